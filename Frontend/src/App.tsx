@@ -31,6 +31,7 @@ export default function App() {
       } catch (error) {
         console.error("Auth check failed", error);
         localStorage.removeItem("token");
+        localStorage.removeItem("refreshToken");
         setCurrentUser(null);
       }
     };
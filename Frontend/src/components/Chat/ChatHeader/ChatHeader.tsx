@@ -25,8 +25,9 @@ import { Avatar } from "../../Shared";
 type ChatHeaderProps = {
   conversation: ConversationInfoType;
   onStartVideoCall?: () => void;
+  status?: string;
 };
-export function ChatHeader({ conversation, onStartVideoCall }: ChatHeaderProps) {
+export function ChatHeader({ conversation, onStartVideoCall, status }: ChatHeaderProps) {
   const { data: users, loading } = useUsersInfo(conversation.users);
   const { currentUser } = useUserStore();
   const { theme } = useTheme();
@@ -103,7 +104,9 @@ export function ChatHeader({ conversation, onStartVideoCall }: ChatHeaderProps)
                     .slice(0, 3)
                     .join(", ")}
               </Name>
-              {conversation.users.length === 2 && filtered?.[0]?.data()?.email && (
+              {status ? (
+                <Email theme={theme}>{status}</Email>
+              ) : conversation.users.length === 2 && filtered?.[0]?.data()?.email && (
                 <Email theme={theme}>{filtered[0].data()?.email}</Email>
               )}
             </div>
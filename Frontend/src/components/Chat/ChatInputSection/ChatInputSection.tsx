@@ -36,6 +36,7 @@ import { ReplyInfoType } from "../../../library";
 import toast from "react-hot-toast";
 import { FiX } from "react-icons/fi";
 import api from "../../../services/api";
+import { socketService } from "../../../services/socket";
 
 type InputHeaderProps = {
   replyInfo: ReplyInfoType | null;
@@ -64,6 +65,23 @@ export function ChatInputSection({
 
   const [fileDragging, setFileDragging] = useState(false);
 
+  // The server batches typing updates and expires them after ~6s, so one
+  // refresh every few seconds while keys are being pressed is enough.
+  const lastTypingSentRef = useRef(0);
+
+  const handleInputChange = (value: string) => {
+    setInputValue(value);
+    const socket = socketService.getSocket();
+    const now = Date.now();
+    if (!value) {
+      lastTypingSentRef.current = 0;
+      socket.emit("typing", { room: conversationId, typing: false });
+    } else if (now - lastTypingSentRef.current > 3000) {
+      lastTypingSentRef.current = now;
+      socket.emit("typing", { room: conversationId, typing: true });
+    }
+  };
+
   type EmojiEvent = {
     unified: string;
   };
@@ -111,6 +129,7 @@ export function ChatInputSection({
     if (!inputValue.trim()) return;
 
     setInputValue("");
+    lastTypingSentRef.current = 0;
     setReplyInfo && setReplyInfo(null);
 
     try {
@@ -316,7 +335,7 @@ export function ChatInputSection({
               maxLength={1000}
               ref={textInputRef}
               value={inputValue}
-              onChange={(e) => setInputValue(e.target.value)}
+              onChange={(e) => handleInputChange(e.target.value)}
               onPaste={handlePaste}
               type="text"
               placeholder="Message..."
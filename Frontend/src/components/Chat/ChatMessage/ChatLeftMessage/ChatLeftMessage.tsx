@@ -122,7 +122,13 @@ export function LeftMessage({
                 event.stopPropagation();
               }}
               title={formattedDate}
-              src={IMAGE_PROXY(message.content)}
+              // Bubble-sized thumbnail when the server has made one.
+              src={IMAGE_PROXY(message.file?.thumbnails?.["480"] || message.content)}
+              style={
+                message.file?.width && message.file?.height
+                  ? { aspectRatio: `${message.file.width} / ${message.file.height}`, height: "auto" }
+                  : undefined
+              }
               alt="image"
             />
           </LeftMessageImage>
@@ -105,7 +105,13 @@ export function ChatRightMessage({ message, setReplyInfo }: RightMessageProps) {
             <img
               className="image"
               title={formattedDate}
-              src={IMAGE_PROXY(message.content)}
+              // Bubble-sized thumbnail when the server has made one.
+              src={IMAGE_PROXY(message.file?.thumbnails?.["480"] || message.content)}
+              style={
+                message.file?.width && message.file?.height
+                  ? { aspectRatio: `${message.file.width} / ${message.file.height}`, height: "auto" }
+                  : undefined
+              }
               alt=""
             />
           </RightMessageImage>
@@ -19,6 +19,7 @@ import {
   AvatarWrapper,
   DeleteButton,
 } from "./Style";
+import { UnreadBadge } from "../Style";
 
 type SelectConversationProps = {
   theme: string | null;
@@ -161,10 +162,15 @@ export function SelectConversation({
                   <Name theme={theme}>{name}</Name>
                   <Timestamp theme={theme}>{formatTimestamp()}</Timestamp>
                 </TopRow>
-                <LastMessage theme={theme}>
-                  <MessageStatus>✓✓</MessageStatus>
-                  {formatLastMessage()}
-                </LastMessage>
+                <TopRow>
+                  <LastMessage theme={theme}>
+                    <MessageStatus>✓✓</MessageStatus>
+                    {formatLastMessage()}
+                  </LastMessage>
+                  {!!conversation.unreadCount && conversationId !== id && (
+                    <UnreadBadge>{conversation.unreadCount}</UnreadBadge>
+                  )}
+                </TopRow>
               </MessageInfo>
               <DeleteButton className="delete-btn" onClick={handleDelete} title="Delete conversation">
                 <LuTrash2 size={18} />
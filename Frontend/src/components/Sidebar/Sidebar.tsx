@@ -38,7 +38,7 @@ import {
 import { Profile, SelectConversation } from ".";
 import { Avatar } from "../Shared";
 import { useCollectionQuery } from "../../hooks/useCollectionQuery";
-import api from "../../services/api";
+import api, { logout } from "../../services/api";
 
 
 
@@ -79,8 +79,7 @@ export function Sidebar() {
   });
 
   const signOutUser = () => {
-    localStorage.removeItem("token");
-    localStorage.removeItem("user");
+    logout();
     setCurrentUser(null);
     toast.success("User signed out successfully");
   };
@@ -25,5 +25,5 @@ export const useCollectionQuery = (key: string, url: string) => {
     fetchData();
   }, [key, url]);
 
-  return { loading, error, data, refetch: fetchData };
+  return { loading, error, data, setData, refetch: fetchData };
 };
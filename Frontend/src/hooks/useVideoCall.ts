@@ -38,12 +38,20 @@ export const useVideoCall = (room: string) => {
             }
         });
 
+        // Trickle ICE candidates arrive coalesced by the server.
+        socket.on("signal-batch", (data: { signals: SignalData[] }) => {
+            if (connectionRef.current) {
+                data.signals.forEach((signal) => connectionRef.current.signal(signal));
+            }
+        });
+
         socket.on("call-ended", () => {
             leaveCall();
         });
 
         return () => {
             socket.off("signal");
+            socket.off("signal-batch");
             socket.off("call-ended");
             leaveCall();
         };
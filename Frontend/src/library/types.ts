@@ -31,6 +31,10 @@ export type ConversationInfoType = {
   };
   updatedAt?: any;
   theme?: string;
+  unreadCount?: number;
+  lastReadSeq?: number;
+  readCursors?: Record<string, number>;
+  presence?: Record<string, string>;
 };
 
 export interface SavedUserType {
@@ -49,6 +53,10 @@ export interface MessageItemType {
   file?: {
     name: string;
     size: number;
+    width?: number;
+    height?: number;
+    blurhash?: string;
+    thumbnails?: Record<string, string>;
   };
   createdAt: {
     seconds: number;
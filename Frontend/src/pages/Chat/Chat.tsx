@@ -1,4 +1,4 @@
-import { useState } from "react";
+import { useCallback, useRef, useState } from "react";
 import { useParams } from "react-router-dom";
 
 import { useDocumentQuery, useCollectionQuery } from "../../hooks";
@@ -11,6 +11,7 @@ import { Spinner } from "../../components/Core";
 import { ChatHeader, ChatInputSection, ChatView } from "../../components/Chat";
 import { VideoCallWindow } from "../../components/Chat/VideoCall/VideoCallWindow";
 import { socketService } from "../../services/socket";
+import api from "../../services/api";
 import { useEffect } from "react";
 
 export default function Chat() {
@@ -28,16 +29,71 @@ export default function Chat() {
 
   const hasAccess = conversation?.users?.includes(currentUser?.uid as string);
 
-  const { data: messagesList, loading: msgLoading, error: msgError, refetch: refetchMessages } = useCollectionQuery(
+  const { data: messagesList, loading: msgLoading, error: msgError, setData: setMessagesList } = useCollectionQuery(
     `conversation-messages-${id}`,
     `/messages/${id}`
   );
 
+  const lastSeqRef = useRef(0);
+
+  useEffect(() => {
+    if (Array.isArray(messagesList)) {
+      lastSeqRef.current = messagesList.reduce(
+        (max: number, message: any) => Math.max(max, message.seq || 0),
+        0
+      );
+    }
+  }, [messagesList]);
+
+  const mergeMessages = useCallback((incoming: any[]) => {
+    setMessagesList((prev: any[] | null) => {
+      const next = [...(prev || [])];
+      incoming.forEach((message) => {
+        const index = next.findIndex((m) => m.id === message.id);
+        if (index === -1) next.push(message);
+        else next[index] = message;
+      });
+      return next.sort((a, b) => a.id - b.id);
+    });
+  }, [setMessagesList]);
+
+  const syncMessages = useCallback(async () => {
+    let hasMore = true;
+    while (hasMore) {
+      const response = await api.get(`/messages/${id}`, {
+        params: { since: lastSeqRef.current },
+      });
+      const { messages, cursor } = response.data;
+      lastSeqRef.current = Math.max(lastSeqRef.current, cursor);
+      mergeMessages(messages);
+      hasMore = response.data.hasMore;
+    }
+  }, [id, mergeMessages]);
+
   const [isVideoCallOpen, setIsVideoCallOpen] = useState(false);
+  const [presence, setPresence] = useState<Record<string, string>>({});
+  const [typing, setTyping] = useState<Record<string, boolean>>({});
+
+  const markRead = useCallback(() => {
+    if (document.visibilityState !== "visible") return;
+    api.post(`/conversations/${id}/read`).catch(() => {});
+  }, [id]);
+
+  useEffect(() => {
+    setPresence({});
+    setTyping({});
+    markRead();
+    document.addEventListener("visibilitychange", markRead);
+    return () => document.removeEventListener("visibilitychange", markRead);
+  }, [markRead]);
 
   useEffect(() => {
     const socket = socketService.getSocket();
-    socket.emit("join-room", { room: id });
+    const joinRoom = () =>
+      socket.emit("join-room", { room: id }, (ack: any) => {
+        if (ack?.presence) setPresence(ack.presence);
+      });
+    joinRoom();
 
     const handleIncomingSignal = (data: any) => {
       if (data.signal.type === "offer") {
@@ -45,20 +101,54 @@ export default function Chat() {
       }
     };
 
-    const handleNewMessage = (data: any) => {
-      if (data.conversationId.toString() === id?.toString()) {
-        refetchMessages();
+    const handleMessageEvent = (data: any) => {
+      if (data.conversationId.toString() !== id?.toString()) return;
+      if (data.message?.senderId !== currentUser?.uid) markRead();
+      if (data.seq <= lastSeqRef.current) return;
+      if (data.message && data.seq === lastSeqRef.current + 1) {
+        lastSeqRef.current = data.seq;
+        mergeMessages([data.message]);
+      } else {
+        // Missed at least one event; fetch only what changed since our cursor.
+        syncMessages();
       }
     };
 
+    // Rooms belong to the connection, so a reconnect (possibly to another
+    // worker) has to rejoin and catch up on anything sent while offline.
+    const handleReconnect = () => {
+      joinRoom();
+      syncMessages();
+    };
+
+    // Typing and presence arrive batched: one event per room per flush window.
+    const handleRoomActivity = (data: any) => {
+      if (data.conversationId.toString() !== id?.toString()) return;
+      if (data.presence) setPresence((prev) => ({ ...prev, ...data.presence }));
+      if (data.typing) setTyping((prev) => ({ ...prev, ...data.typing }));
+    };
+
+    socket.on("connect", handleReconnect);
+    socket.on("room-activity", handleRoomActivity);
     socket.on("signal", handleIncomingSignal);
-    socket.on("new-message", handleNewMessage);
+    socket.on("new-message", handleMessageEvent);
+    socket.on("message-updated", handleMessageEvent);
 
     return () => {
+      socket.off("connect", handleReconnect);
+      socket.off("room-activity", handleRoomActivity);
       socket.off("signal", handleIncomingSignal);
-      socket.off("new-message", handleNewMessage);
+      socket.off("new-message", handleMessageEvent);
+      socket.off("message-updated", handleMessageEvent);
     };
-  }, [id]);
+  }, [id, mergeMessages, syncMessages, markRead, currentUser?.uid]);
+
+  const others = (conversation?.users || []).filter((uid) => uid !== currentUser?.uid);
+  const headerStatus = others.some((uid) => typing[uid])
+    ? "typing…"
+    : others.length === 1 && presence[others[0]] && presence[others[0]] !== "offline"
+      ? presence[others[0]]
+      : undefined;
 
   return (
     <Wrapper theme={theme}>
@@ -76,6 +166,7 @@ export default function Chat() {
             <ChatHeader
               conversation={conversation}
               onStartVideoCall={() => setIsVideoCallOpen(true)}
+              status={headerStatus}
             />
             <ChatView
               replyInfo={replyInfo}
@@ -90,7 +181,7 @@ export default function Chat() {
               replyInfo={replyInfo}
               setReplyInfo={setReplyInfo}
               conversationId={id}
-              refetch={refetchMessages}
+              refetch={syncMessages}
             />
 
             {isVideoCallOpen && id && (
@@ -47,6 +47,7 @@ export default function SignIn() {
         setIsSignUp(false);
       } else {
         localStorage.setItem("token", response.data.token);
+        localStorage.setItem("refreshToken", response.data.refreshToken);
         localStorage.setItem("user", JSON.stringify(response.data.user));
         setCurrentUser(response.data.user);
         toast.success("Signed In! ✅");
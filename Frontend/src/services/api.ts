@@ -20,16 +20,61 @@ api.interceptors.request.use(
     (error) => Promise.reject(error)
 );
 
+const clearSession = () => {
+    localStorage.removeItem('token');
+    localStorage.removeItem('refreshToken');
+    localStorage.removeItem('user');
+};
+
+// Access tokens are short-lived; on a 401 the refresh token is exchanged for
+// a new pair once and the request is retried. Concurrent 401s share one refresh.
+let refreshing: Promise<string> | null = null;
+
+export const refreshAccessToken = () => {
+    if (!refreshing) {
+        const refreshToken = localStorage.getItem('refreshToken');
+        refreshing = (refreshToken
+            ? axios.post(`${API_URL}/auth/refresh`, { refreshToken }).then(({ data }) => {
+                localStorage.setItem('token', data.token);
+                localStorage.setItem('refreshToken', data.refreshToken);
+                return data.token as string;
+            })
+            : Promise.reject(new Error('No refresh token'))
+        ).finally(() => {
+            refreshing = null;
+        });
+    }
+    return refreshing;
+};
+
 api.interceptors.response.use(
     (response) => response,
-    (error) => {
-        if (error.response?.status === 401) {
-            localStorage.removeItem('token');
-            localStorage.removeItem('user');
+    async (error) => {
+        const original = error.config;
+        if (error.response?.status === 401 && original && !original._retried && !original.url?.startsWith('/auth/')) {
+            original._retried = true;
+            try {
+                const token = await refreshAccessToken();
+                original.headers.Authorization = `Bearer ${token}`;
+                return api(original);
+            } catch {
+                // fall through to signing out
+            }
+        }
+        if (error.response?.status === 401 && !original?.url?.startsWith('/auth/')) {
+            clearSession();
             window.location.href = '/signin';
         }
         return Promise.reject(error);
     }
 );
 
+export const logout = () => {
+    const refreshToken = localStorage.getItem('refreshToken');
+    clearSession();
+    if (refreshToken) {
+        axios.post(`${API_URL}/auth/logout`, { refreshToken }).catch(() => undefined);
+    }
+};
+
 export default api;
@@ -1,14 +1,50 @@
 import { io, Socket } from "socket.io-client";
+import { refreshAccessToken } from "./api";
 
 const SOCKET_URL = import.meta.env.VITE_API_URL || "http://localhost:5000";
+// The server marks a user away after ~70s without one.
+const HEARTBEAT_INTERVAL = 25000;
+
+const visibilityStatus = () =>
+    document.visibilityState === "visible" ? "online" : "away";
 
 class SocketService {
     private socket: Socket | null = null;
+    private heartbeatTimer: ReturnType<typeof setInterval> | null = null;
+    private refreshedToken = false;
+
+    private sendHeartbeat = () => {
+        this.socket?.emit("heartbeat", { status: visibilityStatus() });
+    };
 
     connect() {
         if (!this.socket) {
-            this.socket = io(SOCKET_URL);
+            // WebSocket only: long-polling needs sticky sessions once the
+            // backend runs more than one worker.
+            this.socket = io(SOCKET_URL, {
+                transports: ["websocket"],
+                // Read on every (re)connect so a fresh login is picked up.
+                auth: (cb) => cb({ token: localStorage.getItem("token") }),
+            });
+            // The server refuses a handshake with an expired access token and
+            // socket.io-client doesn't retry a refused connection, so refresh
+            // the token once and reconnect.
+            this.socket.on("connect", () => {
+                this.refreshedToken = false;
+            });
+            this.socket.on("connect_error", () => {
+                const socket = this.socket;
+                if (!socket || socket.active || this.refreshedToken) return;
+                this.refreshedToken = true;
+                refreshAccessToken()
+                    .then(() => {
+                        if (this.socket === socket) socket.connect();
+                    })
+                    .catch(() => undefined);
+            });
             console.log("Socket connected to:", SOCKET_URL);
+            this.heartbeatTimer = setInterval(this.sendHeartbeat, HEARTBEAT_INTERVAL);
+            document.addEventListener("visibilitychange", this.sendHeartbeat);
         }
         return this.socket;
     }
@@ -19,6 +55,9 @@ class SocketService {
 
     disconnect() {
         if (this.socket) {
+            if (this.heartbeatTimer) clearInterval(this.heartbeatTimer);
+            this.heartbeatTimer = null;
+            document.removeEventListener("visibilitychange", this.sendHeartbeat);
             this.socket.disconnect();
             this.socket = null;
         }
@@ -1,15 +1,35 @@
 import os
-from flask import Flask, send_from_directory
+from flask import Flask, send_from_directory, jsonify, make_response, request, redirect
 from flask_cors import CORS
 from dotenv import load_dotenv
 from extensions import socketio
-from routes import api_bp
-from db import init_db
+from routes import api_bp, message_writer
+from uploads import MAX_UPLOAD_SIZE, UPLOAD_FOLDER, content_etag, is_immutable_name
+from storage import storage, SIGNED_URL_TTL
+from db import init_db, pool_stats
+from cache import cache_stats
+from rooms import registry as room_registry
+import presence
+import signaling
+import media
+import auth
+import passwords
+import metrics
+import partitions
+import sockets  # registers the Socket.IO event handlers
 
 load_dotenv()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'default_secret_key')
+# Leaves room for multipart framing around a maximum-size single-request upload.
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE + 1024 * 1024
+# Behind Apache/lighttpd, let the front server stream attachment bytes.
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+# Behind nginx, an internal location (e.g. /protected-uploads/) aliased to the upload folder.
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+DEFAULT_UPLOAD_CACHE_CONTROL = 'public, max-age=3600'
 
 default_origins = [
     'https://connect-now-lyart.vercel.app',
@@ -24,41 +44,76 @@ CORS(app, resources={
 socketio.init_app(app, cors_allowed_origins=allowed_origins)
 
 app.register_blueprint(api_bp, url_prefix='/api')
+metrics.init_app(app)
+partitions.start()
+media.start()
 
-@socketio.on('join-room')
-def handle_join_room(data):
-    from flask_socketio import join_room
-    room = data.get('room')
-    if room:
-        join_room(room)
-        print(f"User joined room: {room}")
-
-@socketio.on('signal')
-def handle_signal(data):
-    from flask_socketio import emit
-    room = data.get('room')
-    if room:
-        emit('signal', data, to=room, include_self=False)
-
-@socketio.on('gesture-action')
-def handle_gesture_action(data):
-    from flask_socketio import emit
-    room = data.get('room')
-    if room:
-        emit('gesture-action', data, to=room, include_self=False)
-
-UPLOAD_FOLDER = os.path.join(os.getcwd(), 'uploads')
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    if filename.startswith('.') or '/' in filename:
+        return jsonify({'message': 'Not found'}), 404
+    etag = content_etag(filename)
+    if etag is None:
+        return jsonify({'message': 'Not found'}), 404
+    cache_control = IMMUTABLE_CACHE_CONTROL if is_immutable_name(filename) else DEFAULT_UPLOAD_CACHE_CONTROL
+
+    signed_url = storage.signed_url(filename)
+    if signed_url:
+        # The bytes come straight from the bucket (or nginx secure_link); the
+        # redirect may only be cached for part of the signed URL's lifetime.
+        response = make_response('')
+        response.set_etag(etag)
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            response.headers['Cache-Control'] = cache_control
+            return response
+        response = redirect(signed_url, code=302)
+        response.headers['Cache-Control'] = f"private, max-age={SIGNED_URL_TTL // 2}"
+        return response
+
+    relative_path = storage.relative_path(filename)
+    if relative_path is None:
+        return jsonify({'message': 'Not found'}), 404
+    if X_ACCEL_REDIRECT_PREFIX:
+        response = make_response('')
+        response.set_etag(etag)
+        response = response.make_conditional(request)
+        if response.status_code != 304:
+            response.headers['X-Accel-Redirect'] = f"{X_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{relative_path}"
+    else:
+        # conditional=True answers If-None-Match with 304 and Range with 206;
+        # the body goes out through wsgi.file_wrapper, i.e. sendfile() under gunicorn.
+        response = send_from_directory(storage.root, relative_path, conditional=True, etag=etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
 
 @app.route('/')
 def index():
     return "ConnectNow Backend with Signaling is running!"
 
+def service_stats():
+    return {
+        'dbPool': pool_stats(),
+        'caches': cache_stats(),
+        'sockets': room_registry.stats(),
+        'presence': presence.stats(),
+        'signaling': signaling.stats(),
+        'messageWriter': message_writer.stats(),
+        'media': media.stats(),
+        'auth': {**auth.stats(), 'passwords': passwords.stats()},
+    }
+
+@app.route('/health')
+def health():
+    return jsonify({'status': 'ok', **service_stats()})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.metrics_response(service_stats())
+
 if __name__ == '__main__':
     if os.environ.get('FLASK_ENV') == 'development':
         init_db()
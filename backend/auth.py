@@ -0,0 +1,136 @@
+import os
+import time
+import secrets
+import hashlib
+import datetime
+import jwt
+from flask import request, jsonify
+from functools import wraps
+from cache import TTLCache
+
+SECRET_KEY = os.environ.get('SECRET_KEY', 'default_secret_key')
+# Access tokens are short-lived JWTs checked without touching the database;
+# refresh tokens are opaque, stored hashed in refresh_tokens and rotated on
+# every use.
+ACCESS_TOKEN_TTL = int(os.environ.get('ACCESS_TOKEN_TTL', 15 * 60))
+REFRESH_TOKEN_TTL = int(os.environ.get('REFRESH_TOKEN_TTL', 30 * 24 * 3600))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 20000))
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 300))
+
+# Verified access tokens keyed on their signature, so repeat requests with the
+# same token skip the HMAC and claim checks. An entry never outlives the
+# token's exp claim.
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+
+
+def issue_access_token(user_id, uid):
+    return jwt.encode({
+        'user_id': user_id,
+        'uid': uid,
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(seconds=ACCESS_TOKEN_TTL)
+    }, SECRET_KEY, algorithm="HS256")
+
+
+def decode_token(token):
+    # Returns the user id the token was issued for, or None if it is missing,
+    # expired or forged.
+    if not token:
+        return None
+    signature = token.rsplit('.', 1)[-1]
+    cached = token_cache.get(signature)
+    if cached is not None:
+        user_id, expires_at, cached_token = cached
+        if expires_at > time.time() and cached_token == token:
+            return user_id
+        token_cache.pop(signature)
+    try:
+        data = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+        user_id = data['user_id']
+    except Exception:
+        return None
+    expires_at = data.get('exp')
+    if expires_at is not None:
+        remaining = expires_at - time.time()
+        if remaining > 0:
+            token_cache.set(signature, (user_id, expires_at, token), ttl=min(remaining, TOKEN_CACHE_TTL))
+    return user_id
+
+
+def bearer_token():
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith("Bearer "):
+        return auth_header.split(" ")[1]
+    return None
+
+
+def token_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token = bearer_token()
+        if not token:
+            return jsonify({'message': 'Token is missing!'}), 401
+
+        current_user_id = decode_token(token)
+        if current_user_id is None:
+            return jsonify({'message': 'Token is invalid!'}), 401
+
+        return f(current_user_id, *args, **kwargs)
+    return decorated
+
+
+def _refresh_token_hash(token):
+    # Refresh tokens are 256 random bits, so a plain digest is enough to keep
+    # a database dump from being usable.
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def issue_refresh_token(cur, user_id):
+    token = secrets.token_urlsafe(32)
+    cur.execute("""
+        INSERT INTO refresh_tokens (user_id, token_hash, expires_at)
+        VALUES (%s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s))
+        RETURNING id
+    """, (user_id, _refresh_token_hash(token), REFRESH_TOKEN_TTL))
+    return token, cur.fetchone()[0]
+
+
+def rotate_refresh_token(cur, token):
+    # Returns (user_id, new refresh token), or None. Presenting a token that
+    # was already rotated means it leaked (or a client replayed it), so every
+    # refresh token of that user is revoked; the caller must commit either way.
+    if not token:
+        return None
+    cur.execute("""
+        SELECT id, user_id, revoked_at IS NOT NULL, expires_at <= CURRENT_TIMESTAMP
+        FROM refresh_tokens WHERE token_hash = %s
+        FOR UPDATE
+    """, (_refresh_token_hash(token),))
+    row = cur.fetchone()
+    if not row:
+        return None
+    token_id, user_id, revoked, expired = row
+    if revoked:
+        revoke_user_refresh_tokens(cur, user_id)
+        return None
+    if expired:
+        return None
+    new_token, new_id = issue_refresh_token(cur, user_id)
+    cur.execute("UPDATE refresh_tokens SET revoked_at = CURRENT_TIMESTAMP, replaced_by = %s WHERE id = %s",
+                (new_id, token_id))
+    return user_id, new_token
+
+
+def revoke_refresh_token(cur, token):
+    cur.execute("""
+        UPDATE refresh_tokens SET revoked_at = CURRENT_TIMESTAMP
+        WHERE token_hash = %s AND revoked_at IS NULL
+    """, (_refresh_token_hash(token),))
+
+
+def revoke_user_refresh_tokens(cur, user_id):
+    cur.execute("UPDATE refresh_tokens SET revoked_at = CURRENT_TIMESTAMP WHERE user_id = %s AND revoked_at IS NULL",
+                (user_id,))
+
+
+def stats():
+    return {'tokenCache': token_cache.stats()}
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import datetime
+import statistics
+
+# Run from the backend directory: python -m benchmarks.auth
+# No database needed. Shows that per-request token checks and per-login
+# password hashing are tuned independently: the first table is the cost every
+# authenticated request pays, the second is what PASSWORD_SCRYPT_N buys.
+import jwt
+import auth
+import passwords
+
+REQUESTS = int(os.environ.get('BENCH_REQUESTS', 20000))
+TOKENS = int(os.environ.get('BENCH_TOKENS', 100))
+SCRYPT_NS = [int(n) for n in os.environ.get('BENCH_SCRYPT_NS', '4096,16384,65536').split(',')]
+LOGINS = int(os.environ.get('BENCH_LOGINS', 10))
+
+
+def make_tokens():
+    exp = datetime.datetime.utcnow() + datetime.timedelta(minutes=15)
+    return [jwt.encode({'user_id': i, 'uid': f'bench-{i}', 'exp': exp}, auth.SECRET_KEY, algorithm="HS256")
+            for i in range(TOKENS)]
+
+
+def time_requests(tokens, cached):
+    auth.token_cache.clear()
+    samples = []
+    for i in range(REQUESTS):
+        token = tokens[i % len(tokens)]
+        if not cached:
+            auth.token_cache.clear()
+        started = time.perf_counter()
+        if auth.decode_token(token) != i % len(tokens):
+            sys.exit("decode_token returned the wrong user")
+        samples.append((time.perf_counter() - started) * 1e6)
+    return samples
+
+
+def time_logins(n):
+    stored = passwords.hash_password('correct horse battery staple', n=n)
+    samples = []
+    for _ in range(LOGINS):
+        started = time.perf_counter()
+        passwords.verify_password('correct horse battery staple', stored)
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def main():
+    tokens = make_tokens()
+    print(f"Per-request token check, {REQUESTS} requests over {TOKENS} tokens")
+    print(f"{'mode':>10} {'p50 us':>10} {'p99 us':>10}")
+    for label, cached in (('uncached', False), ('cached', True)):
+        samples = time_requests(tokens, cached)
+        print(f"{label:>10} {statistics.median(samples):>10.2f} {percentile(samples, 0.99):>10.2f}")
+    print(f"token cache: {auth.token_cache.stats()}")
+
+    print()
+    print(f"Login password check, {LOGINS} logins per setting (r={passwords.PASSWORD_SCRYPT_R}, p={passwords.PASSWORD_SCRYPT_P})")
+    print(f"{'scrypt n':>10} {'memory MiB':>11} {'p50 ms':>10} {'max ms':>10}")
+    for n in SCRYPT_NS:
+        samples = time_logins(n)
+        memory = 128 * n * passwords.PASSWORD_SCRYPT_R / 1024 / 1024
+        print(f"{n:>10} {memory:>11.0f} {statistics.median(samples):>10.2f} {max(samples):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
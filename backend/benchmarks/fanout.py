@@ -0,0 +1,168 @@
+import os
+import sys
+import time
+import json
+import uuid
+import datetime
+import threading
+import statistics
+import subprocess
+import urllib.request
+
+# Run from the backend directory:
+#   BENCH_DATABASE_URL=postgresql://... BENCH_SOCKETIO_MESSAGE_QUEUE=redis://localhost:6379/0 \
+#   python -m benchmarks.fanout
+# Starts BENCH_WORKERS copies of app.py sharing one message queue, spreads
+# Socket.IO clients across them and checks that a message sent through one
+# worker reaches the clients on every worker. Needs python-socketio[client].
+BENCH_DATABASE_URL = os.environ.get('BENCH_DATABASE_URL')
+BENCH_SOCKETIO_MESSAGE_QUEUE = os.environ.get('BENCH_SOCKETIO_MESSAGE_QUEUE')
+if not BENCH_DATABASE_URL or not BENCH_SOCKETIO_MESSAGE_QUEUE:
+    sys.exit("Set BENCH_DATABASE_URL to a throwaway PostgreSQL database and BENCH_SOCKETIO_MESSAGE_QUEUE to a broker url.")
+if BENCH_SOCKETIO_MESSAGE_QUEUE.startswith('local://'):
+    sys.exit("local:// queues only work inside one process; use redis:// or amqp://.")
+os.environ['DATABASE_URL'] = BENCH_DATABASE_URL
+
+import jwt
+import socketio
+from db import init_db, connection
+from auth import SECRET_KEY
+
+WORKERS = int(os.environ.get('BENCH_WORKERS', 3))
+BASE_PORT = int(os.environ.get('BENCH_BASE_PORT', 5100))
+CLIENTS_PER_WORKER = int(os.environ.get('BENCH_CLIENTS_PER_WORKER', 20))
+MESSAGES = int(os.environ.get('BENCH_MESSAGES', 50))
+DELIVERY_TIMEOUT = float(os.environ.get('BENCH_DELIVERY_TIMEOUT', 5))
+
+
+def start_workers():
+    workers = []
+    for i in range(WORKERS):
+        env = dict(os.environ,
+                   PORT=str(BASE_PORT + i),
+                   FLASK_ENV='production',
+                   DATABASE_URL=BENCH_DATABASE_URL,
+                   SOCKETIO_MESSAGE_QUEUE=BENCH_SOCKETIO_MESSAGE_QUEUE)
+        workers.append(subprocess.Popen([sys.executable, 'app.py'], env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    deadline = time.time() + 30
+    for i in range(WORKERS):
+        while True:
+            try:
+                urllib.request.urlopen(f'http://127.0.0.1:{BASE_PORT + i}/', timeout=1)
+                break
+            except OSError:
+                if time.time() > deadline:
+                    stop_workers(workers)
+                    sys.exit(f"Worker on port {BASE_PORT + i} did not start.")
+                time.sleep(0.2)
+    return workers
+
+
+def stop_workers(workers):
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.wait()
+
+
+def seed(cur):
+    cur.execute("""
+        INSERT INTO users (uid, email, password_hash, display_name)
+        VALUES ('bench-fanout-sender', 'bench-fanout-sender@example.com', '', 'Fanout Sender'),
+               ('bench-fanout-peer', 'bench-fanout-peer@example.com', '', 'Fanout Peer')
+        ON CONFLICT (uid) DO UPDATE SET display_name = EXCLUDED.display_name
+        RETURNING id
+    """)
+    user_ids = [row[0] for row in cur.fetchall()]
+    cur.execute("INSERT INTO conversations (last_message) VALUES ('') RETURNING id")
+    conversation_id = cur.fetchone()[0]
+    cur.execute("INSERT INTO conversation_participants (conversation_id, user_id) VALUES (%s, %s), (%s, %s)",
+                (conversation_id, user_ids[0], conversation_id, user_ids[1]))
+    return user_ids[0], conversation_id
+
+
+def make_token(user_id, uid):
+    return jwt.encode({
+        'user_id': user_id,
+        'uid': uid,
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    }, SECRET_KEY, algorithm="HS256")
+
+
+def connect_clients(conversation_id, token, on_message):
+    clients = []
+    for i in range(WORKERS):
+        for _ in range(CLIENTS_PER_WORKER):
+            client = socketio.Client(reconnection=False)
+            client.on('new-message', lambda data, worker=i: on_message(worker, data))
+            client.connect(f'http://127.0.0.1:{BASE_PORT + i}', transports=['websocket'], auth={'token': token})
+            client.emit('join-room', {'room': str(conversation_id)})
+            clients.append(client)
+    # join-room has no ack; give every worker a moment to register the rooms.
+    time.sleep(1)
+    return clients
+
+
+def post_message(port, token, conversation_id, content):
+    body = json.dumps({'conversationId': conversation_id, 'content': content, 'type': 'text'}).encode()
+    req = urllib.request.Request(f'http://127.0.0.1:{port}/api/messages', data=body, method='POST',
+                                 headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {token}'})
+    with urllib.request.urlopen(req, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def run():
+    init_db()
+    with connection() as conn, conn.cursor() as cur:
+        sender_id, conversation_id = seed(cur)
+        conn.commit()
+    token = make_token(sender_id, 'bench-fanout-sender')
+
+    workers = start_workers()
+    clients = []
+    try:
+        lock = threading.Lock()
+        sent_at = {}
+        latencies = [[] for _ in range(WORKERS)]
+
+        def on_message(worker, data):
+            received = time.perf_counter()
+            content = data['message']['content']
+            with lock:
+                if content in sent_at:
+                    latencies[worker].append((received - sent_at[content]) * 1000)
+
+        clients = connect_clients(conversation_id, token, on_message)
+
+        for n in range(MESSAGES):
+            content = f'fanout-{uuid.uuid4()}'
+            with lock:
+                sent_at[content] = time.perf_counter()
+            post_message(BASE_PORT + n % WORKERS, token, conversation_id, content)
+
+        expected = MESSAGES * CLIENTS_PER_WORKER
+        deadline = time.time() + DELIVERY_TIMEOUT
+        while time.time() < deadline and any(len(samples) < expected for samples in latencies):
+            time.sleep(0.1)
+
+        print(f"{WORKERS} workers, {CLIENTS_PER_WORKER} clients each, {MESSAGES} messages over {BENCH_SOCKETIO_MESSAGE_QUEUE}")
+        print(f"{'worker':>7} {'delivered':>10} {'p50 ms':>9} {'max ms':>9}")
+        delivered = 0
+        for i, samples in enumerate(latencies):
+            delivered += len(samples)
+            p50 = statistics.median(samples) if samples else float('nan')
+            worst = max(samples) if samples else float('nan')
+            print(f"{BASE_PORT + i:>7} {len(samples):>6}/{expected:<3} {p50:>9.2f} {worst:>9.2f}")
+        ratio = delivered / (expected * WORKERS)
+        print(f"delivery ratio: {ratio:.4f}")
+        if ratio < 1:
+            sys.exit(1)
+    finally:
+        for client in clients:
+            client.disconnect()
+        stop_workers(workers)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,136 @@
+import os
+import sys
+import time
+import datetime
+import statistics
+
+# Run from the backend directory: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.inbox
+# The benchmark seeds rows, so it refuses to run against the app's own DATABASE_URL.
+BENCH_DATABASE_URL = os.environ.get('BENCH_DATABASE_URL')
+if not BENCH_DATABASE_URL:
+    sys.exit("Set BENCH_DATABASE_URL to a throwaway PostgreSQL database.")
+os.environ['DATABASE_URL'] = BENCH_DATABASE_URL
+
+import jwt
+from db import init_db, connection
+from app import app
+import inbox
+from auth import SECRET_KEY
+
+SCALES = [int(n) for n in os.environ.get('BENCH_SCALES', '10,100,1000,10000').split(',')]
+ITERATIONS = int(os.environ.get('BENCH_ITERATIONS', 30))
+
+
+def seed_user(cur):
+    cur.execute("""
+        INSERT INTO users (uid, email, password_hash, display_name)
+        VALUES ('bench-inbox-owner', 'bench-inbox-owner@example.com', '', 'Inbox Owner')
+        ON CONFLICT (uid) DO UPDATE SET display_name = EXCLUDED.display_name
+        RETURNING id
+    """)
+    return cur.fetchone()[0]
+
+
+def grow_inbox(cur, user_id, current, target):
+    # One direct chat per peer, each with one message from the peer, and the
+    # inbox_entries projection built for them as the API would have.
+    count = target - current
+    if count <= 0:
+        return
+    cur.execute("""
+        WITH peers AS (
+            INSERT INTO users (uid, email, password_hash, display_name)
+            SELECT 'bench-inbox-peer-' || g, 'bench-inbox-peer-' || g || '@example.com', '', 'Peer ' || g
+            FROM generate_series(%(start)s, %(stop)s) g
+            ON CONFLICT (uid) DO UPDATE SET display_name = EXCLUDED.display_name
+            RETURNING id
+        ),
+        numbered_peers AS (
+            SELECT id, row_number() OVER (ORDER BY id) AS n FROM peers
+        ),
+        convs AS (
+            INSERT INTO conversations (last_message, updated_at, seq, message_count)
+            SELECT 'Message ' || g, CURRENT_TIMESTAMP - g * INTERVAL '1 second', 1, 1
+            FROM generate_series(%(start)s, %(stop)s) g
+            RETURNING id
+        ),
+        numbered_convs AS (
+            SELECT id, row_number() OVER (ORDER BY id) AS n FROM convs
+        )
+        INSERT INTO conversation_participants (conversation_id, user_id)
+        SELECT c.id, %(user_id)s FROM numbered_convs c
+        UNION ALL
+        SELECT c.id, p.id FROM numbered_convs c JOIN numbered_peers p ON p.n = c.n
+        RETURNING conversation_id
+    """, {'start': current + 1, 'stop': target, 'user_id': user_id})
+    conversation_ids = sorted({row[0] for row in cur.fetchall()})
+    cur.execute("""
+        INSERT INTO messages (conversation_id, sender_id, content, type, seq, created_at)
+        SELECT p.conversation_id, p.user_id, c.last_message, 'text', 1, c.updated_at
+        FROM conversation_participants p
+        JOIN conversations c ON c.id = p.conversation_id
+        WHERE p.conversation_id = ANY(%(ids)s) AND p.user_id <> %(user_id)s
+        ORDER BY c.updated_at
+    """, {'ids': conversation_ids, 'user_id': user_id})
+    cur.execute("""
+        UPDATE conversations c SET direct_key = k.direct_key
+        FROM (
+            SELECT conversation_id, MIN(user_id) || ':' || MAX(user_id) AS direct_key
+            FROM conversation_participants WHERE conversation_id = ANY(%s)
+            GROUP BY conversation_id
+        ) k
+        WHERE k.conversation_id = c.id
+    """, (conversation_ids,))
+    inbox.rebuild(cur, conversation_ids)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run():
+    init_db()
+    client = app.test_client()
+
+    with connection() as conn, conn.cursor() as cur:
+        user_id = seed_user(cur)
+        cur.execute("SELECT COUNT(*) FROM conversation_participants WHERE user_id = %s", (user_id,))
+        existing = cur.fetchone()[0]
+        conn.commit()
+
+    token = jwt.encode({
+        'user_id': user_id,
+        'uid': 'bench-inbox-owner',
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    }, SECRET_KEY, algorithm="HS256")
+    headers = {'Authorization': f'Bearer {token}'}
+
+    print(f"{'conversations':>14} {'p50 ms':>9} {'p95 ms':>9} {'per conv us':>12}")
+    for scale in SCALES:
+        with connection() as conn, conn.cursor() as cur:
+            grow_inbox(cur, user_id, existing, scale)
+            conn.commit()
+            cur.execute("ANALYZE conversations; ANALYZE conversation_participants; ANALYZE users; "
+                        "ANALYZE messages; ANALYZE inbox_entries;")
+        existing = max(existing, scale)
+
+        client.get('/api/conversations', headers=headers)
+        samples = []
+        for _ in range(ITERATIONS):
+            started = time.perf_counter()
+            response = client.get('/api/conversations', headers=headers)
+            samples.append((time.perf_counter() - started) * 1000)
+            assert response.status_code == 200, response.data
+        # Conversations seeded by an older version of this benchmark have no
+        # messages and aren't listed; start from an empty database then.
+        listed = len(response.get_json())
+        assert listed == existing, f"inbox lists {listed} of {existing} conversations"
+
+        p50 = statistics.median(samples)
+        print(f"{existing:>14} {p50:>9.2f} {percentile(samples, 95):>9.2f} {p50 * 1000 / existing:>12.2f}")
+
+
+if __name__ == "__main__":
+    run()
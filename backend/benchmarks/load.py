@@ -0,0 +1,418 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import datetime
+import tempfile
+import threading
+import subprocess
+import http.client
+import urllib.parse
+import urllib.request
+
+# Run from the backend directory:
+#   BENCH_DATABASE_URL=postgresql://... python -m benchmarks.load           # run and compare
+#   BENCH_DATABASE_URL=postgresql://... python -m benchmarks.load save      # run and store the baseline
+# Seeds BENCH_USERS users with BENCH_CONVERSATIONS conversations of
+# BENCH_MESSAGES_PER_CONVERSATION messages (same BENCH_SEED, same data),
+# starts app.py on BENCH_PORT and drives a weighted mix of inbox loads,
+# history fetches, message sends, user and message searches and uploads from
+# BENCH_CONCURRENCY threads for BENCH_DURATION seconds. BENCH_SOCKET_CLIENTS
+# users are also connected over Socket.IO (needs python-socketio[client]) to
+# time fan-out of the sends.
+#
+# Results are compared with the stored baseline: a scenario regresses when
+# its p95 grows or its throughput drops by more than BENCH_TOLERANCE, or when
+# it runs more database queries per request than before (read from /metrics).
+# Other settings of the app (MESSAGE_WRITE_MODE, DB_POOL_MAX_SIZE, ...) are
+# passed through from the environment.
+BENCH_DATABASE_URL = os.environ.get('BENCH_DATABASE_URL')
+if not BENCH_DATABASE_URL:
+    sys.exit("Set BENCH_DATABASE_URL to a throwaway PostgreSQL database.")
+os.environ['DATABASE_URL'] = BENCH_DATABASE_URL
+
+import jwt
+from psycopg2.extras import execute_values
+from db import init_db, connection
+from auth import SECRET_KEY
+import inbox
+
+PORT = int(os.environ.get('BENCH_PORT', 5200))
+USERS = int(os.environ.get('BENCH_USERS', 200))
+CONVERSATIONS = int(os.environ.get('BENCH_CONVERSATIONS', 1000))
+MESSAGES_PER_CONVERSATION = int(os.environ.get('BENCH_MESSAGES_PER_CONVERSATION', 50))
+DURATION = float(os.environ.get('BENCH_DURATION', 30))
+WARMUP = float(os.environ.get('BENCH_WARMUP', 3))
+CONCURRENCY = int(os.environ.get('BENCH_CONCURRENCY', 16))
+MIX = os.environ.get('BENCH_MIX', 'inbox=30,history=25,send=20,search=10,message_search=10,upload=5')
+SOCKET_CLIENTS = int(os.environ.get('BENCH_SOCKET_CLIENTS', 20))
+UPLOAD_BYTES = int(os.environ.get('BENCH_UPLOAD_BYTES', 64 * 1024))
+SEED = int(os.environ.get('BENCH_SEED', 1))
+TOLERANCE = float(os.environ.get('BENCH_TOLERANCE', 0.25))
+BASELINE = os.environ.get('BENCH_BASELINE', os.path.join(os.path.dirname(__file__), 'baselines', 'load.json'))
+
+# The route each scenario exercises, to pick its query counts out of /metrics.
+SCENARIO_ROUTES = {
+    'inbox': '/api/conversations',
+    'history': '/api/messages/<int:conversation_id>',
+    'send': '/api/messages',
+    'search': '/api/users/search',
+    'message_search': '/api/messages/search',
+    'upload': '/api/upload',
+}
+
+
+def parse_mix(text):
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIO_ROUTES:
+            sys.exit(f"Unknown scenario {name!r} in BENCH_MIX")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def seed():
+    # Rebuilds the bench-load-* data from scratch so every run starts from the
+    # same state.
+    rng = random.Random(SEED)
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            DELETE FROM conversations WHERE id IN (
+                SELECT p.conversation_id FROM conversation_participants p
+                JOIN users u ON u.id = p.user_id WHERE u.uid LIKE 'bench-load-%'
+            )
+        """)
+        cur.execute("DELETE FROM users WHERE uid LIKE 'bench-load-%'")
+        rows = execute_values(cur, """
+            INSERT INTO users (uid, email, password_hash, display_name) VALUES %s RETURNING id, uid
+        """, [(f'bench-load-{i}', f'bench-load-{i}@example.com', '', f'Load User {i}') for i in range(USERS)],
+            page_size=1000, fetch=True)
+        users = sorted(rows, key=lambda row: int(row[1].rsplit('-', 1)[1]))
+
+        pairs = set()
+        while len(pairs) < min(CONVERSATIONS, USERS * (USERS - 1) // 2):
+            a, b = rng.sample(range(USERS), 2)
+            pairs.add((min(a, b), max(a, b)))
+        pairs = sorted(pairs)
+        conversation_ids = [row[0] for row in execute_values(cur, """
+            INSERT INTO conversations (last_message, seq, message_count, direct_key) VALUES %s RETURNING id
+        """, [(f'Seed message {MESSAGES_PER_CONVERSATION}', MESSAGES_PER_CONVERSATION, MESSAGES_PER_CONVERSATION,
+               f'{min(users[a][0], users[b][0])}:{max(users[a][0], users[b][0])}')
+              for a, b in pairs], page_size=1000, fetch=True)]
+
+        conversations = []
+        participants = []
+        for conversation_id, (a, b) in zip(conversation_ids, pairs):
+            conversations.append((conversation_id, users[a][0], users[b][0]))
+            for i in (a, b):
+                participants.append((conversation_id, users[i][0], MESSAGES_PER_CONVERSATION, MESSAGES_PER_CONVERSATION))
+        execute_values(cur, """
+            INSERT INTO conversation_participants (conversation_id, user_id, read_count, last_read_seq) VALUES %s
+        """, participants, page_size=1000)
+        execute_values(cur, f"""
+            INSERT INTO messages (conversation_id, sender_id, content, type, seq, created_at)
+            SELECT v.conversation_id, CASE WHEN g %% 2 = 0 THEN v.a ELSE v.b END, 'Seed message ' || g, 'text', g,
+                   CURRENT_TIMESTAMP - ({MESSAGES_PER_CONVERSATION} - g) * INTERVAL '1 minute'
+            FROM (VALUES %s) AS v(conversation_id, a, b), generate_series(1, {MESSAGES_PER_CONVERSATION}) g
+        """, conversations, page_size=200)
+        inbox.rebuild(cur, conversation_ids)
+        conn.commit()
+        cur.execute("ANALYZE users; ANALYZE conversations; ANALYZE conversation_participants; ANALYZE messages; ANALYZE inbox_entries;")
+        conn.commit()
+
+    by_user = {}
+    for conversation_id, a, b in conversations:
+        by_user.setdefault(a, []).append(conversation_id)
+        by_user.setdefault(b, []).append(conversation_id)
+    return [(user_id, uid) for user_id, uid in users if user_id in by_user], by_user
+
+
+def make_token(user_id, uid):
+    return jwt.encode({
+        'user_id': user_id,
+        'uid': uid,
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=2)
+    }, SECRET_KEY, algorithm="HS256")
+
+
+def start_app(upload_root):
+    env = dict(os.environ, PORT=str(PORT), FLASK_ENV='production', DATABASE_URL=BENCH_DATABASE_URL,
+               STORAGE_LOCAL_ROOT=upload_root)
+    process = subprocess.Popen([sys.executable, 'app.py'], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while True:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{PORT}/', timeout=1)
+            return process
+        except OSError:
+            if process.poll() is not None or time.time() > deadline:
+                process.terminate()
+                sys.exit(f"app.py did not start on port {PORT}.")
+            time.sleep(0.2)
+
+
+class Client:
+    # One keep-alive HTTP connection per load thread.
+    def __init__(self, token):
+        self.token = token
+        self.conn = http.client.HTTPConnection('127.0.0.1', PORT, timeout=30)
+
+    def request(self, method, path, body=None, content_type='application/json'):
+        headers = {'Authorization': f'Bearer {self.token}'}
+        if body is not None:
+            headers['Content-Type'] = content_type
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = http.client.HTTPConnection('127.0.0.1', PORT, timeout=30)
+            return 0, None
+        return response.status, data
+
+
+def multipart(filename, payload):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + payload + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.sent_at = {}
+        self.fanout = []
+
+    def record(self, scenario, elapsed, ok):
+        with self.lock:
+            if ok:
+                self.samples.setdefault(scenario, []).append(elapsed)
+            else:
+                self.errors[scenario] = self.errors.get(scenario, 0) + 1
+
+
+def run_scenario(scenario, client, rng, user_conversations):
+    if scenario == 'inbox':
+        return client.request('GET', '/api/conversations'), None
+    if scenario == 'history':
+        conversation_id = rng.choice(user_conversations)
+        return client.request('GET', f'/api/messages/{conversation_id}?limit=50'), None
+    if scenario == 'send':
+        conversation_id = rng.choice(user_conversations)
+        content = f'bench-{uuid.uuid4().hex}'
+        body = json.dumps({'conversationId': conversation_id, 'content': content, 'type': 'text'})
+        return client.request('POST', '/api/messages', body.encode()), content
+    if scenario == 'search':
+        query = rng.choice(['load', 'user', f'user {rng.randrange(USERS)}', f'bench-load-{rng.randrange(USERS)}'])
+        return client.request('GET', f'/api/users/search?q={urllib.parse.quote(query)}&limit=20'), None
+    if scenario == 'message_search':
+        query = rng.choice(['seed', f'message {rng.randint(1, MESSAGES_PER_CONVERSATION)}', '"seed message"', 'bench'])
+        sort = rng.choice(['recent', 'recent', 'relevance'])
+        return client.request('GET', f'/api/messages/search?q={urllib.parse.quote(query)}&sort={sort}&limit=20'), None
+    body, content_type = multipart(f'bench-{uuid.uuid4().hex}.bin', os.urandom(UPLOAD_BYTES))
+    return client.request('POST', '/api/upload', body, content_type), None
+
+
+def load_thread(index, users, by_user, mix, recorder, start_at, stop_at):
+    rng = random.Random(SEED * 1000 + index)
+    user_id, uid = users[index % len(users)]
+    client = Client(make_token(user_id, uid))
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    while True:
+        now = time.perf_counter()
+        if now >= stop_at:
+            break
+        scenario = rng.choices(names, weights)[0]
+        started = time.perf_counter()
+        (status, _), content = run_scenario(scenario, client, rng, by_user[user_id])
+        if content is not None:
+            with recorder.lock:
+                recorder.sent_at[content] = started
+        if started >= start_at:
+            recorder.record(scenario, (time.perf_counter() - started) * 1000, 200 <= status < 300)
+
+
+def connect_sockets(users, by_user, recorder):
+    if SOCKET_CLIENTS <= 0:
+        return []
+    try:
+        import socketio
+    except ImportError:
+        print("python-socketio[client] is not installed; skipping fan-out timing.")
+        return []
+
+    def on_message(data):
+        received = time.perf_counter()
+        content = (data.get('message') or {}).get('content')
+        with recorder.lock:
+            sent = recorder.sent_at.get(content)
+            if sent is not None:
+                recorder.fanout.append((received - sent) * 1000)
+
+    clients = []
+    for user_id, uid in users[:SOCKET_CLIENTS]:
+        client = socketio.Client(reconnection=False)
+        client.on('new-message', on_message)
+        client.connect(f'http://127.0.0.1:{PORT}', transports=['websocket'], auth={'token': make_token(user_id, uid)})
+        for conversation_id in by_user[user_id]:
+            client.call('join-room', {'room': str(conversation_id)}, timeout=10)
+        clients.append(client)
+    return clients
+
+
+def route_query_counts():
+    # Average database queries per request for each route, from /metrics.
+    with urllib.request.urlopen(f'http://127.0.0.1:{PORT}/metrics', timeout=10) as response:
+        text = response.read().decode()
+    sums, counts = {}, {}
+    for line in text.splitlines():
+        for suffix, target in (('_sum', sums), ('_count', counts)):
+            prefix = f'connectnow_http_request_db_queries{suffix}{{route="'
+            if line.startswith(prefix):
+                route, value = line[len(prefix):].split('"} ')
+                target[route] = float(value)
+    return {route: sums[route] / counts[route] for route in counts if counts[route]}
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(recorder, queries):
+    results = {}
+    for scenario, route in SCENARIO_ROUTES.items():
+        samples = recorder.samples.get(scenario, [])
+        errors = recorder.errors.get(scenario, 0)
+        if not samples and not errors:
+            continue
+        results[scenario] = {
+            'requests': len(samples),
+            'errors': errors,
+            'rps': round(len(samples) / DURATION, 2),
+            'p50': round(percentile(samples, 50), 2) if samples else None,
+            'p95': round(percentile(samples, 95), 2) if samples else None,
+            'p99': round(percentile(samples, 99), 2) if samples else None,
+            'queriesPerRequest': round(queries[route], 2) if route in queries else None,
+        }
+    if recorder.fanout:
+        results['fanout'] = {
+            'requests': len(recorder.fanout),
+            'errors': 0,
+            'rps': round(len(recorder.fanout) / DURATION, 2),
+            'p50': round(percentile(recorder.fanout, 50), 2),
+            'p95': round(percentile(recorder.fanout, 95), 2),
+            'p99': round(percentile(recorder.fanout, 99), 2),
+            'queriesPerRequest': None,
+        }
+    return results
+
+
+def print_results(results):
+    print(f"{'scenario':>9} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}")
+    for scenario, r in results.items():
+        cells = [f"{r[k]:>8.2f}" if r[k] is not None else f"{'-':>8}" for k in ('p50', 'p95', 'p99', 'queriesPerRequest')]
+        print(f"{scenario:>9} {r['requests']:>9} {r['errors']:>7} {r['rps']:>8.2f} {' '.join(cells)}")
+
+
+def settings():
+    return {
+        'users': USERS,
+        'conversations': CONVERSATIONS,
+        'messagesPerConversation': MESSAGES_PER_CONVERSATION,
+        'concurrency': CONCURRENCY,
+        'duration': DURATION,
+        'mix': MIX,
+        'socketClients': SOCKET_CLIENTS,
+        'seed': SEED,
+    }
+
+
+def compare(results):
+    if not os.path.exists(BASELINE):
+        print(f"No baseline at {BASELINE}; run with 'save' to create one.")
+        return True
+    with open(BASELINE) as f:
+        baseline = json.load(f)
+    if baseline.get('settings') != settings():
+        print("Baseline was recorded with different settings; not comparing.")
+        return True
+
+    ok = True
+    for scenario, base in baseline['results'].items():
+        current = results.get(scenario)
+        if current is None:
+            continue
+        problems = []
+        if base['p95'] and current['p95'] and current['p95'] > base['p95'] * (1 + TOLERANCE):
+            problems.append(f"p95 {base['p95']} -> {current['p95']} ms")
+        if base['rps'] and current['rps'] < base['rps'] * (1 - TOLERANCE):
+            problems.append(f"throughput {base['rps']} -> {current['rps']} req/s")
+        if base['queriesPerRequest'] is not None and current['queriesPerRequest'] is not None \
+                and current['queriesPerRequest'] > base['queriesPerRequest'] + 0.5:
+            problems.append(f"queries/request {base['queriesPerRequest']} -> {current['queriesPerRequest']}")
+        if current['errors'] > base['errors']:
+            problems.append(f"errors {base['errors']} -> {current['errors']}")
+        if problems:
+            ok = False
+            print(f"REGRESSION {scenario}: {'; '.join(problems)}")
+    if ok:
+        print(f"No regressions against {BASELINE} (tolerance {TOLERANCE:.0%}).")
+    return ok
+
+
+def run(mode):
+    mix = parse_mix(MIX)
+    init_db()
+    started = time.perf_counter()
+    users, by_user = seed()
+    print(f"Seeded {len(users)} users, {sum(len(c) for c in by_user.values()) // 2} conversations "
+          f"x {MESSAGES_PER_CONVERSATION} messages in {time.perf_counter() - started:.1f}s")
+
+    recorder = Recorder()
+    with tempfile.TemporaryDirectory() as upload_root:
+        process = start_app(upload_root)
+        sockets = []
+        try:
+            sockets = connect_sockets(users, by_user, recorder)
+            start_at = time.perf_counter() + WARMUP
+            stop_at = start_at + DURATION
+            threads = [threading.Thread(target=load_thread, args=(i, users, by_user, mix, recorder, start_at, stop_at))
+                       for i in range(CONCURRENCY)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            time.sleep(1)
+            results = summarize(recorder, route_query_counts())
+        finally:
+            for client in sockets:
+                client.disconnect()
+            process.terminate()
+            process.wait()
+
+    print(f"{CONCURRENCY} threads for {DURATION:.0f}s against app.py on port {PORT}")
+    print_results(results)
+    if mode == 'save':
+        os.makedirs(os.path.dirname(BASELINE), exist_ok=True)
+        with open(BASELINE, 'w') as f:
+            json.dump({'settings': settings(), 'results': results}, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {BASELINE}")
+    elif not compare(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] not in ([], ['save']):
+        sys.exit("Usage: python -m benchmarks.load [save]")
+    run('save' if sys.argv[1:] == ['save'] else 'compare')
@@ -0,0 +1,236 @@
+import time
+import threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    # Bounded LRU where every entry also expires after ttl seconds. Shared by
+    # all greenlets/threads of a worker; each worker process has its own copy.
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxSize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hitRatio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# Results of /api/users/search, keyed on (normalized query, offset, limit).
+search_cache = TTLCache(maxsize=2048, ttl=30)
+
+# User profiles keyed on users.id, plus the uid -> id mapping used by routes
+# that receive uids from the client. Profiles change only through
+# update_profile, which invalidates them.
+profile_cache = TTLCache(maxsize=10000, ttl=300)
+uid_cache = TTLCache(maxsize=10000, ttl=300)
+
+# Conversation id -> frozenset of participant user ids. Loading it reads
+# the whole room, so checks on a single user go through member_cache instead.
+membership_cache = TTLCache(maxsize=5000, ttl=60)
+# (conversation id, user id) -> role.
+member_cache = TTLCache(maxsize=50000, ttl=60)
+# Conversation id -> {'kind', 'name', 'memberCount'}.
+conversation_cache = TTLCache(maxsize=5000, ttl=60)
+
+
+def _profile_from_row(row):
+    return {
+        'id': row[0],
+        'uid': row[1],
+        'email': row[2],
+        'displayName': row[3],
+        'photoURL': row[4]
+    }
+
+
+def public_profile(profile):
+    return {key: profile[key] for key in ('uid', 'email', 'displayName', 'photoURL')}
+
+
+def _store_profiles(rows):
+    profiles = [_profile_from_row(row) for row in rows]
+    for profile in profiles:
+        profile_cache.set(profile['id'], profile)
+        uid_cache.set(profile['uid'], profile['id'])
+    return profiles
+
+
+def _with_cursor(cur, fn):
+    if cur is not None:
+        return fn(cur)
+    from db import connection
+    with connection() as conn, conn.cursor() as own_cur:
+        return fn(own_cur)
+
+
+def get_profiles(user_ids, cur=None):
+    found = {}
+    missing = []
+    for user_id in set(user_ids):
+        profile = profile_cache.get(user_id)
+        if profile is None:
+            missing.append(user_id)
+        else:
+            found[user_id] = profile
+    if missing:
+        def load(c):
+            c.execute("SELECT id, uid, email, display_name, photo_url FROM users WHERE id = ANY(%s)", (missing,))
+            return c.fetchall()
+        for profile in _store_profiles(_with_cursor(cur, load)):
+            found[profile['id']] = profile
+    return found
+
+
+def get_profile(user_id, cur=None):
+    return get_profiles([user_id], cur).get(user_id)
+
+
+def get_profiles_by_uid(uids, cur=None):
+    found = {}
+    missing = []
+    for uid in set(uids):
+        user_id = uid_cache.get(uid)
+        profile = profile_cache.get(user_id) if user_id is not None else None
+        if profile is None:
+            missing.append(uid)
+        else:
+            found[uid] = profile
+    if missing:
+        def load(c):
+            c.execute("SELECT id, uid, email, display_name, photo_url FROM users WHERE uid = ANY(%s)", (missing,))
+            return c.fetchall()
+        for profile in _store_profiles(_with_cursor(cur, load)):
+            found[profile['uid']] = profile
+    return found
+
+
+def get_profile_by_uid(uid, cur=None):
+    return get_profiles_by_uid([uid], cur).get(uid)
+
+
+def get_member_ids(conversation_id, cur=None):
+    members = membership_cache.get(conversation_id)
+    if members is None:
+        def load(c):
+            c.execute("SELECT user_id FROM conversation_participants WHERE conversation_id = %s", (conversation_id,))
+            return c.fetchall()
+        members = frozenset(row[0] for row in _with_cursor(cur, load))
+        membership_cache.set(conversation_id, members)
+    return members
+
+
+def get_role(conversation_id, user_id, cur=None, fresh=False):
+    # The member's role, or None. One primary-key lookup per (conversation,
+    # user) however large the room is. Only members are cached, so someone
+    # just added is never turned away by a stale entry on another worker.
+    # Removals and role changes are only invalidated on the worker that made
+    # them, so writes and socket joins pass fresh=True and read the row.
+    key = (conversation_id, user_id)
+    role = None if fresh else member_cache.get(key)
+    if role is None:
+        def load(c):
+            c.execute("SELECT role FROM conversation_participants WHERE conversation_id = %s AND user_id = %s",
+                      (conversation_id, user_id))
+            return c.fetchone()
+        row = _with_cursor(cur, load)
+        if row is None:
+            member_cache.pop(key)
+            return None
+        role = row[0]
+        member_cache.set(key, role)
+    return role
+
+
+def is_member(conversation_id, user_id, cur=None, fresh=False):
+    return get_role(conversation_id, user_id, cur, fresh) is not None
+
+
+def get_conversation(conversation_id, cur=None):
+    info = conversation_cache.get(conversation_id)
+    if info is None:
+        def load(c):
+            c.execute("SELECT kind, name, member_count FROM conversations WHERE id = %s", (conversation_id,))
+            return c.fetchone()
+        row = _with_cursor(cur, load)
+        if row is None:
+            return None
+        info = {'kind': row[0], 'name': row[1], 'memberCount': row[2]}
+        conversation_cache.set(conversation_id, info)
+    return info
+
+
+def invalidate_user(user_id):
+    profile = profile_cache.pop(user_id)
+    if profile:
+        uid_cache.pop(profile['uid'])
+    # Search results embed display names and photos.
+    search_cache.clear()
+
+
+def invalidate_conversation(conversation_id, user_ids=()):
+    # user_ids: members who joined, left or changed role.
+    membership_cache.pop(conversation_id)
+    conversation_cache.pop(conversation_id)
+    for user_id in user_ids:
+        member_cache.pop((conversation_id, user_id))
+
+
+def cache_stats():
+    return {
+        'profiles': profile_cache.stats(),
+        'uids': uid_cache.stats(),
+        'memberships': membership_cache.stats(),
+        'members': member_cache.stats(),
+        'conversations': conversation_cache.stats(),
+        'search': search_cache.stats(),
+    }
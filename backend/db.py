@@ -1,6 +1,276 @@
 import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 from psycopg2.extras import RealDictCursor
+import metrics
+
+POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800))
+POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', 300))
+# Idle connections older than this are pinged with SELECT 1 before being handed out.
+POOL_HEALTH_CHECK_AFTER = float(os.environ.get('DB_POOL_HEALTH_CHECK_AFTER', 30))
+
+
+class PoolError(Exception):
+    pass
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
+def _use_green_wait_callback():
+    # Under the eventlet worker, psycopg2 would otherwise block the whole hub
+    # while waiting on the server. wait_select cooperates with patched select().
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return
+    if patcher.is_monkey_patched('select'):
+        psycopg2.extensions.set_wait_callback(psycopg2.extras.wait_select)
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    # Default cursor of pooled connections: reports every statement to
+    # metrics, which is what makes per-request query counts possible.
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.observe_query(query, time.perf_counter() - started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            metrics.observe_query(query, time.perf_counter() - started)
+
+
+class _PooledConnection:
+    __slots__ = ('conn', 'created_at', 'last_used_at')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+
+
+class ConnectionPool:
+    def __init__(self, dsn, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, timeout=POOL_TIMEOUT,
+                 max_lifetime=POOL_MAX_LIFETIME, max_idle=POOL_MAX_IDLE,
+                 health_check_after=POOL_HEALTH_CHECK_AFTER, **connect_kwargs):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.health_check_after = health_check_after
+        self.connect_kwargs = connect_kwargs
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle = deque()
+        self._in_use = {}
+        self._size = 0
+        self._waiters = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._recycled = 0
+        self._failed_health_checks = 0
+        self._checkout_time_total = 0.0
+        self._checkout_time_max = 0.0
+
+    def _connect(self):
+        try:
+            conn = psycopg2.connect(self.dsn, **self.connect_kwargs)
+        except psycopg2.Error as e:
+            raise PoolError(f"Error connecting to database: {e}") from e
+        return _PooledConnection(conn)
+
+    def _discard(self, entry):
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+
+    def _is_expired(self, entry, now):
+        if entry.conn.closed:
+            return True
+        if self.max_lifetime and now - entry.created_at > self.max_lifetime:
+            return True
+        if self.max_idle and now - entry.last_used_at > self.max_idle and self._size > self.min_size:
+            return True
+        return False
+
+    def _is_healthy(self, entry, now):
+        if now - entry.last_used_at < self.health_check_after:
+            return True
+        try:
+            with entry.conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            entry.conn.rollback()
+            return True
+        except psycopg2.Error:
+            self._failed_health_checks += 1
+            return False
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+
+        while True:
+            entry = None
+            with self._lock:
+                if self._closed:
+                    raise PoolError("Connection pool is closed")
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(f"Timed out after {self.timeout}s waiting for a database connection")
+                    self._waiters += 1
+                    try:
+                        self._available.wait(remaining)
+                    finally:
+                        self._waiters -= 1
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    # Reserve the slot before connecting so we never exceed max_size.
+                    self._size += 1
+
+            if entry is None:
+                try:
+                    entry = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._size -= 1
+                        self._available.notify()
+                    raise
+            else:
+                now = time.monotonic()
+                if self._is_expired(entry, now) or not self._is_healthy(entry, now):
+                    self._recycled += 1
+                    self._discard(entry)
+                    with self._lock:
+                        self._size -= 1
+                        self._available.notify()
+                    continue
+
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._in_use[id(entry.conn)] = entry
+                self._checkouts += 1
+                self._checkout_time_total += elapsed
+                self._checkout_time_max = max(self._checkout_time_max, elapsed)
+            metrics.observe_pool_acquire(elapsed)
+            return entry.conn
+
+    def putconn(self, conn, close=False):
+        with self._lock:
+            entry = self._in_use.pop(id(conn), None)
+        if entry is None:
+            raise PoolError("Connection does not belong to this pool")
+
+        if not conn.closed and not close:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+
+        now = time.monotonic()
+        entry.last_used_at = now
+        with self._lock:
+            if close or self._closed or conn.closed or (
+                    self.max_lifetime and now - entry.created_at > self.max_lifetime):
+                self._size -= 1
+                if not conn.closed:
+                    self._recycled += 1
+                discard = True
+            else:
+                self._idle.append(entry)
+                discard = False
+            self._available.notify()
+        if discard:
+            self._discard(entry)
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        except Exception:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass
+            raise
+        finally:
+            self.putconn(conn)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._available.notify_all()
+        for entry in idle:
+            self._discard(entry)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self._size,
+                'maxSize': self.max_size,
+                'inUse': len(self._in_use),
+                'idle': len(self._idle),
+                'waiters': self._waiters,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'recycled': self._recycled,
+                'failedHealthChecks': self._failed_health_checks,
+                'checkoutTimeAvgMs': round(self._checkout_time_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                'checkoutTimeMaxMs': round(self._checkout_time_max * 1000, 3),
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _use_green_wait_callback()
+                _pool = ConnectionPool(os.environ.get('DATABASE_URL'), client_encoding='UTF8',
+                                       cursor_factory=TimedCursor)
+    return _pool
+
+
+def connection():
+    return get_pool().connection()
+
+
+def pool_stats():
+    return get_pool().stats()
+
 
 def get_db_connection():
     try:
@@ -11,64 +281,12 @@ def get_db_connection():
         return None
 
 def init_db():
-    conn = get_db_connection()
-    if not conn:
-        print("Failed to connect to DB during initialization.")
-        return
-
-    try:
-        cur = conn.cursor()
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                uid VARCHAR(255) UNIQUE NOT NULL, -- To keep compatibility or just use UUID
-                email VARCHAR(255) UNIQUE NOT NULL,
-                password_hash VARCHAR(255) NOT NULL,
-                display_name VARCHAR(255),
-                photo_url TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS conversations (
-                id SERIAL PRIMARY KEY,
-                last_message TEXT,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS conversation_participants (
-                conversation_id INTEGER REFERENCES conversations(id) ON DELETE CASCADE,
-                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                PRIMARY KEY (conversation_id, user_id)
-            );
-        """)
-
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id SERIAL PRIMARY KEY,
-                conversation_id INTEGER REFERENCES conversations(id) ON DELETE CASCADE,
-                sender_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                content TEXT,
-                type VARCHAR(50) DEFAULT 'text', -- text, image, etc.
-                reply_to INTEGER DEFAULT NULL,
-                reactions JSONB DEFAULT '{}'::jsonb,
-                file_meta JSONB DEFAULT NULL,
-                is_deleted BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-
-        conn.commit()
-        cur.close()
-        conn.close()
+    # The schema lives in migrations.py; this stays as the entry point app.py uses.
+    from migrations import migrate
+    if migrate():
         print("Database initialized successfully.")
-    except Exception as e:
-        print(f"Error initializing database: {e}")
+    else:
+        print("Failed to initialize database.")
 
 if __name__ == "__main__":
     init_db()
\ No newline at end of file
@@ -1,4 +1,6 @@
 from flask_socketio import SocketIO
+from fanout import make_client_manager
+import metrics
 
 import os
 default_origins = [
@@ -7,4 +9,20 @@ default_origins = [
     'http://localhost:3000'
 ]
 allowed_origins = os.environ.get('ALLOWED_ORIGINS', '').split(',') if os.environ.get('ALLOWED_ORIGINS') else default_origins
-socketio = SocketIO(cors_allowed_origins=allowed_origins)
\ No newline at end of file
+
+
+class InstrumentedSocketIO(SocketIO):
+    # Counts emits per event and how many of this worker's sockets each one
+    # addressed; flask_socketio.emit() inside handlers ends up here too.
+    def emit(self, event, *args, **kwargs):
+        to = kwargs.get('to') or kwargs.get('room')
+        recipients = 0
+        if self.server is not None and to is not None:
+            namespace = kwargs.get('namespace') or '/'
+            recipients = len(self.server.manager.rooms.get(namespace, {}).get(to, ()))
+        metrics.observe_emit(event, recipients)
+        return super().emit(event, *args, **kwargs)
+
+
+# With a message queue configured, emits from any worker reach sockets on every worker.
+socketio = InstrumentedSocketIO(cors_allowed_origins=allowed_origins, client_manager=make_client_manager())
\ No newline at end of file
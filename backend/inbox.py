@@ -0,0 +1,167 @@
+import os
+from psycopg2.extras import execute_values, Json
+
+# Per-user inbox projection. inbox_entries holds one row per (user,
+# conversation) with everything the conversation list shows, updated in the
+# same transaction as the write that changes it, so GET /conversations is a
+# range scan over idx_inbox_entries_user_sort instead of a join across
+# conversations, participants and users.
+#
+# sort_key is the id of the conversation's newest message and doubles as the
+# page cursor. Message ids are drawn while the conversation row is locked,
+# so a conversation's newer messages always carry higher ids; sort_key still
+# never moves backwards. Conversations without messages have a NULL sort_key
+# and are not listed.
+#
+# Rooms with more than INBOX_LARGE_ROOM_SIZE members are "live": their
+# entries keep only the per-user flags and are not touched when a message is
+# sent, so a send costs the same in a room of 10 000 as in a room of 10. The
+# inbox reads their preview from conversations and the unread count from the
+# member's read counter instead; new messages don't unarchive them. A room
+# stays live if it shrinks again.
+INBOX_PAGE_SIZE = int(os.environ.get('INBOX_PAGE_SIZE', 50))
+MAX_INBOX_PAGE_SIZE = 200
+LARGE_ROOM_SIZE = int(os.environ.get('INBOX_LARGE_ROOM_SIZE', 100))
+PREVIEW_LENGTH = 200
+
+INBOX_COLUMNS = ("e.conversation_id, e.sort_key, e.last_message_preview, e.last_message_type, e.last_sender_id, "
+                 "e.last_message_at, e.unread_count, e.muted, e.archived")
+LIVE_INBOX_COLUMNS = (f"c.id, c.last_message_id, left(c.last_message, {PREVIEW_LENGTH}), c.last_message_type, "
+                      "c.last_sender_id, c.updated_at, GREATEST(c.message_count - p.read_count, 0), e.muted, e.archived")
+
+
+def add_members(cur, conversation_id, user_ids):
+    # New members start from the conversation's current last message; call
+    # after conversations.member_count has been updated.
+    cur.execute(f"""
+        INSERT INTO inbox_entries (user_id, conversation_id, sort_key, last_message_preview, last_message_type,
+                                   last_sender_id, last_message_at, live)
+        SELECT u.id, c.id, c.last_message_id, left(c.last_message, {PREVIEW_LENGTH}), c.last_message_type,
+               c.last_sender_id, CASE WHEN c.last_message_id IS NOT NULL THEN c.updated_at END,
+               c.member_count > %s
+        FROM conversations c CROSS JOIN unnest(%s::integer[]) AS u(id)
+        WHERE c.id = %s
+        ON CONFLICT DO NOTHING
+    """, (LARGE_ROOM_SIZE, list(user_ids), conversation_id))
+    sync_live(cur, conversation_id)
+
+
+def sync_live(cur, conversation_id):
+    # Switches a room that grew past LARGE_ROOM_SIZE over; a no-op (and an
+    # empty index scan) for rooms that are already live or still small.
+    cur.execute("""
+        UPDATE inbox_entries e SET live = TRUE
+        FROM conversations c
+        WHERE c.id = %s AND c.member_count > %s AND e.conversation_id = c.id AND NOT e.live
+    """, (conversation_id, LARGE_ROOM_SIZE))
+
+
+def remove_members(cur, conversation_id, user_ids):
+    cur.execute("DELETE FROM inbox_entries WHERE conversation_id = %s AND user_id = ANY(%s)",
+                (conversation_id, list(user_ids)))
+
+
+def record_messages(cur, conversations):
+    # conversations: [(conversation_id, count, last message id, content, type,
+    # last sender id, {sender id: messages after that sender's last one})].
+    # Senders have read up to their own last message; everyone else gets
+    # count more unread. A new message from someone else brings an archived
+    # conversation back unless it is muted.
+    execute_values(cur, f"""
+        UPDATE inbox_entries e
+        SET sort_key = GREATEST(e.sort_key, v.message_id), last_message_preview = left(v.content, {PREVIEW_LENGTH}),
+            last_message_type = v.type, last_sender_id = v.sender_id, last_message_at = CURRENT_TIMESTAMP,
+            unread_count = COALESCE((v.senders ->> e.user_id::text)::integer, e.unread_count + v.n),
+            archived = e.archived AND (e.muted OR e.user_id = v.sender_id)
+        FROM (VALUES %s) AS v(conversation_id, n, message_id, content, type, sender_id, senders)
+        WHERE e.conversation_id = v.conversation_id AND NOT e.live
+    """, [(cid, n, message_id, content, msg_type, sender_id, Json({str(k): v for k, v in senders.items()}))
+          for cid, n, message_id, content, msg_type, sender_id, senders in sorted(conversations, key=lambda c: c[0])],
+        template="(%s, %s, %s, %s, %s, %s, %s::jsonb)")
+
+
+def message_removed(cur, conversation_id, message_id):
+    cur.execute("""
+        UPDATE inbox_entries SET last_message_preview = NULL, last_message_type = 'removed'
+        WHERE conversation_id = %s AND sort_key = %s AND NOT live
+    """, (conversation_id, message_id))
+    cur.execute("""
+        UPDATE conversations SET last_message = NULL, last_message_type = 'removed'
+        WHERE id = %s AND last_message_id = %s
+    """, (conversation_id, message_id))
+
+
+def mark_read(cur, conversation_ids, user_id):
+    cur.execute("UPDATE inbox_entries SET unread_count = 0 WHERE user_id = %s AND conversation_id = ANY(%s) AND unread_count <> 0",
+                (user_id, list(conversation_ids)))
+
+
+def set_flags(cur, user_id, conversation_id, muted=None, archived=None):
+    cur.execute("""
+        UPDATE inbox_entries SET muted = COALESCE(%s, muted), archived = COALESCE(%s, archived)
+        WHERE user_id = %s AND conversation_id = %s
+        RETURNING muted, archived
+    """, (muted, archived, user_id, conversation_id))
+    return cur.fetchone()
+
+
+def page(cur, user_id, archived=False, before=None, limit=None):
+    # The caller's small-room entries in index order, merged with their live
+    # rooms (few per user) read through conversations.
+    cur.execute(f"""
+        (SELECT {INBOX_COLUMNS}
+         FROM inbox_entries e
+         WHERE e.user_id = %(user_id)s AND e.archived = %(archived)s AND e.sort_key IS NOT NULL AND NOT e.live
+           AND (%(before)s::bigint IS NULL OR e.sort_key < %(before)s)
+         ORDER BY e.sort_key DESC
+         LIMIT %(limit)s)
+        UNION ALL
+        (SELECT {LIVE_INBOX_COLUMNS}
+         FROM inbox_entries e
+         JOIN conversations c ON c.id = e.conversation_id
+         JOIN conversation_participants p ON p.conversation_id = e.conversation_id AND p.user_id = e.user_id
+         WHERE e.user_id = %(user_id)s AND e.live AND e.archived = %(archived)s AND c.last_message_id IS NOT NULL
+           AND (%(before)s::bigint IS NULL OR c.last_message_id < %(before)s))
+        ORDER BY 2 DESC
+        LIMIT %(limit)s
+    """, {'user_id': user_id, 'archived': archived, 'before': before, 'limit': limit})
+    return cur.fetchall()
+
+
+def rebuild(cur, conversation_ids):
+    # Recomputes the entries of the given conversations, and the summary
+    # columns live rooms are read from, from messages and the read counters,
+    # keeping muted/archived; for repairs and for data loaded outside the API.
+    cur.execute("""
+        UPDATE conversations c
+        SET member_count = (SELECT COUNT(*) FROM conversation_participants p WHERE p.conversation_id = c.id),
+            last_message_id = l.id, last_sender_id = l.sender_id,
+            last_message_type = CASE WHEN l.is_deleted THEN 'removed' ELSE l.type END
+        FROM conversations c2
+        LEFT JOIN LATERAL (
+            SELECT m.id, m.sender_id, m.type, m.is_deleted
+            FROM messages m WHERE m.conversation_id = c2.id
+            ORDER BY m.id DESC LIMIT 1
+        ) l ON TRUE
+        WHERE c2.id = c.id AND c.id = ANY(%s)
+    """, (conversation_ids,))
+    cur.execute(f"""
+        INSERT INTO inbox_entries (user_id, conversation_id, sort_key, last_message_preview,
+                                   last_message_type, last_sender_id, last_message_at, unread_count, live)
+        SELECT p.user_id, p.conversation_id, l.id, CASE WHEN NOT l.is_deleted THEN left(l.content, {PREVIEW_LENGTH}) END,
+               CASE WHEN l.is_deleted THEN 'removed' ELSE l.type END, l.sender_id, l.created_at,
+               GREATEST(c.message_count - p.read_count, 0), c.member_count > %s
+        FROM conversation_participants p
+        JOIN conversations c ON c.id = p.conversation_id
+        LEFT JOIN LATERAL (
+            SELECT m.id, m.content, m.type, m.is_deleted, m.sender_id, m.created_at
+            FROM messages m WHERE m.conversation_id = p.conversation_id
+            ORDER BY m.id DESC LIMIT 1
+        ) l ON TRUE
+        WHERE p.conversation_id = ANY(%s)
+        ON CONFLICT (user_id, conversation_id) DO UPDATE
+        SET sort_key = EXCLUDED.sort_key, last_message_preview = EXCLUDED.last_message_preview,
+            last_message_type = EXCLUDED.last_message_type, last_sender_id = EXCLUDED.last_sender_id,
+            last_message_at = EXCLUDED.last_message_at, unread_count = EXCLUDED.unread_count,
+            live = inbox_entries.live OR EXCLUDED.live
+    """, (LARGE_ROOM_SIZE, conversation_ids))
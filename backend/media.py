@@ -0,0 +1,370 @@
+import os
+import re
+import math
+import time
+import queue
+import shutil
+import signal
+import tempfile
+import subprocess
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from psycopg2.extras import Json
+from extensions import socketio
+from db import connection
+from uploads import PARTIAL_FOLDER, CONTENT_HASH_NAME, blob_url, ensure_folders
+from storage import storage
+import metrics
+
+# Attachments are processed once per blob (content hash) in a process pool,
+# so image decoding never blocks the eventlet hub. The result is stored in
+# blobs.media and merged into messages.file_meta:
+#   {processed, mime, width, height, blurhash, thumbnails: {size: url}, duration, pages}
+MEDIA_PROCESSING = os.environ.get('MEDIA_PROCESSING', '1') == '1'
+MEDIA_WORKERS = int(os.environ.get('MEDIA_WORKERS', 2))
+MEDIA_THUMB_SIZES = [int(s) for s in os.environ.get('MEDIA_THUMB_SIZES', '160,480,1024').split(',')]
+MEDIA_TIMEOUT = float(os.environ.get('MEDIA_TIMEOUT', 120))
+MAX_IMAGE_PIXELS = int(os.environ.get('MEDIA_MAX_IMAGE_PIXELS', 80 * 1000 * 1000))
+# A 'processing' claim older than this belongs to a worker that died mid-job
+# (a live one gives up after MEDIA_TIMEOUT) and may be taken over.
+MEDIA_STALE_AFTER = 2 * MEDIA_TIMEOUT
+
+PDF_PAGE = re.compile(rb'/Type\s*/Page(?!s)')
+
+_lock = threading.Lock()
+_executor = None
+_worker_pids = None
+_listeners = []
+_started = False
+_stats = {'queued': 0, 'processed': 0, 'skipped': 0, 'failed': 0, 'timeTotalMs': 0.0}
+
+
+# --- runs in the worker processes -------------------------------------------
+
+def _register_worker(pids):
+    # Pool initializer: tells the web process which pid to kill if a job hangs.
+    pids.put(os.getpid())
+
+
+_B83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+
+def _b83(value, length):
+    return ''.join(_B83[(value // 83 ** (length - i - 1)) % 83] for i in range(length))
+
+
+def _to_linear(value):
+    v = value / 255
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+
+def _to_srgb(value):
+    v = max(0.0, min(1.0, value))
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    return int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def blurhash(pixels, width, height, x_components=4, y_components=3):
+    # pixels: width * height (r, g, b) tuples, row-major. Meant for a ~32px
+    # copy of the image; the hash only keeps a handful of cosine components.
+    linear = [(_to_linear(r), _to_linear(g), _to_linear(b)) for r, g, b in pixels]
+    factors = []
+    for j in range(y_components):
+        for i in range(x_components):
+            norm = 1 if i == 0 and j == 0 else 2
+            r = g = b = 0.0
+            for y in range(height):
+                cos_y = math.cos(math.pi * j * y / height)
+                row = y * width
+                for x in range(width):
+                    basis = norm * math.cos(math.pi * i * x / width) * cos_y
+                    pr, pg, pb = linear[row + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            scale = 1 / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = _b83((x_components - 1) + (y_components - 1) * 9, 1)
+    if ac:
+        actual_max = max(abs(v) for factor in ac for v in factor)
+        quantised_max = max(0, min(82, int(math.floor(actual_max * 166 - 0.5))))
+        max_value = (quantised_max + 1) / 166
+        result += _b83(quantised_max, 1)
+    else:
+        max_value = 1
+        result += _b83(0, 1)
+    result += _b83((_to_srgb(dc[0]) << 16) + (_to_srgb(dc[1]) << 8) + _to_srgb(dc[2]), 4)
+    for factor in ac:
+        q = [max(0, min(18, int(math.floor(math.copysign(abs(v / max_value) ** 0.5, v) * 9 + 9.5)))) for v in factor]
+        result += _b83(q[0] * 19 * 19 + q[1] * 19 + q[2], 2)
+    return result
+
+
+def _process_image(path, sha256, out_dir, sizes):
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    try:
+        image = Image.open(path)
+        image.load()
+    except Exception:
+        return None
+
+    mime = Image.MIME.get(image.format)
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    width, height = image.size
+    meta = {'mime': mime, 'width': width, 'height': height, 'thumbnails': {}}
+
+    for size in sorted(sizes):
+        if size >= max(width, height):
+            break
+        thumb = image.copy()
+        thumb.thumbnail((size, size))
+        name = f"{sha256}_{size}.webp"
+        thumb.save(os.path.join(out_dir, name), 'WEBP', quality=80, method=4)
+        meta['thumbnails'][str(size)] = blob_url(name)
+
+    small = image.convert('RGB')
+    small.thumbnail((32, 32))
+    data = small.tobytes()
+    pixels = [tuple(data[i:i + 3]) for i in range(0, len(data), 3)]
+    meta['blurhash'] = blurhash(pixels, small.size[0], small.size[1])
+    return meta
+
+
+def _probe_duration(path):
+    if not shutil.which('ffprobe'):
+        return None
+    try:
+        out = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path],
+            capture_output=True, text=True, timeout=30
+        ).stdout.strip()
+        return round(float(out), 3) if out else None
+    except (subprocess.SubprocessError, ValueError):
+        return None
+
+
+def inspect_file(path, sha256, out_dir, sizes):
+    with open(path, 'rb') as f:
+        head = f.read(8)
+
+    if head.startswith(b'%PDF'):
+        with open(path, 'rb') as f:
+            pages = len(PDF_PAGE.findall(f.read()))
+        return {'processed': True, 'mime': 'application/pdf', 'pages': pages or None}
+
+    meta = _process_image(path, sha256, out_dir, sizes)
+    if meta is not None:
+        meta['processed'] = True
+        return meta
+
+    duration = _probe_duration(path)
+    if duration is not None:
+        return {'processed': True, 'duration': duration}
+    return {'processed': True}
+
+
+def process_file(name, sha256, sizes):
+    # Fetching the blob and publishing thumbnails happen here too, so slow
+    # storage I/O never runs on the web process. The scratch directory sits
+    # next to the upload staging area so local publishing is a rename.
+    ensure_folders()
+    with storage.local_copy(name) as path, tempfile.TemporaryDirectory(dir=PARTIAL_FOLDER) as out_dir:
+        meta = inspect_file(path, sha256, out_dir, sizes)
+        for thumb in os.listdir(out_dir):
+            storage.put_file(os.path.join(out_dir, thumb), thumb, 'image/webp')
+    return meta
+
+
+# --- runs in the web process ------------------------------------------------
+
+def on_ready(fn):
+    # fn(url, media) is called after a blob's metadata has been stored.
+    _listeners.append(fn)
+    return fn
+
+
+def _get_executor():
+    global _executor, _worker_pids
+    with _lock:
+        if _executor is None:
+            _worker_pids = multiprocessing.Queue()
+            _executor = ProcessPoolExecutor(max_workers=MEDIA_WORKERS, initializer=_register_worker,
+                                            initargs=(_worker_pids,))
+        return _executor, _worker_pids
+
+
+def _reset_executor(executor, pids):
+    # A task that is already running can't be cancelled, so a stuck decode
+    # is stopped by killing its pool; the next job starts a fresh one. Jobs
+    # that were running next to it fail with BrokenProcessPool and are
+    # retried once by _run.
+    global _executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    while True:
+        try:
+            pid = pids.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _run(name, sha256, started):
+    for attempt in (1, 2):
+        executor, pids = _get_executor()
+        try:
+            future = executor.submit(process_file, name, sha256, MEDIA_THUMB_SIZES)
+        except RuntimeError:
+            # Shut down by _reset_executor since we picked it up.
+            continue
+        # Poll instead of blocking on result(), which would stall every greenlet.
+        while not future.done() and time.perf_counter() - started < MEDIA_TIMEOUT:
+            socketio.sleep(0.05)
+        if not future.done():
+            _reset_executor(executor, pids)
+            raise TimeoutError(f"no result after {MEDIA_TIMEOUT}s")
+        try:
+            return future.result(timeout=0)
+        except BrokenProcessPool:
+            if attempt == 2:
+                raise
+    raise RuntimeError("media pool unavailable")
+
+
+def sha256_from_url(url):
+    if not url or not isinstance(url, str):
+        return None
+    match = CONTENT_HASH_NAME.match(url.rsplit('/', 1)[-1])
+    return match.group(1) if match else None
+
+
+def schedule(url):
+    sha256 = sha256_from_url(url)
+    if not MEDIA_PROCESSING or not sha256:
+        return
+    socketio.start_background_task(_process, sha256, url)
+
+
+def start():
+    # Blobs a dead worker left at 'processing' would never be picked up
+    # again; a starting worker schedules the ones whose claim is stale.
+    global _started
+    with _lock:
+        if _started or not MEDIA_PROCESSING:
+            return
+        _started = True
+    socketio.start_background_task(requeue_stale)
+
+
+def requeue_stale():
+    try:
+        with connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT name FROM blobs
+                WHERE media_status = 'processing' AND media_started_at < LOCALTIMESTAMP - make_interval(secs => %s)
+            """, (MEDIA_STALE_AFTER,))
+            names = [row[0] for row in cur.fetchall()]
+    except Exception as e:
+        metrics.log(f"Requeueing stale media jobs failed: {e}")
+        return
+    if names:
+        metrics.log(f"Requeueing {len(names)} stale media job(s)")
+    # blob_url(name) is also what messages carry as content, which is how
+    # attach_media_to_messages finds them once the job is done.
+    for name in names:
+        schedule(blob_url(name))
+
+
+def _process(sha256, url):
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE blobs SET media_status = 'processing', media_started_at = LOCALTIMESTAMP
+            WHERE sha256 = %s AND (media_status IS NULL OR media_status = 'processing'
+                                   AND media_started_at < LOCALTIMESTAMP - make_interval(secs => %s))
+            RETURNING name
+        """, (sha256, MEDIA_STALE_AFTER))
+        row = cur.fetchone()
+        conn.commit()
+    if not row:
+        with _lock:
+            _stats['skipped'] += 1
+        return
+
+    with _lock:
+        _stats['queued'] += 1
+    started = time.perf_counter()
+    try:
+        meta = _run(row[0], sha256, started)
+        status = 'done'
+    except Exception as e:
+        metrics.log(f"Media processing failed for {sha256}: {e!r}")
+        meta = None
+        status = 'failed'
+
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("UPDATE blobs SET media = %s, media_status = %s WHERE sha256 = %s",
+                    (Json(meta) if meta else None, status, sha256))
+        conn.commit()
+
+    with _lock:
+        _stats['processed' if meta else 'failed'] += 1
+        _stats['timeTotalMs'] += (time.perf_counter() - started) * 1000
+    if meta:
+        for fn in _listeners:
+            try:
+                fn(url, meta)
+            except Exception as e:
+                metrics.log(f"Media listener failed for {sha256}: {e}")
+
+
+def attach(cur, url, file_meta):
+    # Messages sent after processing finished get the metadata right away.
+    sha256 = sha256_from_url(url)
+    if not sha256 or not isinstance(file_meta, dict):
+        return file_meta
+    cur.execute("SELECT media FROM blobs WHERE sha256 = %s AND media_status = 'done'", (sha256,))
+    row = cur.fetchone()
+    if row and row[0]:
+        return {**file_meta, **row[0]}
+    return file_meta
+
+
+def attach_many(cur, files):
+    # attach() for several (url, file_meta) pairs with one blobs lookup.
+    hashes = {url: sha256_from_url(url) for url, file_meta in files if isinstance(file_meta, dict)}
+    wanted = list({sha256 for sha256 in hashes.values() if sha256})
+    media = {}
+    if wanted:
+        cur.execute("SELECT sha256, media FROM blobs WHERE sha256 = ANY(%s) AND media_status = 'done'", (wanted,))
+        media = {sha256: meta for sha256, meta in cur.fetchall() if meta}
+    return [{**file_meta, **media[hashes[url]]} if hashes.get(url) in media else file_meta
+            for url, file_meta in files]
+
+
+def stats():
+    with _lock:
+        done = _stats['processed'] + _stats['failed']
+        return {
+            'enabled': MEDIA_PROCESSING,
+            'queued': _stats['queued'],
+            'processed': _stats['processed'],
+            'skipped': _stats['skipped'],
+            'failed': _stats['failed'],
+            'timeAvgMs': round(_stats['timeTotalMs'] / done, 1) if done else 0.0,
+        }
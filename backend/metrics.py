@@ -0,0 +1,319 @@
+import os
+import re
+import json
+import time
+import uuid
+import bisect
+import threading
+from functools import wraps
+from flask import g, request, has_app_context, Response
+
+# Request-level instrumentation. Every HTTP request and Socket.IO event gets a
+# trace id and a tally of the queries it ran, how long they took and how long
+# it waited for a pooled connection. Aggregates are served at /metrics in the
+# Prometheus text format; LOG_FORMAT=json also writes one line per request.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+# When set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>".
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+TRACE_ID = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in self._values.items()]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._values.items()]
+        out = []
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                out.append((f"{self.name}_bucket", labels + (('le', _format(bound)),), cumulative))
+            out.append((f"{self.name}_bucket", labels + (('le', '+Inf'),), count))
+            out.append((f"{self.name}_sum", labels, total))
+            out.append((f"{self.name}_count", labels, count))
+        return out
+
+
+_registry = []
+
+http_request_seconds = Histogram(
+    'connectnow_http_request_seconds', 'HTTP request latency', ('method', 'route', 'status'))
+http_request_db_queries = Histogram(
+    'connectnow_http_request_db_queries', 'Database queries per HTTP request', ('route',), COUNT_BUCKETS)
+http_request_db_seconds = Histogram(
+    'connectnow_http_request_db_seconds', 'Time spent in database queries per HTTP request', ('route',))
+socketio_event_seconds = Histogram(
+    'connectnow_socketio_event_seconds', 'Socket.IO event handler latency', ('event',))
+socketio_event_db_queries = Histogram(
+    'connectnow_socketio_event_db_queries', 'Database queries per Socket.IO event', ('event',), COUNT_BUCKETS)
+socketio_emits = Counter(
+    'connectnow_socketio_emits_total', 'Socket.IO events emitted by this worker', ('event',))
+socketio_emit_recipients = Counter(
+    'connectnow_socketio_emit_recipients_total', 'Sockets on this worker addressed by emits', ('event',))
+db_query_seconds = Histogram(
+    'connectnow_db_query_seconds', 'Database query latency', ('statement',))
+db_pool_acquire_seconds = Histogram(
+    'connectnow_db_pool_acquire_seconds', 'Time spent waiting for a pooled database connection')
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _snake(name):
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
+
+
+def _gauges(prefix, stats, out):
+    # Flattens the nested stats() dicts also shown on /health.
+    for key, value in stats.items():
+        name = f"{prefix}_{_snake(key)}"
+        if isinstance(value, dict):
+            _gauges(name, value, out)
+        elif isinstance(value, bool):
+            out.append((name, int(value)))
+        elif isinstance(value, (int, float)):
+            out.append((name, value))
+
+
+def render(stats=None):
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_labels(_label_pairs(metric, labels))} {_format(value)}")
+    gauges = []
+    _gauges('connectnow', stats or {}, gauges)
+    for name, value in gauges:
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {_format(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+def _label_pairs(metric, labels):
+    # Stored label tuples hold the values in labelnames order, optionally
+    # followed by an ('le', bound) pair added by Histogram.samples.
+    pairs = []
+    for i, item in enumerate(labels):
+        if isinstance(item, tuple):
+            pairs.append(item)
+        else:
+            pairs.append((metric.labelnames[i], item))
+    return pairs
+
+
+def metrics_response(stats=None):
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return Response('unauthorized\n', status=401, mimetype='text/plain')
+    return Response(render(stats), mimetype='text/plain; version=0.0.4')
+
+
+# --- per-request traces -----------------------------------------------------
+
+def _new_trace(trace_id=None):
+    return {
+        'id': trace_id if trace_id and TRACE_ID.match(trace_id) else uuid.uuid4().hex[:16],
+        'started': time.perf_counter(),
+        'queries': 0,
+        'dbSeconds': 0.0,
+        'poolWaitSeconds': 0.0,
+    }
+
+
+def current_trace():
+    if not has_app_context():
+        return None
+    return g.get('trace')
+
+
+def trace_id():
+    trace = current_trace()
+    return trace['id'] if trace else None
+
+
+def log(message, **fields):
+    # print() with the trace id attached; a JSON object per line when
+    # LOG_FORMAT=json.
+    trace = trace_id()
+    if LOG_FORMAT == 'json':
+        print(json.dumps({'ts': round(time.time(), 3), 'msg': message, 'traceId': trace, **fields}, default=str), flush=True)
+    elif trace:
+        print(f"[{trace}] {message}")
+    else:
+        print(message)
+
+
+def _statement(query):
+    if isinstance(query, bytes):
+        query = query[:32].decode('utf-8', 'replace')
+    else:
+        query = str(query)[:32]
+    words = query.split(None, 1)
+    return words[0].upper() if words else 'UNKNOWN'
+
+
+def observe_query(query, seconds):
+    if not METRICS_ENABLED:
+        return
+    db_query_seconds.observe(seconds, (_statement(query),))
+    trace = current_trace()
+    if trace is not None:
+        trace['queries'] += 1
+        trace['dbSeconds'] += seconds
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        text = query.decode('utf-8', 'replace') if isinstance(query, bytes) else str(query)
+        log('slow query', durationMs=round(seconds * 1000, 2), query=' '.join(text.split())[:500])
+
+
+def observe_pool_acquire(seconds):
+    if not METRICS_ENABLED:
+        return
+    db_pool_acquire_seconds.observe(seconds)
+    trace = current_trace()
+    if trace is not None:
+        trace['poolWaitSeconds'] += seconds
+
+
+def observe_emit(event, recipients):
+    if not METRICS_ENABLED:
+        return
+    socketio_emits.inc((event,))
+    if recipients:
+        socketio_emit_recipients.inc((event,), recipients)
+
+
+def _start_request():
+    g.trace = _new_trace(request.headers.get('X-Request-ID'))
+
+
+def _finish_request(response):
+    trace = g.pop('trace', None)
+    if trace is None:
+        return response
+    elapsed = time.perf_counter() - trace['started']
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    http_request_seconds.observe(elapsed, (request.method, route, str(response.status_code)))
+    http_request_db_queries.observe(trace['queries'], (route,))
+    http_request_db_seconds.observe(trace['dbSeconds'], (route,))
+
+    response.headers['X-Request-ID'] = trace['id']
+    # Shows up in the browser's network panel: where the time went.
+    response.headers['Server-Timing'] = (
+        f'db;dur={trace["dbSeconds"] * 1000:.2f};desc="{trace["queries"]} queries", '
+        f'pool;dur={trace["poolWaitSeconds"] * 1000:.2f}, '
+        f'app;dur={(elapsed - trace["dbSeconds"] - trace["poolWaitSeconds"]) * 1000:.2f}'
+    )
+    if LOG_FORMAT == 'json':
+        print(json.dumps({
+            'ts': round(time.time(), 3),
+            'msg': 'request',
+            'traceId': trace['id'],
+            'method': request.method,
+            'route': route,
+            'path': request.path,
+            'status': response.status_code,
+            'durationMs': round(elapsed * 1000, 2),
+            'dbQueries': trace['queries'],
+            'dbMs': round(trace['dbSeconds'] * 1000, 2),
+            'poolWaitMs': round(trace['poolWaitSeconds'] * 1000, 2),
+        }), flush=True)
+    return response
+
+
+def init_app(app):
+    if not METRICS_ENABLED:
+        return
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+
+def socket_event(event):
+    # Wraps a Socket.IO handler (under @socketio.on) with the same tracing
+    # HTTP requests get.
+    def decorator(fn):
+        if not METRICS_ENABLED:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            g.trace = trace = _new_trace()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                g.pop('trace', None)
+                elapsed = time.perf_counter() - trace['started']
+                socketio_event_seconds.observe(elapsed, (event,))
+                socketio_event_db_queries.observe(trace['queries'], (event,))
+                if LOG_FORMAT == 'json':
+                    print(json.dumps({
+                        'ts': round(time.time(), 3),
+                        'msg': 'socket event',
+                        'traceId': trace['id'],
+                        'event': event,
+                        'sid': request.sid,
+                        'durationMs': round(elapsed * 1000, 2),
+                        'dbQueries': trace['queries'],
+                        'dbMs': round(trace['dbSeconds'] * 1000, 2),
+                    }), flush=True)
+        return wrapper
+    return decorator
@@ -0,0 +1,621 @@
+import sys
+import json
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from db import get_db_connection
+from partitions import PARTITION_SIZE, PARTITIONS_AHEAD
+
+# Any fixed key works; it only has to be the same for every runner process.
+MIGRATION_LOCK_ID = 7_203_114
+
+
+class Migration:
+    def __init__(self, version, name, statements, transactional=True):
+        self.version = version
+        self.name = name
+        self.statements = statements
+        self.transactional = transactional
+
+
+class ConcurrentIndex:
+    # Built with CREATE INDEX CONCURRENTLY so writes to hot tables keep flowing.
+    # A failed concurrent build leaves an INVALID index behind, which is dropped
+    # and rebuilt on the next run.
+    def __init__(self, name, table, definition, unique=False):
+        self.name = name
+        self.table = table
+        self.definition = definition
+        self.unique = unique
+
+    def apply(self, cur):
+        cur.execute("""
+            SELECT i.indisvalid FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s AND pg_catalog.pg_table_is_visible(c.oid)
+        """, (self.name,))
+        row = cur.fetchone()
+        if row and row[0]:
+            return
+        if row:
+            print(f"  dropping invalid index {self.name}")
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {self.name}")
+        unique = "UNIQUE " if self.unique else ""
+        cur.execute(f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {self.name} ON {self.table} {self.definition}")
+
+
+MIGRATIONS = [
+    Migration(1, 'initial_schema', [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            uid VARCHAR(255) UNIQUE NOT NULL,
+            email VARCHAR(255) UNIQUE NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
+            display_name VARCHAR(255),
+            photo_url TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id SERIAL PRIMARY KEY,
+            last_message TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS conversation_participants (
+            conversation_id INTEGER REFERENCES conversations(id) ON DELETE CASCADE,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            PRIMARY KEY (conversation_id, user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL PRIMARY KEY,
+            conversation_id INTEGER REFERENCES conversations(id) ON DELETE CASCADE,
+            sender_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            content TEXT,
+            type VARCHAR(50) DEFAULT 'text',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    Migration(2, 'message_replies_reactions_files', [
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS reply_to INTEGER DEFAULT NULL",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS reactions JSONB DEFAULT '{}'::jsonb",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS is_deleted BOOLEAN DEFAULT FALSE",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS file_meta JSONB DEFAULT NULL",
+    ]),
+    Migration(3, 'conversation_change_seq', [
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS seq BIGINT NOT NULL DEFAULT 0",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS seq BIGINT",
+        # Existing rows predate change tracking; message ids are already monotonic per conversation.
+        "UPDATE messages SET seq = id WHERE seq IS NULL",
+        """
+        UPDATE conversations c SET seq = m.max_seq
+        FROM (SELECT conversation_id, MAX(seq) AS max_seq FROM messages GROUP BY conversation_id) m
+        WHERE m.conversation_id = c.id AND c.seq < m.max_seq
+        """,
+    ]),
+    Migration(4, 'hot_path_indexes', [
+        # Keyset pages and the full-history fetch in get_messages.
+        ConcurrentIndex('idx_messages_conversation_id', 'messages', '(conversation_id, id)'),
+        ConcurrentIndex('idx_messages_conversation_created', 'messages', '(conversation_id, created_at)'),
+        # ?since=<seq> delta sync.
+        ConcurrentIndex('idx_messages_conversation_seq', 'messages', '(conversation_id, seq)'),
+        # Inbox and membership lookups that lead on the user.
+        ConcurrentIndex('idx_participants_user', 'conversation_participants', '(user_id, conversation_id)'),
+        # ON DELETE CASCADE from users would otherwise scan messages.
+        ConcurrentIndex('idx_messages_sender', 'messages', '(sender_id)'),
+    ], transactional=False),
+    Migration(5, 'pg_trgm', [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    ]),
+    Migration(6, 'user_search_indexes', [
+        # Substring/similarity matching for queries of three or more characters.
+        ConcurrentIndex('idx_users_display_name_trgm', 'users', 'USING gin (lower(display_name) gin_trgm_ops)'),
+        ConcurrentIndex('idx_users_email_trgm', 'users', 'USING gin (lower(email) gin_trgm_ops)'),
+        # Shorter queries fall back to prefix matching, which a btree can serve.
+        ConcurrentIndex('idx_users_display_name_prefix', 'users', '(lower(display_name) text_pattern_ops)'),
+        ConcurrentIndex('idx_users_email_prefix', 'users', '(lower(email) text_pattern_ops)'),
+        # Empty query lists the newest users.
+        ConcurrentIndex('idx_users_created_at', 'users', '(created_at DESC, id DESC)'),
+    ], transactional=False),
+    Migration(7, 'upload_sessions_and_blobs', [
+        """
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 CHAR(64) PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            size BIGINT NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS uploads (
+            id VARCHAR(36) PRIMARY KEY,
+            owner_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            original_name VARCHAR(255),
+            size BIGINT NOT NULL,
+            received BIGINT NOT NULL DEFAULT 0,
+            expected_sha256 CHAR(64),
+            sha256 CHAR(64) REFERENCES blobs(sha256),
+            status VARCHAR(16) NOT NULL DEFAULT 'pending', -- pending, complete
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_uploads_owner_status ON uploads (owner_id, status, sha256)",
+        "CREATE INDEX IF NOT EXISTS idx_uploads_pending_created ON uploads (created_at) WHERE status = 'pending'",
+    ]),
+    Migration(8, 'read_cursors', [
+        # Unread = conversations.message_count - conversation_participants.read_count,
+        # so the inbox never has to count messages.
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS message_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE conversation_participants ADD COLUMN IF NOT EXISTS read_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE conversation_participants ADD COLUMN IF NOT EXISTS last_read_seq BIGINT NOT NULL DEFAULT 0",
+        "ALTER TABLE conversation_participants ADD COLUMN IF NOT EXISTS last_read_at TIMESTAMP",
+        """
+        UPDATE conversations c SET message_count = m.total
+        FROM (SELECT conversation_id, COUNT(*) AS total FROM messages GROUP BY conversation_id) m
+        WHERE m.conversation_id = c.id
+        """,
+        # History from before read tracking counts as read.
+        """
+        UPDATE conversation_participants p SET read_count = c.message_count, last_read_seq = c.seq
+        FROM conversations c
+        WHERE c.id = p.conversation_id
+        """,
+    ]),
+    Migration(9, 'blob_media_metadata', [
+        # Thumbnails, dimensions, blurhash etc. produced by media.py, once per blob.
+        "ALTER TABLE blobs ADD COLUMN IF NOT EXISTS media JSONB",
+        "ALTER TABLE blobs ADD COLUMN IF NOT EXISTS media_status VARCHAR(16)",  # processing, done, failed
+        # When processing was claimed, so a claim left by a dead worker can be retaken.
+        "ALTER TABLE blobs ADD COLUMN IF NOT EXISTS media_started_at TIMESTAMP",
+    ]),
+    Migration(10, 'attachment_message_index', [
+        # Finds the messages that link a blob once its metadata is ready. On a
+        # hash: content can outgrow a btree entry.
+        ConcurrentIndex('idx_messages_attachment_hash', 'messages', '(md5(content)) WHERE file_meta IS NOT NULL'),
+    ], transactional=False),
+    Migration(11, 'refresh_tokens', [
+        # Rotated on every use; replaced_by links a token to its successor.
+        """
+        CREATE TABLE IF NOT EXISTS refresh_tokens (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            token_hash CHAR(64) UNIQUE NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            revoked_at TIMESTAMP,
+            replaced_by INTEGER REFERENCES refresh_tokens(id) ON DELETE SET NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_refresh_tokens_user_active ON refresh_tokens (user_id) WHERE revoked_at IS NULL",
+    ]),
+    Migration(12, 'partition_messages', [
+        # Rebuilds messages as a table range-partitioned on id (see
+        # partitions.py) in one transaction; writes to messages block until
+        # the copy is done.
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP",
+        # When older messages were deleted is unknown; their retention starts now.
+        "UPDATE messages SET deleted_at = CURRENT_TIMESTAMP WHERE is_deleted AND deleted_at IS NULL",
+        "ALTER SEQUENCE messages_id_seq OWNED BY NONE",
+        "ALTER TABLE messages RENAME TO messages_unpartitioned",
+        "ALTER INDEX messages_pkey RENAME TO messages_unpartitioned_pkey",
+        "CREATE TABLE messages (LIKE messages_unpartitioned INCLUDING DEFAULTS, PRIMARY KEY (id)) PARTITION BY RANGE (id)",
+        f"""
+        DO $$
+        DECLARE
+            bound BIGINT := 0;
+            top BIGINT;
+        BEGIN
+            SELECT GREATEST(COALESCE(MAX(id), 0), (SELECT last_value FROM messages_id_seq)) INTO top
+            FROM messages_unpartitioned;
+            WHILE bound <= top + {PARTITION_SIZE} * {PARTITIONS_AHEAD} LOOP
+                EXECUTE format('CREATE TABLE messages_p%s PARTITION OF messages FOR VALUES FROM (%s) TO (%s)',
+                               bound, bound, bound + {PARTITION_SIZE});
+                bound := bound + {PARTITION_SIZE};
+            END LOOP;
+        END $$
+        """,
+        "INSERT INTO messages SELECT * FROM messages_unpartitioned",
+        "DROP TABLE messages_unpartitioned",
+        "ALTER SEQUENCE messages_id_seq OWNED BY messages.id",
+        "ALTER TABLE messages ADD FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE",
+        "ALTER TABLE messages ADD FOREIGN KEY (sender_id) REFERENCES users(id) ON DELETE CASCADE",
+        # The (conversation_id, created_at) index is gone: full history is now
+        # read in id order, which lets the scan walk partitions in order.
+        "CREATE INDEX idx_messages_conversation_id ON messages (conversation_id, id)",
+        "CREATE INDEX idx_messages_conversation_seq ON messages (conversation_id, seq)",
+        "CREATE INDEX idx_messages_sender ON messages (sender_id)",
+        "CREATE INDEX idx_messages_attachment_hash ON messages (md5(content)) WHERE file_meta IS NOT NULL",
+        # Deleted messages still waiting for partitions.purge_deleted; rows
+        # leave the index once purged, so it stays small.
+        "CREATE INDEX idx_messages_purge ON messages (deleted_at) WHERE is_deleted AND (content IS NOT NULL OR file_meta IS NOT NULL OR reactions <> '{}'::jsonb)",
+        """
+        CREATE TABLE IF NOT EXISTS archived_message_partitions (
+            name VARCHAR(63) PRIMARY KEY,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            size_before BIGINT,
+            size_after BIGINT,
+            tablespace VARCHAR(63)
+        )
+        """,
+    ]),
+    Migration(13, 'message_search', [
+        # See search.py. Adding a stored column rewrites every partition, so
+        # writes to messages block until this finishes; run it off-peak.
+        "CREATE EXTENSION IF NOT EXISTS btree_gin",
+        """
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+            CASE WHEN is_deleted IS NOT TRUE AND file_meta IS NULL
+                 THEN to_tsvector('simple'::regconfig, coalesce(content, ''))
+            END
+        ) STORED
+        """,
+        # Partitioned parent: no CONCURRENTLY, same as migration 12.
+        "CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING gin (conversation_id, search_vector)",
+    ]),
+    Migration(14, 'inbox_entries', [
+        # Per-user inbox projection, see inbox.py.
+        """
+        CREATE TABLE IF NOT EXISTS inbox_entries (
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            conversation_id INTEGER NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
+            sort_key BIGINT,
+            last_message_preview TEXT,
+            last_message_type VARCHAR(50),
+            last_sender_id INTEGER,
+            last_message_at TIMESTAMP,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            muted BOOLEAN NOT NULL DEFAULT FALSE,
+            archived BOOLEAN NOT NULL DEFAULT FALSE,
+            PRIMARY KEY (user_id, conversation_id)
+        )
+        """,
+        """
+        INSERT INTO inbox_entries (user_id, conversation_id, sort_key, last_message_preview,
+                                   last_message_type, last_sender_id, last_message_at, unread_count)
+        SELECT p.user_id, p.conversation_id, l.id, CASE WHEN NOT l.is_deleted THEN left(l.content, 200) END,
+               CASE WHEN l.is_deleted THEN 'removed' ELSE l.type END, l.sender_id, l.created_at,
+               GREATEST(c.message_count - p.read_count, 0)
+        FROM conversation_participants p
+        JOIN conversations c ON c.id = p.conversation_id
+        LEFT JOIN LATERAL (
+            SELECT m.id, m.content, m.type, m.is_deleted, m.sender_id, m.created_at
+            FROM messages m WHERE m.conversation_id = p.conversation_id
+            ORDER BY m.id DESC LIMIT 1
+        ) l ON TRUE
+        ON CONFLICT DO NOTHING
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_inbox_entries_user_sort ON inbox_entries (user_id, archived, sort_key DESC) WHERE sort_key IS NOT NULL",
+        # Writes update every entry of a conversation.
+        "CREATE INDEX IF NOT EXISTS idx_inbox_entries_conversation ON inbox_entries (conversation_id)",
+    ]),
+    Migration(15, 'group_conversations', [
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS kind VARCHAR(16) NOT NULL DEFAULT 'direct'",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS name VARCHAR(255)",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS created_by INTEGER REFERENCES users(id) ON DELETE SET NULL",
+        # '<lower user id>:<higher user id>' for direct chats, NULL for groups.
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS direct_key VARCHAR(64)",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS member_count INTEGER NOT NULL DEFAULT 0",
+        # What the inbox shows for large rooms, whose inbox_entries are not
+        # updated per message (see inbox.py).
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS last_message_id BIGINT",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS last_sender_id INTEGER",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS last_message_type VARCHAR(50)",
+        "ALTER TABLE conversation_participants ADD COLUMN IF NOT EXISTS role VARCHAR(16) NOT NULL DEFAULT 'member'",
+        "ALTER TABLE conversation_participants ADD COLUMN IF NOT EXISTS joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
+        "ALTER TABLE inbox_entries ADD COLUMN IF NOT EXISTS live BOOLEAN NOT NULL DEFAULT FALSE",
+        """
+        UPDATE conversations c SET member_count = p.total
+        FROM (SELECT conversation_id, COUNT(*) AS total FROM conversation_participants GROUP BY conversation_id) p
+        WHERE p.conversation_id = c.id
+        """,
+        """
+        UPDATE conversations c SET last_message_id = l.id, last_sender_id = l.sender_id,
+            last_message_type = CASE WHEN l.is_deleted THEN 'removed' ELSE l.type END
+        FROM (
+            SELECT DISTINCT ON (conversation_id) conversation_id, id, sender_id, type, is_deleted
+            FROM messages ORDER BY conversation_id, id DESC
+        ) l
+        WHERE l.conversation_id = c.id
+        """,
+        # Every conversation so far was a 1-on-1. If a pair ended up with
+        # several, the oldest one keeps the key and is the one reused.
+        """
+        UPDATE conversations c SET direct_key = k.direct_key
+        FROM (
+            SELECT DISTINCT ON (direct_key) conversation_id, direct_key FROM (
+                SELECT conversation_id, MIN(user_id) || ':' || MAX(user_id) AS direct_key
+                FROM conversation_participants GROUP BY conversation_id HAVING COUNT(*) = 2
+            ) pairs
+            ORDER BY direct_key, conversation_id
+        ) k
+        WHERE k.conversation_id = c.id AND c.direct_key IS NULL
+        """,
+    ]),
+    Migration(16, 'group_conversation_indexes', [
+        # O(1) lookup of an existing direct chat; also what makes two
+        # concurrent "start chat" requests agree on one conversation.
+        ConcurrentIndex('idx_conversations_direct_key', 'conversations', '(direct_key)', unique=True),
+        # Per-message inbox updates only touch entries of small rooms...
+        ConcurrentIndex('idx_inbox_entries_conversation_fanout', 'inbox_entries', '(conversation_id) WHERE NOT live'),
+        # ...and inbox reads pick up the caller's large rooms separately.
+        ConcurrentIndex('idx_inbox_entries_user_live', 'inbox_entries', '(user_id) WHERE live'),
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_inbox_entries_conversation",
+    ], transactional=False),
+]
+
+# Representative forms of the queries on hot request paths. check_plans() fails
+# if any of them would need a sequential scan over one of HOT_TABLES.
+HOT_TABLES = {'messages', 'conversation_participants', 'conversations', 'users', 'inbox_entries'}
+
+HOT_QUERIES = {
+    'membership': (
+        "SELECT 1 FROM conversation_participants WHERE conversation_id = %s AND user_id = %s",
+        (1, 1),
+    ),
+    'inbox': (
+        """
+        SELECT conversation_id, sort_key, unread_count FROM inbox_entries
+        WHERE user_id = %s AND archived = %s AND sort_key IS NOT NULL AND NOT live AND sort_key < %s
+        ORDER BY sort_key DESC LIMIT 51
+        """,
+        (1, False, 1000),
+    ),
+    'inbox_details': (
+        """
+        SELECT c.id, c.kind, me.last_read_seq,
+               CASE WHEN c.kind = 'direct' THEN ARRAY(
+                   SELECT p.user_id FROM conversation_participants p WHERE p.conversation_id = c.id
+               ) END
+        FROM conversations c
+        JOIN conversation_participants me ON me.conversation_id = c.id AND me.user_id = %s
+        WHERE c.id = ANY(%s)
+        """,
+        (1, [1, 2, 3]),
+    ),
+    'inbox_live': (
+        """
+        SELECT c.id, c.last_message_id FROM inbox_entries e
+        JOIN conversations c ON c.id = e.conversation_id
+        JOIN conversation_participants p ON p.conversation_id = e.conversation_id AND p.user_id = e.user_id
+        WHERE e.user_id = %s AND e.live AND e.archived = %s AND c.last_message_id IS NOT NULL
+        """,
+        (1, False),
+    ),
+    'direct_conversation': (
+        "SELECT id FROM conversations WHERE direct_key = %s",
+        ('1:2',),
+    ),
+    'member_role': (
+        "SELECT role FROM conversation_participants WHERE conversation_id = %s AND user_id = %s",
+        (1, 1),
+    ),
+    'messages_latest_page': (
+        """
+        SELECT m.id, u.uid FROM messages m JOIN users u ON m.sender_id = u.id
+        WHERE m.conversation_id = %s AND m.id < %s
+        ORDER BY m.id DESC LIMIT 51
+        """,
+        (1, 1000),
+    ),
+    'messages_full_history': (
+        """
+        SELECT m.id, u.uid FROM messages m JOIN users u ON m.sender_id = u.id
+        WHERE m.conversation_id = %s
+        ORDER BY m.id ASC
+        """,
+        (1,),
+    ),
+    'user_search': (
+        """
+        SELECT uid FROM users
+        WHERE lower(display_name) LIKE %s OR lower(email) LIKE %s
+        LIMIT 21
+        """,
+        ('%ali%', '%ali%'),
+    ),
+    'user_search_prefix': (
+        """
+        SELECT uid FROM users
+        WHERE lower(display_name) LIKE %s OR lower(email) LIKE %s
+        LIMIT 21
+        """,
+        ('al%', 'al%'),
+    ),
+    'messages_by_attachment': (
+        "SELECT id, conversation_id FROM messages WHERE md5(content) = md5(%s) AND content = %s AND file_meta IS NOT NULL",
+        ('/uploads/x', '/uploads/x'),
+    ),
+    'purge_deleted': (
+        """
+        SELECT id FROM messages
+        WHERE is_deleted AND deleted_at < %s
+          AND (content IS NOT NULL OR file_meta IS NOT NULL OR reactions <> '{}'::jsonb)
+        LIMIT 5000
+        """,
+        ('2000-01-01',),
+    ),
+    'message_by_id': (
+        "SELECT sender_id, conversation_id FROM messages WHERE id = %s",
+        (1,),
+    ),
+    'messages_since': (
+        """
+        SELECT m.id, u.uid FROM messages m JOIN users u ON m.sender_id = u.id
+        WHERE m.conversation_id = %s AND m.seq > %s
+        ORDER BY m.seq ASC LIMIT 51
+        """,
+        (1, 0),
+    ),
+    'message_search': (
+        """
+        SELECT m.id FROM messages m
+        WHERE m.conversation_id = ANY(%s) AND m.search_vector @@ %s::tsquery
+          AND m.id >= %s AND m.id < %s
+        ORDER BY m.id DESC LIMIT 21
+        """,
+        ([1, 2, 3], 'hello', 0, 1000),
+    ),
+}
+
+
+def _ensure_version_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def applied_versions(cur):
+    cur.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cur.fetchall()}
+
+
+def _apply(conn, migration):
+    cur = conn.cursor()
+    if migration.transactional:
+        conn.autocommit = False
+        try:
+            for statement in migration.statements:
+                cur.execute(statement)
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (migration.version, migration.name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.autocommit = True
+    else:
+        # CONCURRENTLY cannot run inside a transaction block; every statement
+        # here must be safe to re-run if the migration is interrupted.
+        for statement in migration.statements:
+            if isinstance(statement, ConcurrentIndex):
+                statement.apply(cur)
+            else:
+                cur.execute(statement)
+        cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (migration.version, migration.name))
+    cur.close()
+
+
+def migrate(target=None):
+    conn = get_db_connection()
+    if not conn:
+        print("Failed to connect to DB.")
+        return False
+
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        # Several workers may start at once; only one of them runs migrations.
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        _ensure_version_table(cur)
+        done = applied_versions(cur)
+        pending = [m for m in MIGRATIONS if m.version not in done and (target is None or m.version <= target)]
+        for migration in pending:
+            print(f"Applying migration {migration.version:04d} {migration.name}...")
+            _apply(conn, migration)
+        if pending:
+            print(f"Applied {len(pending)} migration(s).")
+        else:
+            print("Database schema is up to date.")
+        return True
+    except Exception as e:
+        print(f"Error running migrations: {e}")
+        return False
+    finally:
+        try:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        except psycopg2.Error:
+            pass
+        cur.close()
+        conn.close()
+
+
+def status():
+    conn = get_db_connection()
+    if not conn:
+        print("Failed to connect to DB.")
+        return False
+    try:
+        cur = conn.cursor()
+        _ensure_version_table(cur)
+        conn.commit()
+        done = applied_versions(cur)
+        for migration in MIGRATIONS:
+            state = 'applied' if migration.version in done else 'pending'
+            print(f"{migration.version:04d} {migration.name:<40} {state}")
+        cur.close()
+        return True
+    finally:
+        conn.close()
+
+
+def _seq_scans(plan, parents):
+    # Scans of a partition count as scans of its parent table.
+    scans = []
+    relation = parents.get(plan.get('Relation Name'), plan.get('Relation Name'))
+    if plan.get('Node Type') == 'Seq Scan' and relation in HOT_TABLES:
+        scans.append(relation)
+    for child in plan.get('Plans', []):
+        scans.extend(_seq_scans(child, parents))
+    return scans
+
+
+def check_plans():
+    conn = get_db_connection()
+    if not conn:
+        print("Failed to connect to DB.")
+        return False
+
+    failures = []
+    try:
+        cur = conn.cursor()
+        # With seq scans priced out, the planner only still picks one when no
+        # index can serve the query, so small test tables don't cause false alarms.
+        cur.execute("SET LOCAL enable_seqscan = off")
+        cur.execute("""
+            SELECT c.relname, p.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+        """)
+        parents = dict(cur.fetchall())
+        for name, (query, params) in HOT_QUERIES.items():
+            cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+            plan = cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            scans = _seq_scans(plan[0]['Plan'], parents)
+            if scans:
+                failures.append(name)
+                print(f"FAIL {name}: sequential scan on {', '.join(sorted(set(scans)))}")
+            else:
+                print(f"ok   {name}")
+        conn.rollback()
+    finally:
+        conn.close()
+    return not failures
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else 'migrate'
+    if command == 'migrate':
+        ok = migrate(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    elif command == 'status':
+        ok = status()
+    elif command == 'check':
+        ok = check_plans()
+    else:
+        sys.exit("Usage: python migrations.py [migrate [version] | status | check]")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,225 @@
+import os
+import re
+import sys
+import time
+from extensions import socketio
+from db import connection
+import metrics
+
+# messages is range-partitioned on id in blocks of MESSAGE_PARTITION_SIZE ids.
+# Ids come from one sequence, so every partition is also a slice of time, and
+# every lookup the API makes (by id, or keyset pages on id) prunes to the
+# partitions that can hold the rows. Partitions are created
+# MESSAGE_PARTITIONS_AHEAD blocks before the sequence reaches them.
+#
+# python partitions.py maintain (from cron; web workers only do the first
+# step, hourly):
+#   - creates partitions ahead of the id sequence
+#   - clears content, attachments and reactions of messages deleted more
+#     than DELETED_MESSAGE_RETENTION_DAYS ago
+#   - compacts partitions whose newest message is older than
+#     MESSAGE_ARCHIVE_AFTER_DAYS: rewritten in conversation order with
+#     CLUSTER, and moved to MESSAGE_ARCHIVE_TABLESPACE if one is set
+PARTITION_SIZE = int(os.environ.get('MESSAGE_PARTITION_SIZE', 5000000))
+PARTITIONS_AHEAD = int(os.environ.get('MESSAGE_PARTITIONS_AHEAD', 2))
+ARCHIVE_AFTER_DAYS = int(os.environ.get('MESSAGE_ARCHIVE_AFTER_DAYS', 180))
+ARCHIVE_TABLESPACE = os.environ.get('MESSAGE_ARCHIVE_TABLESPACE')
+DELETED_RETENTION_DAYS = int(os.environ.get('DELETED_MESSAGE_RETENTION_DAYS', 30))
+PURGE_BATCH_SIZE = int(os.environ.get('MESSAGE_PURGE_BATCH_SIZE', 5000))
+MAINTENANCE_INTERVAL = float(os.environ.get('MESSAGE_PARTITION_CHECK_INTERVAL', 3600))
+
+PARTITION_LOCK_ID = 0x636e6d70  # 'cnmp'
+BOUND = re.compile(r"FROM \('?(-?\d+)'?\) TO \('?(-?\d+)'?\)")
+
+_started = False
+
+
+def partitions(cur):
+    # [(name, lower, upper, tablespace)] ordered by lower bound.
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), t.spcname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace
+        WHERE i.inhparent = 'messages'::regclass
+    """)
+    out = []
+    for name, bound, tablespace in cur.fetchall():
+        match = BOUND.search(bound or '')
+        if match:
+            out.append((name, int(match.group(1)), int(match.group(2)), tablespace))
+    return sorted(out, key=lambda p: p[1])
+
+
+def ensure_partitions(cur):
+    # Returns the names of the partitions it created. Several workers may run
+    # this at once; the advisory lock makes the others skip.
+    cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (PARTITION_LOCK_ID,))
+    if not cur.fetchone()[0]:
+        return []
+    cur.execute("SELECT last_value FROM messages_id_seq")
+    last_id = cur.fetchone()[0]
+    existing = partitions(cur)
+    upper = existing[-1][2] if existing else 0
+    target = last_id + PARTITION_SIZE * PARTITIONS_AHEAD
+    created = []
+    while upper <= target:
+        name = f"messages_p{upper}"
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages FOR VALUES FROM ({upper}) TO ({upper + PARTITION_SIZE})")
+        created.append(name)
+        upper += PARTITION_SIZE
+    return created
+
+
+def purge_deleted(cur):
+    # Deleted messages stay as tombstones (clients still render "removed"),
+    # but their content is dropped once the retention period is over. The
+    # inner SELECT matches the predicate of idx_messages_purge, so each batch
+    # is an index scan over the rows still to purge.
+    purged = 0
+    while True:
+        cur.execute("""
+            UPDATE messages SET content = NULL, file_meta = NULL, reactions = '{}'::jsonb
+            WHERE id IN (
+                SELECT id FROM messages
+                WHERE is_deleted AND deleted_at < LOCALTIMESTAMP - make_interval(days => %s)
+                  AND (content IS NOT NULL OR file_meta IS NOT NULL OR reactions <> '{}'::jsonb)
+                LIMIT %s
+            )
+        """, (DELETED_RETENTION_DAYS, PURGE_BATCH_SIZE))
+        purged += cur.rowcount
+        cur.connection.commit()
+        if cur.rowcount < PURGE_BATCH_SIZE:
+            return purged
+
+
+def cold_partitions(cur):
+    # A partition is cold once its newest message is older than the cutoff;
+    # the newest message is found through the primary key, not a scan. The
+    # partition currently being written to is never cold.
+    cold = []
+    for name, lower, upper, tablespace in partitions(cur)[:-PARTITIONS_AHEAD - 1]:
+        cur.execute(f"""
+            SELECT created_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+            FROM {name} ORDER BY id DESC LIMIT 1
+        """, (ARCHIVE_AFTER_DAYS,))
+        row = cur.fetchone()
+        if row is None:
+            continue
+        if not row[0]:
+            # Partitions are time-ordered, so everything after this one is warm too.
+            break
+        cold.append(name)
+    return cold
+
+
+def _partition_index(cur, parent_index, partition):
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_index x ON x.indexrelid = c.oid
+        WHERE i.inhparent = %s::regclass AND x.indrelid = %s::regclass
+    """, (parent_index, partition))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def archive_partition(conn, name):
+    # CLUSTER rewrites the partition in (conversation_id, id) order, so
+    # scrolling back through old history reads contiguous pages, and drops
+    # the dead tuples left by deletes and purges. It holds an exclusive lock
+    # on this partition only, for the duration of the rewrite.
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM archived_message_partitions WHERE name = %s", (name,))
+        if cur.fetchone():
+            return False
+        cur.execute("SELECT pg_total_relation_size(%s::regclass)", (name,))
+        size_before = cur.fetchone()[0]
+        index = _partition_index(cur, 'idx_messages_conversation_id', name)
+        if index:
+            cur.execute(f"CLUSTER {name} USING {index}")
+        if ARCHIVE_TABLESPACE:
+            cur.execute(f"ALTER TABLE {name} SET TABLESPACE {ARCHIVE_TABLESPACE}")
+            cur.execute("SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = %s::regclass", (name,))
+            for (partition_index,) in cur.fetchall():
+                cur.execute(f"ALTER INDEX {partition_index} SET TABLESPACE {ARCHIVE_TABLESPACE}")
+        cur.execute(f"ANALYZE {name}")
+        cur.execute("SELECT pg_total_relation_size(%s::regclass)", (name,))
+        size_after = cur.fetchone()[0]
+        cur.execute("""
+            INSERT INTO archived_message_partitions (name, size_before, size_after, tablespace)
+            VALUES (%s, %s, %s, %s)
+        """, (name, size_before, size_after, ARCHIVE_TABLESPACE))
+        conn.commit()
+    metrics.log(f"Archived {name}: {size_before} -> {size_after} bytes")
+    return True
+
+
+def maintain(archive=True):
+    with connection() as conn, conn.cursor() as cur:
+        created = ensure_partitions(cur)
+        conn.commit()
+    if created:
+        metrics.log(f"Created message partitions: {', '.join(created)}")
+    if not archive:
+        return {'created': created}
+
+    with connection() as conn, conn.cursor() as cur:
+        purged = purge_deleted(cur)
+        cold = cold_partitions(cur)
+        conn.commit()
+    archived = []
+    for name in cold:
+        with connection() as conn:
+            if archive_partition(conn, name):
+                archived.append(name)
+    return {'created': created, 'purged': purged, 'archived': archived}
+
+
+def _run():
+    while True:
+        try:
+            maintain(archive=False)
+        except Exception as e:
+            metrics.log(f"Message partition maintenance failed: {e}")
+        socketio.sleep(MAINTENANCE_INTERVAL)
+
+
+def start():
+    # Only partition creation runs inside the web workers; purging and
+    # archival are left to `python partitions.py maintain` from cron.
+    global _started
+    if _started:
+        return
+    _started = True
+    socketio.start_background_task(_run)
+
+
+def status():
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT last_value FROM messages_id_seq")
+        last_id = cur.fetchone()[0]
+        cur.execute("SELECT name FROM archived_message_partitions")
+        archived = {row[0] for row in cur.fetchall()}
+        print(f"id sequence at {last_id}")
+        for name, lower, upper, tablespace in partitions(cur):
+            cur.execute("SELECT pg_total_relation_size(%s::regclass)", (name,))
+            size = cur.fetchone()[0]
+            state = 'archived' if name in archived else ('current' if lower <= last_id < upper else '')
+            print(f"{name:<24} [{lower}, {upper}) {size:>14} bytes  {tablespace or ''} {state}")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'maintain':
+        started = time.perf_counter()
+        result = maintain()
+        print(f"Created {len(result['created'])} partition(s), purged {result['purged']} deleted message(s), "
+              f"archived {len(result['archived'])} partition(s) in {time.perf_counter() - started:.1f}s.")
+    elif command == 'status':
+        status()
+    else:
+        sys.exit("Usage: python partitions.py [maintain | status]")
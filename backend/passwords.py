@@ -0,0 +1,105 @@
+import os
+import hmac
+import base64
+import hashlib
+import threading
+
+# Passwords are stored as scrypt$<n>$<r>$<p>$<salt>$<key>. Raising
+# PASSWORD_SCRYPT_N makes every login (and only logins) more expensive;
+# existing hashes are upgraded the next time their owner signs in. Hashes
+# written before this module are unsalted SHA-256 hex digests and are
+# upgraded the same way.
+PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 14))
+PASSWORD_SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', 8))
+PASSWORD_SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', 1))
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+_lock = threading.Lock()
+_dummy_hash = None
+_stats = {'hashed': 0, 'verified': 0, 'failed': 0, 'rehashed': 0}
+
+
+def _b64(data):
+    return base64.b64encode(data).decode().rstrip('=')
+
+
+def _unb64(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def _green():
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return False
+    return patcher.is_monkey_patched('thread')
+
+
+def _scrypt(password, salt, n, r, p):
+    # scrypt needs about 128 * n * r bytes; hashlib refuses anything over
+    # maxmem, which defaults to 32 MiB.
+    args = (password.encode(),)
+    kwargs = {'salt': salt, 'n': n, 'r': r, 'p': p, 'maxmem': 256 * n * r + 1024 * 1024, 'dklen': KEY_BYTES}
+    if _green():
+        # Under the eventlet worker a hash would stall every request and
+        # socket on the hub; tpool runs it on a native thread instead
+        # (hashlib releases the GIL while hashing), at most
+        # EVENTLET_THREADPOOL_SIZE (default 20) at a time.
+        from eventlet import tpool
+        return tpool.execute(hashlib.scrypt, *args, **kwargs)
+    return hashlib.scrypt(*args, **kwargs)
+
+
+def hash_password(password, n=PASSWORD_SCRYPT_N, r=PASSWORD_SCRYPT_R, p=PASSWORD_SCRYPT_P):
+    salt = os.urandom(SALT_BYTES)
+    key = _scrypt(password, salt, n, r, p)
+    with _lock:
+        _stats['hashed'] += 1
+    return f"scrypt${n}${r}${p}${_b64(salt)}${_b64(key)}"
+
+
+def is_legacy_hash(stored):
+    return len(stored) == 64 and all(c in '0123456789abcdef' for c in stored)
+
+
+def verify_password(password, stored):
+    # Returns (matches, needs_rehash).
+    stored = stored or ''
+    if is_legacy_hash(stored):
+        ok = hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+        needs_rehash = ok
+    else:
+        try:
+            scheme, n, r, p, salt, key = stored.split('$')
+            n, r, p = int(n), int(r), int(p)
+        except ValueError:
+            scheme = None
+        if scheme != 'scrypt':
+            ok = needs_rehash = False
+        else:
+            ok = hmac.compare_digest(_scrypt(password, _unb64(salt), n, r, p), _unb64(key))
+            needs_rehash = ok and (n, r, p) != (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    with _lock:
+        _stats['verified' if ok else 'failed'] += 1
+    return ok, needs_rehash
+
+
+def verify_unknown_user(password):
+    # Same cost as a real check, so response times don't reveal which
+    # emails have accounts.
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = hash_password('')
+    verify_password(password, _dummy_hash)
+    return False
+
+
+def record_rehash():
+    with _lock:
+        _stats['rehashed'] += 1
+
+
+def stats():
+    with _lock:
+        return {'scryptN': PASSWORD_SCRYPT_N, **_stats}
@@ -0,0 +1,184 @@
+import os
+import time
+import threading
+from extensions import socketio
+import cache
+import rooms
+import metrics
+
+# Typing, presence and read-receipt changes are buffered per room and sent as
+# one 'room-activity' event per room every PRESENCE_FLUSH_INTERVAL seconds.
+# Within a window the last value per user wins, so a user toggling typing ten
+# times costs the room a single emit.
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', 0.5))
+# Clients send 'heartbeat' every ~25s; silence for this long reads as away.
+PRESENCE_AWAY_AFTER = float(os.environ.get('PRESENCE_AWAY_AFTER', 70))
+# A typing flag without a refresh expires on its own.
+TYPING_TIMEOUT = float(os.environ.get('TYPING_TIMEOUT', 6))
+
+STATUSES = ('online', 'away')
+
+_lock = threading.Lock()
+_users = {}
+_typing = {}
+_pending = {}
+_started = False
+
+
+def start():
+    global _started
+    with _lock:
+        if _started:
+            return
+        _started = True
+    socketio.start_background_task(_run)
+
+
+def _run():
+    while True:
+        socketio.sleep(PRESENCE_FLUSH_INTERVAL)
+        try:
+            _sweep()
+            flush()
+        except Exception as e:
+            metrics.log(f"Presence flush failed: {e}")
+
+
+def _queue(room, kind, user_id, value):
+    _pending.setdefault(room, {}).setdefault(kind, {})[user_id] = value
+
+
+def _user_rooms(user_id):
+    state = _users.get(user_id)
+    if not state:
+        return set()
+    found = set()
+    for sid in state['sids']:
+        found |= rooms.registry.rooms_for(sid)
+    return found
+
+
+def _announce(user_id, status, room_list=None):
+    for room in (_user_rooms(user_id) if room_list is None else room_list):
+        _queue(room, 'presence', user_id, status)
+
+
+def connect(sid, user_id):
+    with _lock:
+        state = _users.setdefault(user_id, {'status': 'offline', 'last_seen': 0, 'sids': set()})
+        state['sids'].add(sid)
+        state['last_seen'] = time.monotonic()
+        if state['status'] != 'online':
+            state['status'] = 'online'
+            _announce(user_id, 'online')
+
+
+def disconnect(sid, user_id, room_list):
+    # The registry may be Redis; no I/O while holding _lock.
+    online = rooms.registry.is_online(user_id)
+    with _lock:
+        state = _users.get(user_id)
+        if not state:
+            return
+        state['sids'].discard(sid)
+        for room in room_list:
+            if _typing.pop((room, user_id), None) is not None:
+                _queue(room, 'typing', user_id, False)
+        if not state['sids']:
+            del _users[user_id]
+            if not online:
+                _announce(user_id, 'offline', room_list)
+
+
+def joined(room, user_id):
+    with _lock:
+        state = _users.get(user_id)
+        _queue(room, 'presence', user_id, state['status'] if state else 'online')
+
+
+def heartbeat(user_id, status='online'):
+    if status not in STATUSES:
+        status = 'online'
+    with _lock:
+        state = _users.get(user_id)
+        if not state:
+            return
+        state['last_seen'] = time.monotonic()
+        if state['status'] != status:
+            state['status'] = status
+            _announce(user_id, status)
+
+
+def set_typing(room, user_id, typing):
+    with _lock:
+        key = (room, user_id)
+        was_typing = key in _typing
+        if typing:
+            _typing[key] = time.monotonic() + TYPING_TIMEOUT
+        else:
+            _typing.pop(key, None)
+        if was_typing != bool(typing):
+            _queue(room, 'typing', user_id, bool(typing))
+
+
+def read(room, user_id, last_read_seq, read_at):
+    with _lock:
+        _queue(room, 'reads', user_id, {'lastReadSeq': last_read_seq, 'readAt': read_at})
+
+
+def status(user_id):
+    state = _users.get(user_id)
+    if state:
+        return state['status']
+    return 'online' if rooms.registry.is_online(user_id) else 'offline'
+
+
+def statuses(user_ids):
+    return {user_id: status(user_id) for user_id in user_ids}
+
+
+def _sweep():
+    now = time.monotonic()
+    with _lock:
+        for key, expires_at in list(_typing.items()):
+            if expires_at <= now:
+                del _typing[key]
+                _queue(key[0], 'typing', key[1], False)
+        for user_id, state in _users.items():
+            if state['status'] == 'online' and now - state['last_seen'] > PRESENCE_AWAY_AFTER:
+                state['status'] = 'away'
+                _announce(user_id, 'away')
+
+
+def flush():
+    global _pending
+    with _lock:
+        batch, _pending = _pending, {}
+    if not batch:
+        return
+
+    user_ids = set()
+    for changes in batch.values():
+        for values in changes.values():
+            user_ids.update(values)
+    profiles = cache.get_profiles(user_ids)
+
+    def by_uid(values):
+        return {profiles[user_id]['uid']: value for user_id, value in values.items() if user_id in profiles}
+
+    for room, changes in batch.items():
+        if not rooms.registry.has_listeners(room):
+            continue
+        payload = {'conversationId': int(room)}
+        for kind, values in changes.items():
+            payload[kind] = by_uid(values)
+        socketio.emit('room-activity', payload, to=room)
+
+
+def stats():
+    with _lock:
+        return {
+            'users': len(_users),
+            'typing': len(_typing),
+            'pendingRooms': len(_pending),
+        }
@@ -0,0 +1,199 @@
+import threading
+from fanout import SOCKETIO_MESSAGE_QUEUE, SOCKETIO_CHANNEL
+from extensions import socketio
+
+# Who is connected and which conversation rooms their sockets joined. Sockets
+# only get into a room through sockets.handle_join_room, after the membership
+# check, so the registry also answers "is this socket allowed to talk here".
+
+ROOM_KEY_TTL = 24 * 60 * 60
+
+
+class RoomRegistry:
+    # Per-process registry. Authoritative when every socket lives in this
+    # process (no message queue, or the in-process local:// one).
+    def __init__(self, authoritative=True):
+        self.authoritative = authoritative
+        self._lock = threading.Lock()
+        self._users = {}
+        self._rooms = {}
+        self._sid_rooms = {}
+
+    def connect(self, sid, user_id):
+        with self._lock:
+            self._users[sid] = user_id
+            self._sid_rooms[sid] = set()
+
+    def user_id(self, sid):
+        return self._users.get(sid)
+
+    def join(self, sid, room):
+        with self._lock:
+            user_id = self._users.get(sid)
+            if user_id is None:
+                return False
+            self._rooms.setdefault(room, {})[sid] = user_id
+            self._sid_rooms[sid].add(room)
+            return True
+
+    def leave(self, sid, room):
+        with self._lock:
+            self._leave(sid, room)
+
+    def _leave(self, sid, room):
+        members = self._rooms.get(room)
+        if members is not None:
+            members.pop(sid, None)
+            if not members:
+                del self._rooms[room]
+        self._sid_rooms.get(sid, set()).discard(room)
+
+    def disconnect(self, sid):
+        with self._lock:
+            for room in list(self._sid_rooms.get(sid, ())):
+                self._leave(sid, room)
+            self._sid_rooms.pop(sid, None)
+            self._users.pop(sid, None)
+
+    def rooms_for(self, sid):
+        with self._lock:
+            return set(self._sid_rooms.get(sid, ()))
+
+    def in_room(self, sid, room):
+        # remove_member on another worker takes the socket out of the
+        # Socket.IO room through the message queue, which this registry never
+        # hears about; the server's rooms are the truth, and the registry
+        # catches up here.
+        if sid not in self._rooms.get(room, {}):
+            return False
+        if sid in socketio.server.manager.rooms.get('/', {}).get(room, {}):
+            return True
+        self.leave(sid, room)
+        return False
+
+    def has_listeners(self, room):
+        if not self.authoritative:
+            return True
+        return bool(self._rooms.get(room))
+
+    def online_user_ids(self, room):
+        with self._lock:
+            return set(self._rooms.get(room, {}).values())
+
+    def is_online(self, user_id):
+        with self._lock:
+            return user_id in self._users.values()
+
+    def user_sids(self, user_id):
+        with self._lock:
+            return [sid for sid, uid in self._users.items() if uid == user_id]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'local',
+                'authoritative': self.authoritative,
+                'sockets': len(self._users),
+                'rooms': len(self._rooms),
+            }
+
+
+class RedisRoomRegistry(RoomRegistry):
+    # Shared across workers: room membership lives in Redis hashes so any
+    # worker can tell whether a room has sockets anywhere. The sid -> user
+    # mapping stays local because a socket only ever talks to one worker.
+    # Keys expire after a day without joins, which bounds what a crashed
+    # worker leaves behind.
+    def __init__(self, url, prefix=SOCKETIO_CHANNEL):
+        super().__init__(authoritative=True)
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _room_key(self, room):
+        return f'{self.prefix}:room:{room}'
+
+    def _user_key(self, user_id):
+        return f'{self.prefix}:user:{user_id}'
+
+    def connect(self, sid, user_id):
+        super().connect(sid, user_id)
+        pipe = self.redis.pipeline()
+        pipe.sadd(self._user_key(user_id), sid)
+        pipe.expire(self._user_key(user_id), ROOM_KEY_TTL)
+        pipe.execute()
+
+    def join(self, sid, room):
+        if not super().join(sid, room):
+            return False
+        pipe = self.redis.pipeline()
+        pipe.hset(self._room_key(room), sid, self._users[sid])
+        pipe.expire(self._room_key(room), ROOM_KEY_TTL)
+        pipe.execute()
+        return True
+
+    def leave(self, sid, room):
+        super().leave(sid, room)
+        self.redis.hdel(self._room_key(room), sid)
+
+    def disconnect(self, sid):
+        user_id = self._users.get(sid)
+        rooms = list(self._sid_rooms.get(sid, ()))
+        super().disconnect(sid)
+        pipe = self.redis.pipeline()
+        for room in rooms:
+            pipe.hdel(self._room_key(room), sid)
+        if user_id is not None:
+            pipe.srem(self._user_key(user_id), sid)
+        pipe.execute()
+
+    def has_listeners(self, room):
+        return self.redis.hlen(self._room_key(room)) > 0
+
+    def online_user_ids(self, room):
+        return {int(user_id) for user_id in self.redis.hvals(self._room_key(room))}
+
+    def is_online(self, user_id):
+        return self.redis.scard(self._user_key(user_id)) > 0
+
+    def user_sids(self, user_id):
+        return [sid.decode() for sid in self.redis.smembers(self._user_key(user_id))]
+
+    def stats(self):
+        stats = super().stats()
+        stats['backend'] = 'redis'
+        return stats
+
+
+def make_registry(url=SOCKETIO_MESSAGE_QUEUE):
+    if not url or url.startswith('local://'):
+        return RoomRegistry()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisRoomRegistry(url)
+    # Other brokers fan out fine but give us nowhere to share presence, so
+    # never skip an emit on the strength of local knowledge alone.
+    return RoomRegistry(authoritative=False)
+
+
+registry = make_registry()
+
+
+def conversation_room(conversation_id):
+    return str(conversation_id)
+
+
+def has_listeners(conversation_id):
+    return registry.has_listeners(conversation_room(conversation_id))
+
+
+def online_user_ids(conversation_id):
+    return registry.online_user_ids(conversation_room(conversation_id))
+
+
+def remove_member(conversation_id, user_id):
+    # Takes a removed member's sockets out of the room, on whichever worker
+    # they are connected to (leave_room goes through the message queue).
+    room = conversation_room(conversation_id)
+    for sid in registry.user_sids(user_id):
+        socketio.server.leave_room(sid, room, namespace='/')
+        registry.leave(sid, room)
@@ -1,39 +1,39 @@
 from flask import Blueprint, request, jsonify
 from extensions import socketio
-import jwt
 import datetime
 import os
 import hashlib
-from db import get_db_connection
-from psycopg2.extras import Json
-from functools import wraps
+from db import connection, PoolError
+import cache
+from cache import search_cache
+from psycopg2.extras import Json, execute_values
 from werkzeug.utils import secure_filename
+import uploads
+import media
+from uploads import UploadError
+from storage import storage, SIGNED_URL_TTL
+import auth
+import passwords
+import metrics
+from auth import token_required
+import rooms
+import search
+import inbox
+import presence
+from writer import MessageWriter, PendingMessage, QueueFull, WriteFailed
 
 api_bp = Blueprint('api', __name__)
 
-SECRET_KEY = os.environ.get('SECRET_KEY', 'default_secret_key')
 
+@api_bp.errorhandler(PoolError)
+def handle_pool_error(e):
+    metrics.log(f"Database pool error: {e}")
+    return jsonify({'message': 'Database connection failed'}), 500
 
-def token_required(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = None
-        if 'Authorization' in request.headers:
-            auth_header = request.headers['Authorization']
-            if auth_header.startswith("Bearer "):
-                token = auth_header.split(" ")[1]
-        
-        if not token:
-            return jsonify({'message': 'Token is missing!'}), 401
-        
-        try:
-            data = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-            current_user_id = data['user_id']
-        except Exception as e:
-            return jsonify({'message': 'Token is invalid!'}), 401
-        
-        return f(current_user_id, *args, **kwargs)
-    return decorated
+
+@api_bp.errorhandler(UploadError)
+def handle_upload_error(e):
+    return jsonify({'message': e.message, **e.extra}), e.status
 
 
 @api_bp.route('/auth/signup', methods=['POST'])
@@ -46,26 +46,22 @@ def signup():
     if not email or not password:
         return jsonify({'message': 'Email and password are required'}), 400
 
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    password_hash = passwords.hash_password(password)
     
     uid = hashlib.md5(email.encode()).hexdigest()
 
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'message': 'Database connection failed'}), 500
-    
     try:
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO users (uid, email, password_hash, display_name) VALUES (%s, %s, %s, %s) RETURNING id",
-            (uid, email, password_hash, display_name)
-        )
-        user_id = cur.fetchone()[0]
-        conn.commit()
-        cur.close()
-        conn.close()
+        with connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO users (uid, email, password_hash, display_name) VALUES (%s, %s, %s, %s) RETURNING id",
+                (uid, email, password_hash, display_name)
+            )
+            user_id = cur.fetchone()[0]
+            conn.commit()
         
         return jsonify({'message': 'User created successfully', 'uid': uid}), 201
+    except PoolError:
+        raise
     except Exception as e:
         return jsonify({'message': str(e)}), 400
 
@@ -78,68 +74,73 @@ def login():
     if not email or not password:
         return jsonify({'message': 'Email and password are required'}), 400
 
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
-
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'message': 'Database connection failed'}), 500
-
-    cur = conn.cursor()
-    cur.execute("SELECT id, uid, email, display_name, photo_url FROM users WHERE email = %s AND password_hash = %s", (email, password_hash))
-    user = cur.fetchone()
-    cur.close()
-    conn.close()
-
-    if user:
-
-
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT id, uid, email, display_name, photo_url, password_hash FROM users WHERE email = %s", (email,))
+        user = cur.fetchone()
+        if user:
+            valid, needs_rehash = passwords.verify_password(password, user[5])
+        else:
+            valid = passwords.verify_unknown_user(password)
+        if not valid:
+            return jsonify({'message': 'Invalid credentials'}), 401
+
+        if needs_rehash:
+            # Legacy SHA-256 or outdated scrypt parameters: upgrade while we
+            # have the plaintext. Skipped if the password changed meanwhile.
+            cur.execute("UPDATE users SET password_hash = %s WHERE id = %s AND password_hash = %s",
+                        (passwords.hash_password(password), user[0], user[5]))
+            passwords.record_rehash()
+        refresh_token, _ = auth.issue_refresh_token(cur, user[0])
+        conn.commit()
 
+    return jsonify({
+        'token': auth.issue_access_token(user[0], user[1]),
+        'refreshToken': refresh_token,
+        'expiresIn': auth.ACCESS_TOKEN_TTL,
+        'user': {
+            'uid': user[1],
+            'email': user[2],
+            'displayName': user[3],
+            'photoURL': user[4]
+        }
+    })
 
+@api_bp.route('/auth/refresh', methods=['POST'])
+def refresh():
+    data = request.get_json(silent=True) or {}
+    with connection() as conn, conn.cursor() as cur:
+        rotated = auth.rotate_refresh_token(cur, data.get('refreshToken'))
+        if rotated:
+            cur.execute("SELECT uid FROM users WHERE id = %s", (rotated[0],))
+            user = cur.fetchone()
+        conn.commit()
 
-        
+    if not rotated or not user:
+        return jsonify({'message': 'Refresh token is invalid!'}), 401
+    return jsonify({
+        'token': auth.issue_access_token(rotated[0], user[0]),
+        'refreshToken': rotated[1],
+        'expiresIn': auth.ACCESS_TOKEN_TTL
+    })
 
-        user_id = user[0]
-        user_uid = user[1]
-        
-        token = jwt.encode({
-            'user_id': user_id,
-            'uid': user_uid,
-            'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
-        }, SECRET_KEY, algorithm="HS256")
-        
-        return jsonify({
-            'token': token,
-            'user': {
-                'uid': user[1],
-                'email': user[2],
-                'displayName': user[3],
-                'photoURL': user[4]
-            }
-        })
-    
-    return jsonify({'message': 'Invalid credentials'}), 401
+@api_bp.route('/auth/logout', methods=['POST'])
+def logout():
+    data = request.get_json(silent=True) or {}
+    if data.get('refreshToken'):
+        with connection() as conn, conn.cursor() as cur:
+            auth.revoke_refresh_token(cur, data['refreshToken'])
+            conn.commit()
+    return jsonify({'message': 'Logged out'})
 
 
 
 @api_bp.route('/users/me', methods=['GET'])
 @token_required
 def get_current_user(current_user_id):
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'message': 'Database connection failed'}), 500
-    cur = conn.cursor()
-    cur.execute("SELECT uid, email, display_name, photo_url FROM users WHERE id = %s", (current_user_id,))
-    user = cur.fetchone()
-    cur.close()
-    conn.close()
+    user = cache.get_profile(current_user_id)
     
     if user:
-        return jsonify({
-            'uid': user[0],
-            'email': user[1],
-            'displayName': user[2],
-            'photoURL': user[3]
-        })
+        return jsonify(cache.public_profile(user))
     return jsonify({'message': 'User not found'}), 404
 
 @api_bp.route('/profile', methods=['PUT'])
@@ -152,14 +153,7 @@ def update_profile(current_user_id):
     if not display_name and not photo_url:
         return jsonify({'message': 'No fields to update'}), 400
     
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'message': 'Database connection failed'}), 500
-    
     try:
-        cur = conn.cursor()
-        
-
         update_fields = []
         params = []
         
@@ -174,12 +168,11 @@ def update_profile(current_user_id):
         params.append(current_user_id)
         
         query = f"UPDATE users SET {', '.join(update_fields)} WHERE id = %s RETURNING uid, email, display_name, photo_url"
-        cur.execute(query, params)
-        updated_user = cur.fetchone()
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        with connection() as conn, conn.cursor() as cur:
+            cur.execute(query, params)
+            updated_user = cur.fetchone()
+            conn.commit()
+        cache.invalidate_user(current_user_id)
         
         if updated_user:
             return jsonify({
@@ -193,39 +186,94 @@ def update_profile(current_user_id):
             })
         
         return jsonify({'message': 'User not found'}), 404
+    except PoolError:
+        raise
     except Exception as e:
         return jsonify({'message': str(e)}), 500
 
 
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
+MAX_SEARCH_OFFSET = 500
+# Below this length pg_trgm has no trigrams to use, so only prefix matching is indexed.
+MIN_TRIGRAM_QUERY = 3
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def run_user_search(cur, query, offset, limit):
+    if not query:
+        cur.execute("""
+            SELECT uid, email, display_name, photo_url FROM users
+            ORDER BY created_at DESC, id DESC
+            LIMIT %s OFFSET %s
+        """, (limit, offset))
+        return cur.fetchall()
+
+    prefix = escape_like(query) + '%'
+    if len(query) < MIN_TRIGRAM_QUERY:
+        cur.execute("""
+            SELECT uid, email, display_name, photo_url FROM users
+            WHERE lower(display_name) LIKE %(prefix)s OR lower(email) LIKE %(prefix)s
+            ORDER BY (lower(display_name) LIKE %(prefix)s) IS TRUE DESC, lower(display_name), id
+            LIMIT %(limit)s OFFSET %(offset)s
+        """, {'prefix': prefix, 'limit': limit, 'offset': offset})
+        return cur.fetchall()
+
+    # Prefix hits rank first, then trigram similarity; both predicates are served
+    # by the gin_trgm_ops indexes on lower(display_name) and lower(email).
+    cur.execute("""
+        SELECT uid, email, display_name, photo_url FROM users
+        WHERE lower(display_name) LIKE %(contains)s OR lower(email) LIKE %(contains)s
+        ORDER BY (lower(display_name) LIKE %(prefix)s OR lower(email) LIKE %(prefix)s) IS TRUE DESC,
+                 GREATEST(similarity(lower(display_name), %(query)s), similarity(lower(email), %(query)s)) DESC,
+                 id
+        LIMIT %(limit)s OFFSET %(offset)s
+    """, {'contains': '%' + escape_like(query) + '%', 'prefix': prefix, 'query': query, 'limit': limit, 'offset': offset})
+    return cur.fetchall()
+
+
 @api_bp.route('/users/search', methods=['GET'])
 @token_required
 def search_users(current_user_id):
-    query = request.args.get('q', '')
-    
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'message': 'Database connection failed'}), 500
-    cur = conn.cursor()
-    
-    if not query:
-        cur.execute("SELECT uid, email, display_name, photo_url FROM users ORDER BY created_at DESC LIMIT 50")
-    else:
+    query = request.args.get('q', '').strip().lower()[:100]
+    paged = 'cursor' in request.args or 'limit' in request.args
 
-        cur.execute("SELECT uid, email, display_name, photo_url FROM users WHERE email ILIKE %s OR display_name ILIKE %s", (f'%{query}%', f'%{query}%'))
-    
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
+    try:
+        offset = int_arg('cursor') or 0
+        limit = int_arg('limit') or (SEARCH_PAGE_SIZE if paged else MAX_SEARCH_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'message': 'Invalid pagination parameters'}), 400
+    limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+    offset = max(0, min(offset, MAX_SEARCH_OFFSET))
+
+    # Fetch one extra row so we know whether to hand out a next cursor.
+    cache_key = (query, offset, limit)
+    users = search_cache.get(cache_key)
+    if users is None:
+        with connection() as conn, conn.cursor() as cur:
+            users = run_user_search(cur, query, offset, limit + 1)
+        search_cache.set(cache_key, users)
 
     result = []
-    for u in users:
+    for u in users[:limit]:
         result.append({
             'uid': u[0],
             'email': u[1],
             'displayName': u[2],
             'photoURL': u[3]
         })
-    return jsonify(result)
+
+    if not paged:
+        return jsonify(result)
+
+    has_more = len(users) > limit and offset + limit < MAX_SEARCH_OFFSET
+    return jsonify({
+        'users': result,
+        'nextCursor': str(offset + limit) if has_more else None
+    })
 
 @api_bp.route('/users/batch', methods=['POST'])
 @token_required
@@ -236,343 +284,1181 @@ def get_users_batch(current_user_id):
     if not uids:
         return jsonify([])
 
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'message': 'Database connection failed'}), 500
-    cur = conn.cursor()
-
-    cur.execute("SELECT uid, email, display_name, photo_url FROM users WHERE uid = ANY(%s)", (uids,))
-    users = cur.fetchall()
-    cur.close()
-    conn.close()
+    users = cache.get_profiles_by_uid(uids)
 
     result = []
-    for u in users:
-        result.append({
-            'uid': u[0],
-            'email': u[1],
-            'displayName': u[2],
-            'photoURL': u[3]
-        })
+    for uid in dict.fromkeys(uids):
+        if uid in users:
+            result.append(cache.public_profile(users[uid]))
     return jsonify(result)
 
 
 
+MAX_GROUP_MEMBERS = int(os.environ.get('MAX_GROUP_MEMBERS', 5000))
+MAX_GROUP_NAME = 255
+# owner: everything, including roles; admin: add and remove members.
+ROLES = ('owner', 'admin', 'member')
+
+
+def direct_key(user_id, other_id):
+    return f"{min(user_id, other_id)}:{max(user_id, other_id)}"
+
+
 @api_bp.route('/conversations', methods=['POST'])
 @token_required
 def create_conversation(current_user_id):
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
+    if 'memberUids' in data:
+        return create_group(current_user_id, data)
     recipient_uid = data.get('recipientUid')
 
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'message': 'Database connection failed'}), 500
-    cur = conn.cursor()
-
-
-    cur.execute("SELECT id FROM users WHERE uid = %s", (recipient_uid,))
-    recipient = cur.fetchone()
-    
+    recipient = cache.get_profile_by_uid(recipient_uid) if recipient_uid else None
     if not recipient:
         return jsonify({'message': 'Recipient not found'}), 404
     
-    recipient_id = recipient[0]
+    recipient_id = recipient['id']
+    if recipient_id == current_user_id:
+        return jsonify({'message': 'Cannot start a conversation with yourself'}), 400
+    key = direct_key(current_user_id, recipient_id)
 
-    # Check for existing 1-on-1 conversation
-    cur.execute("""
-        SELECT cp1.conversation_id 
-        FROM conversation_participants cp1
-        JOIN conversation_participants cp2 ON cp1.conversation_id = cp2.conversation_id
-        WHERE cp1.user_id = %s AND cp2.user_id = %s
-        AND (SELECT COUNT(*) FROM conversation_participants WHERE conversation_id = cp1.conversation_id) = 2
-    """, (current_user_id, recipient_id))
-    
-    existing_conv = cur.fetchone()
-    if existing_conv:
-        return jsonify({'conversationId': existing_conv[0]}), 200
+    with connection() as conn, conn.cursor() as cur:
 
-    cur.execute("INSERT INTO conversations (last_message) VALUES ('') RETURNING id")
-    conversation_id = cur.fetchone()[0]
+        # Check for existing 1-on-1 conversation: one lookup on the unique
+        # direct_key, which also makes two concurrent requests for the same
+        # pair end up in the same conversation.
+        cur.execute("SELECT id FROM conversations WHERE direct_key = %s", (key,))
+        existing_conv = cur.fetchone()
+        if existing_conv:
+            return jsonify({'conversationId': existing_conv[0]}), 200
 
-    cur.execute("INSERT INTO conversation_participants (conversation_id, user_id) VALUES (%s, %s)", (conversation_id, current_user_id))
-    cur.execute("INSERT INTO conversation_participants (conversation_id, user_id) VALUES (%s, %s)", (conversation_id, recipient_id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+        cur.execute("""
+            INSERT INTO conversations (last_message, kind, direct_key, created_by, member_count)
+            VALUES ('', 'direct', %s, %s, 2)
+            ON CONFLICT (direct_key) DO NOTHING
+            RETURNING id
+        """, (key, current_user_id))
+        row = cur.fetchone()
+        if not row:
+            cur.execute("SELECT id FROM conversations WHERE direct_key = %s", (key,))
+            return jsonify({'conversationId': cur.fetchone()[0]}), 200
+        conversation_id = row[0]
+
+        cur.execute("INSERT INTO conversation_participants (conversation_id, user_id) VALUES (%s, %s)", (conversation_id, current_user_id))
+        cur.execute("INSERT INTO conversation_participants (conversation_id, user_id) VALUES (%s, %s)", (conversation_id, recipient_id))
+        inbox.add_members(cur, conversation_id, [current_user_id, recipient_id])
+        
+        conn.commit()
+    cache.invalidate_conversation(conversation_id, [current_user_id, recipient_id])
 
     return jsonify({'conversationId': conversation_id}), 201
 
+
+def resolve_uids(uids):
+    # uid list from a request body -> ({uid: profile}, error response or None).
+    if not isinstance(uids, list) or not all(isinstance(uid, str) for uid in uids):
+        return None, (jsonify({'message': 'Expected a list of user uids'}), 400)
+    uids = list(dict.fromkeys(uids))
+    if len(uids) > MAX_GROUP_MEMBERS:
+        return None, (jsonify({'message': f'At most {MAX_GROUP_MEMBERS} members'}), 400)
+    profiles = cache.get_profiles_by_uid(uids)
+    missing = [uid for uid in uids if uid not in profiles]
+    if missing:
+        return None, (jsonify({'message': 'Users not found', 'uids': missing}), 404)
+    return profiles, None
+
+
+def create_group(current_user_id, data):
+    name = (data.get('name') or '').strip()[:MAX_GROUP_NAME] or None
+    profiles, error = resolve_uids(data.get('memberUids'))
+    if error:
+        return error
+    member_ids = sorted({p['id'] for p in profiles.values()} | {current_user_id})
+    if len(member_ids) > MAX_GROUP_MEMBERS:
+        return jsonify({'message': f'At most {MAX_GROUP_MEMBERS} members'}), 400
+
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO conversations (last_message, kind, name, created_by, member_count)
+            VALUES ('', 'group', %s, %s, %s)
+            RETURNING id
+        """, (name, current_user_id, len(member_ids)))
+        conversation_id = cur.fetchone()[0]
+        execute_values(cur, "INSERT INTO conversation_participants (conversation_id, user_id, role) VALUES %s",
+                       [(conversation_id, user_id, 'owner' if user_id == current_user_id else 'member')
+                        for user_id in member_ids], page_size=1000)
+        inbox.add_members(cur, conversation_id, member_ids)
+        conn.commit()
+    cache.invalidate_conversation(conversation_id, member_ids)
+
+    return jsonify({
+        'conversationId': conversation_id,
+        'kind': 'group',
+        'name': name,
+        'memberCount': len(member_ids)
+    }), 201
+
 @api_bp.route('/conversations', methods=['GET'])
 @token_required
 def get_conversations(current_user_id):
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'message': 'Database connection failed'}), 500
-    cur = conn.cursor()
-    
-    # Get current user's UID for filter
-    cur.execute("SELECT uid FROM users WHERE id = %s", (current_user_id,))
-    current_uid = cur.fetchone()[0]
+    # Reads the caller's inbox_entries (see inbox.py), then the details of the
+    # conversations on the page in one more query; profiles come from the
+    # cache. Only direct chats list their members here, so a page costs the
+    # same however large the caller's groups are.
+    paged = any(key in request.args for key in ('cursor', 'limit', 'archived'))
 
-    cur.execute("""
-        SELECT c.id, c.last_message, c.updated_at 
-        FROM conversations c
-        JOIN conversation_participants cp ON c.id = cp.conversation_id
-        WHERE cp.user_id = %s AND (c.last_message IS NOT NULL AND LENGTH(TRIM(c.last_message)) > 0)
-        ORDER BY c.updated_at DESC
-    """, (current_user_id,))
-    
-    conversations = cur.fetchall()
-    result = []
-    
-    for conv in conversations:
-        conv_id = conv[0]
-
-        cur.execute("""
-            SELECT u.uid, u.email, u.display_name, u.photo_url
-            FROM users u
-            JOIN conversation_participants cp ON u.id = cp.user_id
-            WHERE cp.conversation_id = %s
-        """, (conv_id,))
-        
-        participants = cur.fetchall()
-        participant_uids = [p[0] for p in participants]
-        
-        # Debug logging
-        # print(f"Conv {conv_id} participants: {participant_uids}")
-        # print(f"Current UID: {current_uid}")
-
-        # Find the other user (if 1-on-1) or just use the first non-me user for groups
-        other_user_data = next((p for p in participants if p[0] != current_uid), participants[0] if participants else None)
-        
-        user_info = {}
-        if other_user_data:
-            user_info = {
-                'uid': other_user_data[0],
-                'email': other_user_data[1],
-                'displayName': other_user_data[2],
-                'photoURL': other_user_data[3]
-            }
-            # print(f"Chosen other user: {user_info['displayName']} ({user_info['uid']})")
+    try:
+        before = int_arg('cursor')
+        limit = int_arg('limit') or inbox.INBOX_PAGE_SIZE
+    except ValueError:
+        return jsonify({'message': 'Invalid pagination parameters'}), 400
+    limit = max(1, min(limit, inbox.MAX_INBOX_PAGE_SIZE))
+    archived = request.args.get('archived') in ('1', 'true')
+
+    with connection() as conn, conn.cursor() as cur:
+        entries = inbox.page(cur, current_user_id, archived, before, limit + 1 if paged else None)
+        has_more = paged and len(entries) > limit
+        if paged:
+            entries = entries[:limit]
+
+        details = {}
+        if entries:
+            cur.execute("""
+                SELECT c.id, c.kind, c.name, c.member_count, me.last_read_seq,
+                       CASE WHEN c.kind = 'direct' THEN ARRAY(
+                           SELECT p.user_id FROM conversation_participants p WHERE p.conversation_id = c.id
+                       ) END
+                FROM conversations c
+                JOIN conversation_participants me ON me.conversation_id = c.id AND me.user_id = %s
+                WHERE c.id = ANY(%s)
+            """, (current_user_id, [entry[0] for entry in entries]))
+            details = {row[0]: row for row in cur.fetchall()}
+        user_ids = {u for row in details.values() for u in (row[5] or [])} | {e[4] for e in entries if e[4]}
+        profiles = cache.get_profiles(user_ids, cur)
 
+    result = []
+    for entry in entries:
+        conversation_id = entry[0]
+        detail = details.get(conversation_id)
+        if detail is None:
+            continue
+        member_ids = sorted(detail[5] or [])
+        others = [u for u in member_ids if u != current_user_id] or member_ids
+        other_user = profiles.get(others[0]) if others else None
+        sender = profiles.get(entry[4])
         result.append({
-            'conversationId': conv_id,
-            'lastMessage': conv[1],
-            'updatedAt': conv[2].isoformat() if conv[2] else None,
-            'users': participant_uids,
-            'userInfo': user_info 
+            'conversationId': conversation_id,
+            'kind': detail[1],
+            'name': detail[2],
+            'memberCount': detail[3],
+            'lastMessage': entry[2],
+            'lastMessageType': entry[3],
+            'lastSender': sender['uid'] if sender else None,
+            'updatedAt': entry[5].isoformat() if entry[5] else None,
+            'users': [profiles[u]['uid'] for u in member_ids if u in profiles],
+            'userInfo': cache.public_profile(other_user) if other_user else {},
+            'unreadCount': entry[6],
+            'lastReadSeq': detail[4],
+            'muted': entry[7],
+            'archived': entry[8]
         })
 
-    cur.close()
-    conn.close()
-    return jsonify(result)
+    if not paged:
+        return jsonify(result)
 
-@api_bp.route('/conversations/<int:conversation_id>', methods=['GET'])
+    return jsonify({
+        'conversations': result,
+        'nextCursor': str(entries[-1][1]) if has_more else None
+    })
+
+@api_bp.route('/conversations/<int:conversation_id>/inbox', methods=['PATCH'])
 @token_required
-def get_conversation_details(current_user_id, conversation_id):
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'message': 'Database connection failed'}), 500
-    cur = conn.cursor()
-    
+def update_inbox_entry(current_user_id, conversation_id):
+    data = request.get_json(silent=True) or {}
+    flags = {key: data.get(key) for key in ('muted', 'archived')}
+    if all(value is None for value in flags.values()):
+        return jsonify({'message': 'No fields to update'}), 400
+    if any(value is not None and not isinstance(value, bool) for value in flags.values()):
+        return jsonify({'message': 'muted and archived must be booleans'}), 400
 
-    cur.execute("SELECT 1 FROM conversation_participants WHERE conversation_id = %s AND user_id = %s", (conversation_id, current_user_id))
-    if not cur.fetchone():
+    with connection() as conn, conn.cursor() as cur:
+        row = inbox.set_flags(cur, current_user_id, conversation_id, flags['muted'], flags['archived'])
+        conn.commit()
+    if not row:
         return jsonify({'message': 'Unauthorized'}), 403
+    return jsonify({'conversationId': conversation_id, 'muted': row[0], 'archived': row[1]})
 
-    cur.execute("SELECT id, last_message, updated_at FROM conversations WHERE id = %s", (conversation_id,))
-    conv = cur.fetchone()
-    
-    if not conv:
-        return jsonify({'message': 'Conversation not found'}), 404
-
+@api_bp.route('/conversations/<int:conversation_id>', methods=['GET'])
+@token_required
+def get_conversation_details(current_user_id, conversation_id):
+    with connection() as conn, conn.cursor() as cur:
+        role = cache.get_role(conversation_id, current_user_id, cur)
+        if not role:
+            return jsonify({'message': 'Unauthorized'}), 403
 
-    cur.execute("""
-        SELECT u.uid, u.email, u.display_name, u.photo_url
-        FROM users u
-        JOIN conversation_participants cp ON u.id = cp.user_id
-        WHERE cp.conversation_id = %s
-    """, (conversation_id,))
-    
-    participants = cur.fetchall()
+        cur.execute("SELECT id, last_message, updated_at, kind, name, member_count FROM conversations WHERE id = %s", (conversation_id,))
+        conv = cur.fetchone()
+        
+        if not conv:
+            return jsonify({'message': 'Conversation not found'}), 404
+
+        # Large rooms list their first members only; the rest is paged
+        # through GET /conversations/<id>/members.
+        if conv[5] > inbox.LARGE_ROOM_SIZE:
+            cur.execute("""
+                SELECT user_id FROM conversation_participants
+                WHERE conversation_id = %s ORDER BY user_id LIMIT %s
+            """, (conversation_id, inbox.LARGE_ROOM_SIZE))
+            member_ids = {row[0] for row in cur.fetchall()} | {current_user_id}
+        else:
+            member_ids = cache.get_member_ids(conversation_id, cur)
+        profiles = cache.get_profiles(member_ids, cur)
+        cur.execute("SELECT user_id, last_read_seq FROM conversation_participants WHERE conversation_id = %s AND user_id = ANY(%s)",
+                    (conversation_id, list(member_ids)))
+        read_cursors = dict(cur.fetchall())
+
+    statuses = presence.statuses(member_ids)
     users_info = []
-    
-
-
     participant_uids = []
     
-    for p in participants:
-        participant_uids.append(p[0])
-        users_info.append({
-            'uid': p[0],
-            'email': p[1],
-            'displayName': p[2],
-            'photoURL': p[3]
-        })
-
-    cur.close()
-    conn.close()
+    for user_id in sorted(profiles):
+        p = profiles[user_id]
+        participant_uids.append(p['uid'])
+        users_info.append(cache.public_profile(p))
 
     return jsonify({
         'conversationId': conv[0],
         'lastMessage': conv[1],
+        'kind': conv[3],
+        'name': conv[4],
+        'memberCount': conv[5],
+        'role': role,
         'users': participant_uids,
-        'participants': users_info
+        'participants': users_info,
+        'readCursors': {profiles[u]['uid']: seq for u, seq in read_cursors.items() if u in profiles},
+        'presence': {profiles[u]['uid']: statuses[u] for u in member_ids if u in profiles}
     })
 
-@api_bp.route('/conversations/<int:conversation_id>', methods=['DELETE'])
+
+@api_bp.route('/conversations/<int:conversation_id>/members', methods=['GET'])
 @token_required
-def delete_conversation(current_user_id, conversation_id):
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'message': 'Database connection failed'}), 500
-    cur = conn.cursor()
-    
+def get_conversation_members(current_user_id, conversation_id):
+    try:
+        after = int_arg('cursor')
+        limit = int_arg('limit') or DEFAULT_PAGE_SIZE
+    except ValueError:
+        return jsonify({'message': 'Invalid pagination parameters'}), 400
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    with connection() as conn, conn.cursor() as cur:
+        if not cache.is_member(conversation_id, current_user_id, cur):
+            return jsonify({'message': 'Unauthorized'}), 403
+        cur.execute("""
+            SELECT user_id, role, joined_at FROM conversation_participants
+            WHERE conversation_id = %s AND (%s::integer IS NULL OR user_id > %s)
+            ORDER BY user_id
+            LIMIT %s
+        """, (conversation_id, after, after, limit + 1))
+        rows = cur.fetchall()
+        profiles = cache.get_profiles([row[0] for row in rows[:limit]], cur)
+
+    members = []
+    for user_id, role, joined_at in rows[:limit]:
+        if user_id in profiles:
+            members.append({
+                **cache.public_profile(profiles[user_id]),
+                'role': role,
+                'joinedAt': joined_at.isoformat() if joined_at else None
+            })
+    return jsonify({
+        'members': members,
+        'nextCursor': str(rows[limit - 1][0]) if len(rows) > limit else None
+    })
 
-    cur.execute("SELECT 1 FROM conversation_participants WHERE conversation_id = %s AND user_id = %s", (conversation_id, current_user_id))
-    if not cur.fetchone():
-        return jsonify({'message': 'Unauthorized'}), 403
 
+def broadcast_members_event(conversation_id, **changes):
+    socketio.emit('members-updated', {'conversationId': conversation_id, **changes},
+                  to=rooms.conversation_room(conversation_id))
 
 
+@api_bp.route('/conversations/<int:conversation_id>/members', methods=['POST'])
+@token_required
+def add_conversation_members(current_user_id, conversation_id):
+    data = request.get_json(silent=True) or {}
+    # Resolved before taking a connection: the profile lookup may need one of
+    # its own on a cache miss.
+    profiles, error = resolve_uids(data.get('uids'))
+    if error:
+        return error
+
+    with connection() as conn, conn.cursor() as cur:
+        if cache.get_role(conversation_id, current_user_id, cur, fresh=True) not in ('owner', 'admin'):
+            return jsonify({'message': 'Unauthorized'}), 403
+
+        # Row lock: concurrent adds can't push the room past MAX_GROUP_MEMBERS.
+        cur.execute("SELECT kind, member_count FROM conversations WHERE id = %s FOR UPDATE", (conversation_id,))
+        kind, member_count = cur.fetchone()
+        if kind != 'group':
+            return jsonify({'message': 'Members can only be changed in group conversations'}), 400
+        cur.execute("SELECT user_id FROM conversation_participants WHERE conversation_id = %s AND user_id = ANY(%s)",
+                    (conversation_id, [p['id'] for p in profiles.values()]))
+        existing = {row[0] for row in cur.fetchall()}
+        if member_count + len({p['id'] for p in profiles.values()} - existing) > MAX_GROUP_MEMBERS:
+            return jsonify({'message': f'At most {MAX_GROUP_MEMBERS} members'}), 400
+
+        # Newcomers start with the history counted as read.
+        added = execute_values(cur, """
+            INSERT INTO conversation_participants (conversation_id, user_id, read_count, last_read_seq)
+            SELECT c.id, v.user_id, c.message_count, c.seq
+            FROM (VALUES %s) AS v(conversation_id, user_id) JOIN conversations c ON c.id = v.conversation_id
+            ON CONFLICT DO NOTHING
+            RETURNING user_id
+        """, [(conversation_id, p['id']) for p in profiles.values()], page_size=max(len(profiles), 1), fetch=True)
+        added_ids = [row[0] for row in added]
+        if added_ids:
+            cur.execute("UPDATE conversations SET member_count = member_count + %s WHERE id = %s RETURNING member_count",
+                        (len(added_ids), conversation_id))
+            member_count = cur.fetchone()[0]
+            inbox.add_members(cur, conversation_id, added_ids)
+        conn.commit()
+    cache.invalidate_conversation(conversation_id, added_ids)
 
+    uids = [p['uid'] for p in profiles.values() if p['id'] in set(added_ids)]
+    if uids:
+        broadcast_members_event(conversation_id, added=uids, memberCount=member_count)
+    return jsonify({'conversationId': conversation_id, 'added': uids, 'memberCount': member_count})
 
-    
+
+@api_bp.route('/conversations/<int:conversation_id>/members/<uid>', methods=['DELETE'])
+@token_required
+def remove_conversation_member(current_user_id, conversation_id, uid):
+    # Members may leave; admins remove members, owners remove anyone. When
+    # the owner leaves, the longest-standing admin (or member) takes over.
+    target = cache.get_profile_by_uid(uid)
+    if not target:
+        return jsonify({'message': 'User not found'}), 404
+    target_id = target['id']
+
+    promoted = None
+    with connection() as conn, conn.cursor() as cur:
+        role = cache.get_role(conversation_id, current_user_id, cur, fresh=True)
+        if not role:
+            return jsonify({'message': 'Unauthorized'}), 403
+        cur.execute("SELECT kind FROM conversations WHERE id = %s FOR UPDATE", (conversation_id,))
+        if cur.fetchone()[0] != 'group':
+            return jsonify({'message': 'Members can only be changed in group conversations'}), 400
+
+        cur.execute("DELETE FROM conversation_participants WHERE conversation_id = %s AND user_id = %s RETURNING role",
+                    (conversation_id, target_id))
+        row = cur.fetchone()
+        if not row:
+            return jsonify({'message': 'Member not found'}), 404
+        target_role = row[0]
+        if target_id != current_user_id and (role == 'member' or (role == 'admin' and target_role != 'member')):
+            return jsonify({'message': 'Unauthorized'}), 403
+
+        inbox.remove_members(cur, conversation_id, [target_id])
+        cur.execute("UPDATE conversations SET member_count = member_count - 1 WHERE id = %s RETURNING member_count",
+                    (conversation_id,))
+        member_count = cur.fetchone()[0]
+        if member_count == 0:
+            cur.execute("DELETE FROM conversations WHERE id = %s", (conversation_id,))
+        elif target_role == 'owner':
+            cur.execute("""
+                UPDATE conversation_participants SET role = 'owner'
+                WHERE conversation_id = %s AND user_id = (
+                    SELECT user_id FROM conversation_participants WHERE conversation_id = %s
+                    ORDER BY role = 'admin' DESC, joined_at, user_id LIMIT 1
+                )
+                RETURNING user_id
+            """, (conversation_id, conversation_id))
+            promoted = cur.fetchone()[0]
+        conn.commit()
+    cache.invalidate_conversation(conversation_id, [target_id] + ([promoted] if promoted else []))
+
+    rooms.remove_member(conversation_id, target_id)
+    changes = {'removed': [uid], 'memberCount': member_count}
+    if promoted:
+        owner = cache.get_profile(promoted)
+        changes['roles'] = {owner['uid']: 'owner'} if owner else {}
+    broadcast_members_event(conversation_id, **changes)
+    return jsonify({'conversationId': conversation_id, **changes})
+
+
+@api_bp.route('/conversations/<int:conversation_id>/members/<uid>', methods=['PATCH'])
+@token_required
+def update_conversation_member(current_user_id, conversation_id, uid):
+    # Owner only. Making someone else owner hands ownership over; the
+    # previous owner becomes an admin.
+    data = request.get_json(silent=True) or {}
+    new_role = data.get('role')
+    if new_role not in ROLES:
+        return jsonify({'message': f"role must be one of {', '.join(ROLES)}"}), 400
+    target = cache.get_profile_by_uid(uid)
+    if not target:
+        return jsonify({'message': 'User not found'}), 404
+    target_id = target['id']
+    me = cache.get_profile(current_user_id)
+
+    with connection() as conn, conn.cursor() as cur:
+        if cache.get_role(conversation_id, current_user_id, cur, fresh=True) != 'owner':
+            return jsonify({'message': 'Unauthorized'}), 403
+        if target_id == current_user_id:
+            return jsonify({'message': 'Hand ownership to another member instead'}), 400
+        cur.execute("""
+            UPDATE conversation_participants SET role = %s
+            WHERE conversation_id = %s AND user_id = %s
+            RETURNING role
+        """, (new_role, conversation_id, target_id))
+        if not cur.fetchone():
+            return jsonify({'message': 'Member not found'}), 404
+        roles = {uid: new_role}
+        if new_role == 'owner':
+            cur.execute("UPDATE conversation_participants SET role = 'admin' WHERE conversation_id = %s AND user_id = %s",
+                        (conversation_id, current_user_id))
+            roles[me['uid']] = 'admin'
+        conn.commit()
+    cache.invalidate_conversation(conversation_id, [target_id, current_user_id])
+
+    broadcast_members_event(conversation_id, roles=roles)
+    return jsonify({'conversationId': conversation_id, 'roles': roles})
+
+@api_bp.route('/conversations/<int:conversation_id>/read', methods=['POST'])
+@token_required
+def mark_conversation_read(current_user_id, conversation_id):
+    # Moves the caller's read cursor to the newest change in the conversation.
+    # The cursor only moves forward, so a stale tab can't un-read messages.
+    with connection() as conn, conn.cursor() as cur:
+        if not cache.is_member(conversation_id, current_user_id, cur, fresh=True):
+            return jsonify({'message': 'Unauthorized'}), 403
+
+        cur.execute("""
+            UPDATE conversation_participants p
+            SET read_count = c.message_count, last_read_seq = c.seq, last_read_at = CURRENT_TIMESTAMP
+            FROM conversations c
+            WHERE c.id = p.conversation_id AND p.conversation_id = %s AND p.user_id = %s
+              AND p.last_read_seq < c.seq
+            RETURNING p.last_read_seq, p.last_read_at
+        """, (conversation_id, current_user_id))
+        row = cur.fetchone()
+        inbox.mark_read(cur, [conversation_id], current_user_id)
+        conn.commit()
+        moved = row is not None
+        if not moved:
+            cur.execute(
+                "SELECT last_read_seq, last_read_at FROM conversation_participants WHERE conversation_id = %s AND user_id = %s",
+                (conversation_id, current_user_id)
+            )
+            row = cur.fetchone()
+
+    last_read_seq, last_read_at = row
+    read_at = last_read_at.isoformat() if last_read_at else None
+    if moved:
+        presence.read(rooms.conversation_room(conversation_id), current_user_id, last_read_seq, read_at)
+    return jsonify({'conversationId': conversation_id, 'lastReadSeq': last_read_seq, 'readAt': read_at, 'unreadCount': 0})
+
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 100))
+MAX_BATCH_PAGE_SIZE = 50
+
+
+def batch_ids(values):
+    # Distinct ids in request order, or None when the list is missing,
+    # malformed or longer than MAX_BATCH_SIZE.
+    if not isinstance(values, list) or not values or len(values) > MAX_BATCH_SIZE:
+        return None
     try:
-        cur.execute("DELETE FROM messages WHERE conversation_id = %s", (conversation_id,))
-        cur.execute("DELETE FROM conversation_participants WHERE conversation_id = %s", (conversation_id,))
-        cur.execute("DELETE FROM conversations WHERE id = %s", (conversation_id,))
-        
+        return list(dict.fromkeys(int(value) for value in values))
+    except (TypeError, ValueError):
+        return None
+
+@api_bp.route('/conversations/batch', methods=['POST'])
+@token_required
+def get_conversations_batch(current_user_id):
+    # GET /conversations/<id> plus the latest page of GET /messages/<id> for
+    # several conversations, in three queries however many are asked for.
+    # Conversations the caller isn't in come back under errors.
+    data = request.get_json() or {}
+    conversation_ids = batch_ids(data.get('conversationIds'))
+    if conversation_ids is None:
+        return jsonify({'message': f'conversationIds must list 1 to {MAX_BATCH_SIZE} ids'}), 400
+    try:
+        limit = int(data.get('limit', DEFAULT_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Invalid pagination parameters'}), 400
+    limit = max(0, min(limit, MAX_BATCH_PAGE_SIZE))
+
+    messages = {}
+    members = {}
+    read_cursors = {}
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.id, c.last_message, c.kind, c.name, c.member_count, c.seq, p.role
+            FROM conversations c
+            JOIN conversation_participants p ON p.conversation_id = c.id AND p.user_id = %s
+            WHERE c.id = ANY(%s)
+        """, (current_user_id, conversation_ids))
+        conversations = {row[0]: row for row in cur.fetchall()}
+        found = list(conversations)
+
+        if found and limit:
+            # The newest limit + 1 messages of each conversation, one index
+            # scan apiece, as the latest page of GET /messages/<id> reads them.
+            cur.execute(f"""
+                SELECT {MESSAGE_COLUMNS}, c.id
+                FROM unnest(%s::integer[]) AS c(id)
+                CROSS JOIN LATERAL (
+                    SELECT * FROM messages m
+                    WHERE m.conversation_id = c.id
+                    ORDER BY m.id DESC
+                    LIMIT %s
+                ) m
+                JOIN users u ON m.sender_id = u.id
+            """, (found, limit + 1))
+            for row in cur.fetchall():
+                messages.setdefault(row[11], []).append(row)
+
+        if found:
+            # Every member of small rooms and the first LARGE_ROOM_SIZE of
+            # large ones, plus the caller.
+            cur.execute("""
+                SELECT c.id, p.user_id, p.last_read_seq
+                FROM unnest(%s::integer[]) AS c(id)
+                CROSS JOIN LATERAL (
+                    SELECT user_id, last_read_seq FROM conversation_participants p
+                    WHERE p.conversation_id = c.id
+                    ORDER BY p.user_id
+                    LIMIT %s
+                ) p
+                UNION
+                SELECT conversation_id, user_id, last_read_seq FROM conversation_participants
+                WHERE user_id = %s AND conversation_id = ANY(%s)
+            """, (found, inbox.LARGE_ROOM_SIZE, current_user_id, found))
+            for cid, user_id, last_read_seq in cur.fetchall():
+                members.setdefault(cid, set()).add(user_id)
+                read_cursors[(cid, user_id)] = last_read_seq
+        member_ids = set().union(*members.values())
+        profiles = cache.get_profiles(member_ids, cur)
+
+    statuses = presence.statuses(member_ids)
+    results = []
+    errors = []
+    for cid in conversation_ids:
+        conv = conversations.get(cid)
+        if not conv:
+            errors.append({'conversationId': cid, 'message': 'Unauthorized'})
+            continue
+        rows = sorted(messages.get(cid, []), key=lambda row: row[0], reverse=True)
+        page = rows[:limit]
+        page.reverse()
+        user_ids = sorted(u for u in members.get(cid, ()) if u in profiles)
+        results.append({
+            'conversationId': cid,
+            'lastMessage': conv[1],
+            'kind': conv[2],
+            'name': conv[3],
+            'memberCount': conv[4],
+            'role': conv[6],
+            'users': [profiles[u]['uid'] for u in user_ids],
+            'participants': [cache.public_profile(profiles[u]) for u in user_ids],
+            'readCursors': {profiles[u]['uid']: read_cursors[(cid, u)] for u in user_ids},
+            'presence': {profiles[u]['uid']: statuses[u] for u in user_ids},
+            'messages': [serialize_message(row) for row in page],
+            'hasMore': len(rows) > limit,
+            'cursor': conv[5]
+        })
+
+    return jsonify({'conversations': results, 'errors': errors})
+
+@api_bp.route('/conversations/read', methods=['POST'])
+@token_required
+def mark_conversations_read(current_user_id):
+    # POST /conversations/<id>/read for several conversations in one UPDATE.
+    data = request.get_json() or {}
+    conversation_ids = batch_ids(data.get('conversationIds'))
+    if conversation_ids is None:
+        return jsonify({'message': f'conversationIds must list 1 to {MAX_BATCH_SIZE} ids'}), 400
+
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE conversation_participants p
+            SET read_count = c.message_count, last_read_seq = c.seq, last_read_at = CURRENT_TIMESTAMP
+            FROM conversations c
+            WHERE c.id = p.conversation_id AND p.conversation_id = ANY(%s) AND p.user_id = %s
+              AND p.last_read_seq < c.seq
+            RETURNING p.conversation_id
+        """, (conversation_ids, current_user_id))
+        moved = {row[0] for row in cur.fetchall()}
+        inbox.mark_read(cur, conversation_ids, current_user_id)
         conn.commit()
-    except Exception as e:
-        conn.rollback()
-        return jsonify({'message': f'Failed to delete: {str(e)}'}), 500
-    finally:
-        cur.close()
-        conn.close()
+        cur.execute("""
+            SELECT conversation_id, last_read_seq, last_read_at FROM conversation_participants
+            WHERE user_id = %s AND conversation_id = ANY(%s)
+        """, (current_user_id, conversation_ids))
+        cursors = {row[0]: row[1:] for row in cur.fetchall()}
+
+    results = []
+    errors = []
+    for cid in conversation_ids:
+        if cid not in cursors:
+            errors.append({'conversationId': cid, 'message': 'Unauthorized'})
+            continue
+        last_read_seq, last_read_at = cursors[cid]
+        read_at = last_read_at.isoformat() if last_read_at else None
+        if cid in moved:
+            presence.read(rooms.conversation_room(cid), current_user_id, last_read_seq, read_at)
+        results.append({'conversationId': cid, 'lastReadSeq': last_read_seq, 'readAt': read_at, 'unreadCount': 0})
+
+    return jsonify({'conversations': results, 'errors': errors})
+
+@api_bp.route('/presence', methods=['GET'])
+@token_required
+def get_presence(current_user_id):
+    uids = [uid for uid in request.args.get('uids', '').split(',') if uid][:MAX_PAGE_SIZE]
+    profiles = cache.get_profiles_by_uid(uids)
+    statuses = presence.statuses([p['id'] for p in profiles.values()])
+    return jsonify({uid: statuses[p['id']] for uid, p in profiles.items()})
+
+@api_bp.route('/conversations/<int:conversation_id>', methods=['DELETE'])
+@token_required
+def delete_conversation(current_user_id, conversation_id):
+    with connection() as conn, conn.cursor() as cur:
+        role = cache.get_role(conversation_id, current_user_id, cur, fresh=True)
+        if not role:
+            return jsonify({'message': 'Unauthorized'}), 403
+        # Anyone in a 1-on-1 may delete it; a group only by its owner (the
+        # others leave instead).
+        conversation = cache.get_conversation(conversation_id, cur)
+        if conversation and conversation['kind'] == 'group' and role != 'owner':
+            return jsonify({'message': 'Unauthorized'}), 403
+
+        try:
+            cur.execute("DELETE FROM messages WHERE conversation_id = %s", (conversation_id,))
+            cur.execute("DELETE FROM conversation_participants WHERE conversation_id = %s RETURNING user_id", (conversation_id,))
+            member_ids = [row[0] for row in cur.fetchall()]
+            cur.execute("DELETE FROM conversations WHERE id = %s", (conversation_id,))
+            
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            return jsonify({'message': f'Failed to delete: {str(e)}'}), 500
+    cache.invalidate_conversation(conversation_id, member_ids)
 
     return jsonify({'message': 'Conversation deleted successfully'}), 200
+
+
+MESSAGE_COLUMNS = "m.id, m.sender_id, m.content, m.type, m.created_at, u.uid, m.reply_to, m.reactions, m.is_deleted, m.file_meta, m.seq"
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# What clients send; 'removed' is only ever produced by the server.
+MESSAGE_TYPES = ('text', 'image', 'file', 'sticker')
+
+
+def serialize_message(msg):
+    return {
+        'id': msg[0],
+        'senderId': msg[5],
+        'content': msg[2],
+        'type': msg[8] and 'removed' or msg[3],
+        'createdAt': msg[4].isoformat(),
+        'replyTo': msg[6],
+        'reactions': msg[7],
+        'file': msg[9],
+        'isDeleted': msg[8],
+        'seq': msg[10]
+    }
+
+
+def int_arg(name):
+    value = request.args.get(name)
+    return int(value) if value not in (None, '') else None
+
+
+def next_conversation_seq(cur, conversation_id):
+    # Takes the conversation row lock, so seq values become visible in commit order.
+    cur.execute("UPDATE conversations SET seq = seq + 1 WHERE id = %s RETURNING seq", (conversation_id,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def broadcast_message_event(event, conversation_id, message):
+    # Clients apply the payload directly when seq is exactly one past the last
+    # seq they hold, and fall back to GET /messages/<id>?since=<seq> on a gap.
+    # Nobody has the conversation open: skip serializing and publishing.
+    if not rooms.has_listeners(conversation_id):
+        return
+    socketio.emit(event, {
+        'conversationId': conversation_id,
+        'seq': message['seq'],
+        'message': message
+    }, to=str(conversation_id))
+
+
 @api_bp.route('/messages/<int:conversation_id>', methods=['GET'])
 @token_required
 def get_messages(current_user_id, conversation_id):
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'message': 'Database connection failed'}), 500
-    cur = conn.cursor()
-    
+    paged = any(key in request.args for key in ('before', 'after', 'since', 'limit'))
+
+    try:
+        before = int_arg('before')
+        after = int_arg('after')
+        since = int_arg('since')
+        limit = int_arg('limit') or DEFAULT_PAGE_SIZE
+    except ValueError:
+        return jsonify({'message': 'Invalid pagination parameters'}), 400
+    if sum(v is not None for v in (before, after, since)) > 1:
+        return jsonify({'message': 'Use only one of before, after or since'}), 400
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.seq FROM conversations c
+            JOIN conversation_participants cp ON cp.conversation_id = c.id
+            WHERE c.id = %s AND cp.user_id = %s
+        """, (conversation_id, current_user_id))
+        membership = cur.fetchone()
+        if not membership:
+            return jsonify({'message': 'Unauthorized'}), 403
+        conversation_seq = membership[0]
+
+        if not paged:
+            cur.execute(f"""
+                SELECT {MESSAGE_COLUMNS}
+                FROM messages m
+                JOIN users u ON m.sender_id = u.id
+                WHERE m.conversation_id = %s
+                ORDER BY m.id ASC
+            """, (conversation_id,))
+            messages = cur.fetchall()
+            return jsonify([serialize_message(msg) for msg in messages])
+
+        # Fetch one extra row to learn whether another page exists. messages is
+        # partitioned on id, so the id bounds below also skip partitions outside
+        # the page, and the latest page reads partitions newest first and stops
+        # at the LIMIT. seq changes on edits, so ?since= can't be narrowed that way.
+        if since is not None:
+            cur.execute(f"""
+                SELECT {MESSAGE_COLUMNS}
+                FROM messages m
+                JOIN users u ON m.sender_id = u.id
+                WHERE m.conversation_id = %s AND m.seq > %s
+                ORDER BY m.seq ASC
+                LIMIT %s
+            """, (conversation_id, since, limit + 1))
+        elif after is not None:
+            cur.execute(f"""
+                SELECT {MESSAGE_COLUMNS}
+                FROM messages m
+                JOIN users u ON m.sender_id = u.id
+                WHERE m.conversation_id = %s AND m.id > %s
+                ORDER BY m.id ASC
+                LIMIT %s
+            """, (conversation_id, after, limit + 1))
+        else:
+            cur.execute(f"""
+                SELECT {MESSAGE_COLUMNS}
+                FROM messages m
+                JOIN users u ON m.sender_id = u.id
+                WHERE m.conversation_id = %s AND (%s::integer IS NULL OR m.id < %s)
+                ORDER BY m.id DESC
+                LIMIT %s
+            """, (conversation_id, before, before, limit + 1))
+        messages = cur.fetchall()
+
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if since is None and after is None:
+        messages.reverse()
+
+    if since is not None:
+        # Delta mode: the cursor is the seq of the last change returned, so the
+        # client can keep calling ?since=<cursor> until hasMore is false.
+        cursor = messages[-1][10] if messages else max(since, conversation_seq)
+    else:
+        cursor = conversation_seq
+
+    return jsonify({
+        'messages': [serialize_message(msg) for msg in messages],
+        'hasMore': has_more,
+        'cursor': cursor
+    })
+
+
+@api_bp.route('/messages/search', methods=['GET'])
+@token_required
+def search_messages(current_user_id):
+    text = request.args.get('q', '').strip()[:search.MAX_MESSAGE_SEARCH_QUERY]
+    sort = request.args.get('sort', 'recent')
+    if not text:
+        return jsonify({'message': 'Search query is required'}), 400
+    if sort not in ('recent', 'relevance'):
+        return jsonify({'message': 'sort must be recent or relevance'}), 400
+
+    try:
+        cursor = search.parse_cursor(request.args.get('cursor'), sort)
+        limit = int_arg('limit') or search.MESSAGE_SEARCH_PAGE_SIZE
+        conversation_id = int_arg('conversationId')
+    except ValueError:
+        return jsonify({'message': 'Invalid pagination parameters'}), 400
+    limit = max(1, min(limit, search.MAX_MESSAGE_SEARCH_PAGE_SIZE))
+
+    rows = []
+    next_cursor = None
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT conversation_id FROM conversation_participants WHERE user_id = %s", (current_user_id,))
+        conversation_ids = [row[0] for row in cur.fetchall()]
+        if conversation_id is not None:
+            if conversation_id not in conversation_ids:
+                return jsonify({'message': 'Unauthorized'}), 403
+            conversation_ids = [conversation_id]
+
+        query = search.parse_query(cur, text) if conversation_ids else None
+        if query:
+            page, next_cursor = search.search(cur, conversation_ids, query, cursor, limit, sort)
+            if page:
+                # Rank and snippet only for the rows on the page; ts_headline
+                # re-parses the content, so it is the expensive part.
+                cur.execute(f"""
+                    SELECT {MESSAGE_COLUMNS}, m.conversation_id,
+                           ts_rank_cd(m.search_vector, %s::tsquery),
+                           ts_headline(%s::regconfig, m.content, %s::tsquery, %s)
+                    FROM messages m
+                    JOIN users u ON m.sender_id = u.id
+                    WHERE m.id = ANY(%s)
+                """, (query, search.SEARCH_CONFIG, query, search.HEADLINE_OPTIONS, [row[0] for row in page]))
+                by_id = {row[0]: row for row in cur.fetchall()}
+                rows = [by_id[message_id] for message_id, rank in page if message_id in by_id]
+
+    return jsonify({
+        'results': [{
+            'conversationId': row[11],
+            'rank': row[12],
+            'snippet': search.highlight(row[13]),
+            'message': serialize_message(row)
+        } for row in rows],
+        'nextCursor': next_cursor
+    })
 
-    cur.execute("SELECT 1 FROM conversation_participants WHERE conversation_id = %s AND user_id = %s", (conversation_id, current_user_id))
-    if not cur.fetchone():
+
+def publish_written_message(item, row):
+    # Called by the writer once the batch holding the message has committed.
+    sender = cache.get_profile(row[1])
+    message = serialize_message(row[:5] + (sender['uid'] if sender else None,) + row[5:])
+    presence.set_typing(rooms.conversation_room(item.conversation_id), item.sender_id, False)
+    broadcast_message_event('new-message', item.conversation_id, message)
+    return message
+
+
+message_writer = MessageWriter(on_commit=publish_written_message)
+
+
+def send_message_via_writer(current_user_id, conversation_id, content, msg_type, reply_to, file_meta):
+    if not cache.is_member(conversation_id, current_user_id, fresh=True):
         return jsonify({'message': 'Unauthorized'}), 403
+    if file_meta:
+        with connection() as conn, conn.cursor() as cur:
+            file_meta = media.attach(cur, content, file_meta)
+    try:
+        item = message_writer.submit(conversation_id, current_user_id, content, msg_type, reply_to, file_meta)
+    except QueueFull:
+        response = jsonify({'message': 'Too many messages in flight, retry shortly'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+
+    if message_writer.mode == 'enqueue':
+        # Written and broadcast with the next batch; id and seq are assigned then.
+        sender = cache.get_profile(current_user_id)
+        return jsonify({'status': 'queued', 'message': {
+            'id': None,
+            'senderId': sender['uid'] if sender else None,
+            'content': content,
+            'type': msg_type,
+            'createdAt': datetime.datetime.utcnow().isoformat(),
+            'replyTo': reply_to,
+            'reactions': None,
+            'file': file_meta,
+            'isDeleted': False,
+            'seq': None
+        }}), 202
 
-    cur.execute("""
-        SELECT m.id, m.sender_id, m.content, m.type, m.created_at, u.uid, m.reply_to, m.reactions, m.is_deleted, m.file_meta
-        FROM messages m
-        JOIN users u ON m.sender_id = u.id
-        WHERE m.conversation_id = %s
-        ORDER BY m.created_at ASC
-    """, (conversation_id,))
-    
-    messages = cur.fetchall()
-    result = []
-    for msg in messages:
-        result.append({
-            'id': msg[0],
-            'senderId': msg[5],
-            'content': msg[2],
-            'type': msg[8] and 'removed' or msg[3],
-            'createdAt': msg[4].isoformat(),
-            'replyTo': msg[6],
-            'reactions': msg[7],
-            'file': msg[9],
-            'isDeleted': msg[8]
-        })
-    cur.close()
-    conn.close()
-    return jsonify(result)
+    try:
+        message = message_writer.wait(item)
+    except WriteFailed as e:
+        metrics.log(f"Message write failed: {e}")
+        return jsonify({'message': 'Failed to send message'}), 500
+    return jsonify({'status': 'sent', 'message': message}), 201
 
 @api_bp.route('/messages', methods=['POST'])
 @token_required
 def send_message(current_user_id):
     data = request.get_json()
-    conversation_id = data.get('conversationId')
+    try:
+        conversation_id = int(data.get('conversationId'))
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Invalid conversation id'}), 400
     content = data.get('content')
     msg_type = data.get('type', 'text')
 
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'message': 'Database connection failed'}), 500
-    cur = conn.cursor()
-
     reply_to = data.get('replyTo')
     file_meta = data.get('file', None)
 
+    if message_writer.enabled:
+        return send_message_via_writer(current_user_id, conversation_id, content, msg_type, reply_to, file_meta)
 
-    cur.execute(
-        "INSERT INTO messages (conversation_id, sender_id, content, type, reply_to, file_meta) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
-        (conversation_id, current_user_id, content, msg_type, reply_to, Json(file_meta) if file_meta else None)
-    )
-    
-
-    cur.execute("UPDATE conversations SET last_message = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (content, conversation_id))
+    with connection() as conn, conn.cursor() as cur:
+        if not cache.is_member(conversation_id, current_user_id, cur, fresh=True):
+            return jsonify({'message': 'Unauthorized'}), 403
+        if file_meta:
+            file_meta = media.attach(cur, content, file_meta)
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        # The message id is drawn here so the conversation row (what large
+        # rooms show in the inbox) is written once per send.
+        cur.execute("""
+            UPDATE conversations
+            SET last_message = %s, updated_at = CURRENT_TIMESTAMP, seq = seq + 1, message_count = message_count + 1,
+                last_message_id = nextval(pg_get_serial_sequence('messages', 'id')),
+                last_sender_id = %s, last_message_type = %s
+            WHERE id = %s
+            RETURNING seq, message_count, last_message_id
+        """, (content, current_user_id, msg_type, conversation_id))
+        row = cur.fetchone()
+        if not row:
+            return jsonify({'message': 'Conversation not found'}), 404
+        seq, message_count, message_id = row
+
+        # The sender has read everything up to their own message.
+        cur.execute(f"""
+            WITH m AS (
+                INSERT INTO messages (id, conversation_id, sender_id, content, type, reply_to, file_meta, seq)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING *
+            ), r AS (
+                UPDATE conversation_participants
+                SET read_count = %s, last_read_seq = %s, last_read_at = CURRENT_TIMESTAMP
+                WHERE conversation_id = %s AND user_id = %s
+            )
+            SELECT {MESSAGE_COLUMNS} FROM m JOIN users u ON m.sender_id = u.id
+        """, (message_id, conversation_id, current_user_id, content, msg_type, reply_to,
+              Json(file_meta) if file_meta else None, seq, message_count, seq, conversation_id, current_user_id))
+        message = serialize_message(cur.fetchone())
+        inbox.record_messages(cur, [(conversation_id, 1, message_id, content, msg_type, current_user_id,
+                                     {current_user_id: 0})])
 
+        conn.commit()
 
-    socketio.emit('new-message', {'conversationId': conversation_id}, to=str(conversation_id))
+    presence.set_typing(rooms.conversation_room(conversation_id), current_user_id, False)
+    broadcast_message_event('new-message', conversation_id, message)
 
-    return jsonify({'status': 'sent'}), 201
+    return jsonify({'status': 'sent', 'message': message}), 201
 
+@api_bp.route('/messages/batch', methods=['POST'])
+@token_required
+def send_messages_batch(current_user_id):
+    # Several sends, to one or more conversations, written as one writer
+    # batch in the request whatever MESSAGE_WRITE_MODE is. Results are per
+    # item in request order, echoing clientId; a rejected or failed item
+    # doesn't hold back the others.
+    data = request.get_json() or {}
+    entries = data.get('messages')
+    if not isinstance(entries, list) or not entries or len(entries) > MAX_BATCH_SIZE:
+        return jsonify({'message': f'messages must list 1 to {MAX_BATCH_SIZE} messages'}), 400
+    for index, entry in enumerate(entries):
+        if isinstance(entry, dict) and (not isinstance(entry.get('content'), str)
+                                        or entry.get('type', 'text') not in MESSAGE_TYPES):
+            return jsonify({'message': f"messages[{index}] needs string content and a type out of "
+                                       f"{', '.join(MESSAGE_TYPES)}"}), 400
+
+    results = []
+    accepted = []
+    for index, entry in enumerate(entries):
+        entry = entry if isinstance(entry, dict) else {}
+        results.append({'index': index, 'clientId': entry.get('clientId')})
+        try:
+            accepted.append((index, int(entry.get('conversationId')), entry))
+        except (TypeError, ValueError):
+            results[index].update(status='error', error='Invalid conversation id')
+
+    items = []
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT conversation_id FROM conversation_participants WHERE user_id = %s AND conversation_id = ANY(%s)",
+                    (current_user_id, list({cid for index, cid, entry in accepted})))
+        member_of = {row[0] for row in cur.fetchall()}
+        for index, cid, entry in accepted:
+            if cid not in member_of:
+                results[index].update(status='error', error='Unauthorized')
+        accepted = [item for item in accepted if item[1] in member_of]
+        files = media.attach_many(cur, [(entry.get('content'), entry.get('file')) for index, cid, entry in accepted])
+
+    for (index, cid, entry), file_meta in zip(accepted, files):
+        item = PendingMessage(cid, current_user_id, entry.get('content'),
+                              entry.get('type', 'text'), entry.get('replyTo'), file_meta)
+        items.append((index, item))
+    if items:
+        message_writer.write([item for index, item in items])
+
+    for index, item in items:
+        if item.error:
+            results[index].update(status='error', error='Failed to send message')
+        else:
+            results[index].update(status='sent', message=item.result)
+    return jsonify({'results': results})
 
 @api_bp.route('/upload', methods=['POST'])
-def upload_file():
+@token_required
+def upload_file(current_user_id):
     if 'file' not in request.files:
         return jsonify({'message': 'No file part'}), 400
     file = request.files['file']
     if file.filename == '':
         return jsonify({'message': 'No selected file'}), 400
-    
-    if file:
-        filename = secure_filename(file.filename)
-
-        import uuid
-        ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
-        new_filename = f"{uuid.uuid4()}.{ext}"
-        save_path = os.path.join(os.getcwd(), 'uploads', new_filename)
-        file.save(save_path)
-        
 
+    upload = uploads.spool_stream(file.stream)
+    upload['filename'] = secure_filename(file.filename)
+    try:
+        sha256 = uploads.verify_upload(upload)
+        with connection() as conn, conn.cursor() as cur:
+            uploads.register_spooled(cur, current_user_id, upload)
+            result = uploads.complete_upload(cur, upload, sha256)
+            conn.commit()
+    except Exception:
+        uploads.discard_partial(upload['id'])
+        raise
+
+    media.schedule(result['url'])
+    return jsonify({'url': result['url']})
+
+# Resumable uploads: POST /uploads to start, PUT /uploads/<id>?offset=N with the
+# raw chunk as the body, GET /uploads/<id> to find where to resume, then
+# POST /uploads/<id>/complete to verify the hash and publish the file.
+@api_bp.route('/uploads', methods=['POST'])
+@token_required
+def start_upload(current_user_id):
+    data = request.get_json() or {}
+    with connection() as conn, conn.cursor() as cur:
+        result = uploads.start_upload(cur, current_user_id, data.get('filename'), data.get('size'), data.get('sha256'))
+        conn.commit()
+    return jsonify(result), 200 if result['complete'] else 201
+
+@api_bp.route('/uploads/<upload_id>', methods=['GET'])
+@token_required
+def get_upload_status(current_user_id, upload_id):
+    with connection() as conn, conn.cursor() as cur:
+        upload = uploads.get_upload(cur, upload_id, current_user_id)
+    return jsonify(uploads.upload_status(upload))
+
+@api_bp.route('/uploads/<upload_id>', methods=['PUT'])
+@token_required
+def append_upload_chunk(current_user_id, upload_id):
+    try:
+        offset = int_arg('offset')
+    except ValueError:
+        offset = None
+    if offset is None:
+        return jsonify({'message': 'offset is required'}), 400
 
-        return jsonify({'url': f"/uploads/{new_filename}"})
+    with connection() as conn, conn.cursor() as cur:
+        upload = uploads.get_upload(cur, upload_id, current_user_id)
 
-    return jsonify({'message': 'Upload failed'}), 500
+    new_offset = uploads.write_chunk(upload, offset, request.stream, request.content_length)
 
-@api_bp.route('/messages/<int:message_id>', methods=['DELETE'])
+    with connection() as conn, conn.cursor() as cur:
+        uploads.record_chunk(cur, upload, new_offset)
+        conn.commit()
+
+    return jsonify({'uploadId': upload_id, 'offset': new_offset, 'size': upload['size']})
+
+@api_bp.route('/uploads/<upload_id>/complete', methods=['POST'])
 @token_required
-def delete_message(current_user_id, message_id):
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'message': 'Database connection failed'}), 500
-    cur = conn.cursor()
-    
+def complete_upload(current_user_id, upload_id):
+    data = request.get_json(silent=True) or {}
+    with connection() as conn, conn.cursor() as cur:
+        upload = uploads.get_upload(cur, upload_id, current_user_id)
+        if upload['status'] == 'complete':
+            return jsonify(uploads.completed_upload(cur, upload))
 
-    cur.execute("SELECT sender_id FROM messages WHERE id = %s", (message_id,))
-    msg = cur.fetchone()
-    if not msg:
-        return jsonify({'message': 'Message not found'}), 404
-        
-    if msg[0] != current_user_id:
+    sha256 = uploads.verify_upload(upload, data.get('sha256'))
 
-        return jsonify({'message': 'Unauthorized'}), 403
+    with connection() as conn, conn.cursor() as cur:
+        result = uploads.complete_upload(cur, upload, sha256)
+        conn.commit()
+    media.schedule(result['url'])
+    return jsonify(result)
 
+# Short-lived direct URL for an attachment, so the bytes don't go through
+# Flask. Falls back to the /uploads/ URL when the backend can't sign.
+@api_bp.route('/files/<name>/url', methods=['GET'])
+@token_required
+def get_file_url(current_user_id, name):
+    if name.startswith('.') or not storage.exists(name):
+        return jsonify({'message': 'File not found'}), 404
+    url = storage.signed_url(name)
+    if url is None:
+        return jsonify({'url': uploads.blob_url(name), 'expiresAt': None})
+    expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=SIGNED_URL_TTL)
+    return jsonify({'url': url, 'expiresAt': expires_at.isoformat() + 'Z'})
+
+@media.on_ready
+def attach_media_to_messages(url, meta):
+    # Messages sent while their attachment was still being processed get the
+    # metadata now, as a regular change so clients pick it up via seq.
+    updated = []
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT id, conversation_id FROM messages
+            WHERE md5(content) = md5(%s) AND content = %s AND file_meta IS NOT NULL AND NOT file_meta ? 'processed'
+            """,
+            (url, url)
+        )
+        found = cur.fetchall()
+        # All conversation rows up front and in id order, as the writer takes
+        # them, so the two can't deadlock on a popular attachment.
+        cur.execute("SELECT id FROM conversations WHERE id = ANY(%s) ORDER BY id FOR UPDATE",
+                    (sorted({conversation_id for message_id, conversation_id in found}),))
+        for message_id, conversation_id in found:
+            seq = next_conversation_seq(cur, conversation_id)
+            cur.execute(f"""
+                UPDATE messages m SET file_meta = m.file_meta || %s, seq = %s
+                FROM users u
+                WHERE m.id = %s AND u.id = m.sender_id
+                RETURNING {MESSAGE_COLUMNS}
+            """, (Json(meta), seq, message_id))
+            updated.append((conversation_id, serialize_message(cur.fetchone())))
+        conn.commit()
+    for conversation_id, message in updated:
+        broadcast_message_event('message-updated', conversation_id, message)
 
-    cur.execute("UPDATE messages SET is_deleted = TRUE WHERE id = %s", (message_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+@api_bp.route('/messages/<int:message_id>', methods=['DELETE'])
+@token_required
+def delete_message(current_user_id, message_id):
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT sender_id, conversation_id, is_deleted FROM messages WHERE id = %s", (message_id,))
+        msg = cur.fetchone()
+        if not msg:
+            return jsonify({'message': 'Message not found'}), 404
+            
+        if msg[0] != current_user_id:
+            return jsonify({'message': 'Unauthorized'}), 403
+        # Deleting twice changes nothing, so it doesn't cost clients a seq either.
+        if msg[2]:
+            return jsonify({'status': 'deleted'}), 200
+
+        seq = next_conversation_seq(cur, msg[1])
+        cur.execute(f"""
+            UPDATE messages m SET is_deleted = TRUE, deleted_at = CURRENT_TIMESTAMP, seq = %s
+            FROM users u
+            WHERE m.id = %s AND u.id = m.sender_id AND NOT m.is_deleted
+            RETURNING {MESSAGE_COLUMNS}
+        """, (seq, message_id))
+        row = cur.fetchone()
+        if not row:
+            # A concurrent delete got the conversation lock first.
+            conn.rollback()
+            return jsonify({'status': 'deleted'}), 200
+        message = serialize_message(row)
+        inbox.message_removed(cur, msg[1], message_id)
+        conn.commit()
+
+    broadcast_message_event('message-updated', msg[1], message)
     
     return jsonify({'status': 'deleted'}), 200
 
@@ -582,39 +1468,115 @@ def toggle_reaction(current_user_id, message_id):
     data = request.get_json()
     reaction = data.get('reaction')
     
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'message': 'Database connection failed'}), 500
-    cur = conn.cursor()
-    
-
-    cur.execute("SELECT uid FROM users WHERE id = %s", (current_user_id,))
-    user_uid = cur.fetchone()[0]
-
+    with connection() as conn, conn.cursor() as cur:
+        user_uid = cache.get_profile(current_user_id, cur)['uid']
+
+        # One statement: the membership check, the conversation seq bump and the
+        # JSONB toggle all happen in SQL. Concurrent reactions to the same message
+        # are re-evaluated against the latest row version, so none are lost.
+        cur.execute(f"""
+            WITH target AS (
+                SELECT m.id, m.conversation_id
+                FROM messages m
+                JOIN conversation_participants cp
+                  ON cp.conversation_id = m.conversation_id AND cp.user_id = %(user_id)s
+                WHERE m.id = %(message_id)s
+            ),
+            bump AS (
+                UPDATE conversations c SET seq = c.seq + 1
+                FROM target t
+                WHERE c.id = t.conversation_id
+                RETURNING c.seq
+            )
+            UPDATE messages m SET
+                reactions = CASE
+                    WHEN %(reaction)s::text IS NULL OR m.reactions ->> %(uid)s = %(reaction)s
+                        THEN COALESCE(m.reactions, '{{}}'::jsonb) - %(uid)s
+                    ELSE COALESCE(m.reactions, '{{}}'::jsonb) || jsonb_build_object(%(uid)s, %(reaction)s::text)
+                END,
+                seq = bump.seq
+            FROM bump, users u
+            WHERE m.id = %(message_id)s AND u.id = m.sender_id
+            RETURNING {MESSAGE_COLUMNS}, m.conversation_id
+        """, {'user_id': current_user_id, 'message_id': message_id, 'uid': user_uid, 'reaction': reaction})
+        row = cur.fetchone()
+        if not row:
+            return jsonify({'message': 'Message not found'}), 404
+        conn.commit()
 
-    cur.execute("SELECT reactions FROM messages WHERE id = %s", (message_id,))
-    res = cur.fetchone()
-    if not res:
-        return jsonify({'message': 'Message not found'}), 404
+    message = serialize_message(row)
+    broadcast_message_event('message-updated', row[-1], message)
     
-    current_reactions = res[0] or {}
-    
-
+    return jsonify({'status': 'updated', 'reactions': message['reactions'], 'message': message}), 200
 
+@api_bp.route('/messages/reactions/batch', methods=['POST'])
+@token_required
+def toggle_reactions_batch(current_user_id):
+    # POST /messages/<id>/reactions for several messages in one statement;
+    # the last entry for a message wins. Each conversation's seq moves once
+    # by the number of its messages changed, which get consecutive seqs.
+    data = request.get_json() or {}
+    entries = data.get('reactions')
+    if not isinstance(entries, list) or not entries or len(entries) > MAX_BATCH_SIZE:
+        return jsonify({'message': f'reactions must list 1 to {MAX_BATCH_SIZE} reactions'}), 400
+    reactions = {}
+    try:
+        for entry in entries:
+            reactions[int(entry['messageId'])] = entry.get('reaction')
+    except (TypeError, ValueError, KeyError):
+        return jsonify({'message': 'Invalid message id'}), 400
 
+    with connection() as conn, conn.cursor() as cur:
+        user_uid = cache.get_profile(current_user_id, cur)['uid']
 
+        # Conversation rows are locked in id order first, as the writer does,
+        # so a batch spanning conversations can't deadlock with a send.
+        cur.execute("""
+            SELECT c.id FROM conversations c
+            WHERE c.id IN (SELECT m.conversation_id FROM messages m WHERE m.id = ANY(%s))
+            ORDER BY c.id
+            FOR UPDATE
+        """, (list(reactions),))
+        cur.execute(f"""
+            WITH target AS (
+                SELECT m.id, m.conversation_id, v.reaction,
+                       row_number() OVER (PARTITION BY m.conversation_id ORDER BY m.id) AS k
+                FROM unnest(%(message_ids)s::bigint[], %(reactions)s::text[]) AS v(message_id, reaction)
+                JOIN messages m ON m.id = v.message_id
+                JOIN conversation_participants cp
+                  ON cp.conversation_id = m.conversation_id AND cp.user_id = %(user_id)s
+            ),
+            bump AS (
+                UPDATE conversations c SET seq = c.seq + t.n
+                FROM (SELECT conversation_id, COUNT(*) AS n FROM target GROUP BY conversation_id) t
+                WHERE c.id = t.conversation_id
+                RETURNING c.id, c.seq - t.n AS base
+            )
+            UPDATE messages m SET
+                reactions = CASE
+                    WHEN t.reaction IS NULL OR m.reactions ->> %(uid)s = t.reaction
+                        THEN COALESCE(m.reactions, '{{}}'::jsonb) - %(uid)s
+                    ELSE COALESCE(m.reactions, '{{}}'::jsonb) || jsonb_build_object(%(uid)s, t.reaction)
+                END,
+                seq = bump.base + t.k
+            FROM target t, bump, users u
+            WHERE m.id = t.id AND bump.id = t.conversation_id AND u.id = m.sender_id
+            RETURNING {MESSAGE_COLUMNS}, m.conversation_id
+        """, {'user_id': current_user_id, 'uid': user_uid,
+              'message_ids': list(reactions), 'reactions': list(reactions.values())})
+        rows = {row[0]: row for row in cur.fetchall()}
+        conn.commit()
 
+    messages = {message_id: serialize_message(row) for message_id, row in rows.items()}
+    for row in sorted(rows.values(), key=lambda row: row[10]):
+        broadcast_message_event('message-updated', row[-1], messages[row[0]])
 
+    results = []
+    for message_id in reactions:
+        message = messages.get(message_id)
+        if not message:
+            results.append({'messageId': message_id, 'status': 'error', 'error': 'Message not found'})
+            continue
+        results.append({'messageId': message_id, 'status': 'updated', 'reactions': message['reactions'], 'message': message})
 
-    
-    if current_reactions.get(user_uid) == reaction:
-        del current_reactions[user_uid]
-    else:
-        current_reactions[user_uid] = reaction
-        
-    cur.execute("UPDATE messages SET reactions = %s WHERE id = %s", (Json(current_reactions), message_id))
-    conn.commit()
-    cur.close()
-    conn.close()
-    
-    return jsonify({'status': 'updated', 'reactions': current_reactions}), 200
\ No newline at end of file
+    return jsonify({'results': results})
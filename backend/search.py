@@ -0,0 +1,110 @@
+import os
+import html
+from cache import TTLCache
+import partitions
+
+# Full-text search over message content. messages.search_vector is a stored
+# generated column (migration 13), so every insert, edit and delete keeps it
+# current with no indexing job to run; deleted messages and attachments get a
+# NULL vector and drop out of the index. The GIN index covers
+# (conversation_id, search_vector), so restricting a search to the caller's
+# conversations happens inside the index, before any heap access.
+#
+# Results are read partition by partition, newest first, and the walk stops
+# once a page is full: a page of recent matches for a common word touches the
+# newest partition or two, not years of history.
+SEARCH_CONFIG = 'simple'  # must match the expression in migration 13
+MESSAGE_SEARCH_PAGE_SIZE = int(os.environ.get('MESSAGE_SEARCH_PAGE_SIZE', 20))
+MAX_MESSAGE_SEARCH_PAGE_SIZE = 50
+MAX_MESSAGE_SEARCH_QUERY = 200
+# sort=relevance ranks the newest MESSAGE_SEARCH_RANK_WINDOW matches only;
+# ranking every match of a common word would read all of them.
+RANK_WINDOW = int(os.environ.get('MESSAGE_SEARCH_RANK_WINDOW', 500))
+
+# ts_headline marks matches with control characters, which can't appear in the
+# escaped text, so the snippet can be HTML-escaped before <mark> goes in.
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_STOP = '\x03'
+HEADLINE_OPTIONS = f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxFragments=2, MaxWords=16, MinWords=6, FragmentDelimiter=" … "'
+
+_partition_cache = TTLCache(maxsize=1, ttl=60)
+
+
+def parse_query(cur, text):
+    # Returns the tsquery text, or None when nothing searchable is left
+    # (punctuation only, for example).
+    cur.execute("SELECT websearch_to_tsquery(%s::regconfig, %s)::text", (SEARCH_CONFIG, text))
+    query = cur.fetchone()[0]
+    return query or None
+
+
+def _id_ranges(cur, before):
+    # [lower, upper) id ranges to search, newest first.
+    bounds = _partition_cache.get('bounds')
+    if bounds is None:
+        bounds = [(lower, upper) for name, lower, upper, tablespace in partitions.partitions(cur)]
+        _partition_cache.set('bounds', bounds)
+    if not bounds:
+        return [(0, before)] if before is not None else [(None, None)]
+    ranges = []
+    for lower, upper in reversed(bounds):
+        if before is not None:
+            if lower >= before:
+                continue
+            upper = min(upper, before)
+        ranges.append((lower, upper))
+    return ranges
+
+
+def matching_ids(cur, conversation_ids, query, before, limit, ranked=False):
+    # Newest first: [(id, rank)], rank is None unless ranked.
+    rank = "ts_rank_cd(m.search_vector, %s::tsquery)" if ranked else "NULL::real"
+    found = []
+    for lower, upper in _id_ranges(cur, before):
+        params = ((query,) if ranked else ()) + (conversation_ids, query, lower, lower, upper, upper, limit - len(found))
+        cur.execute(f"""
+            SELECT m.id, {rank}
+            FROM messages m
+            WHERE m.conversation_id = ANY(%s) AND m.search_vector @@ %s::tsquery
+              AND (%s::bigint IS NULL OR m.id >= %s) AND (%s::bigint IS NULL OR m.id < %s)
+            ORDER BY m.id DESC
+            LIMIT %s
+        """, params)
+        found.extend(cur.fetchall())
+        if len(found) >= limit:
+            break
+    return found
+
+
+def search(cur, conversation_ids, query, cursor, limit, sort='recent'):
+    # Returns ([(id, rank)] for the page, next cursor or None). Cursors are
+    # "<id>" for sort=recent and "<rank>:<id>" for sort=relevance.
+    if sort == 'relevance':
+        window = matching_ids(cur, conversation_ids, query, None, RANK_WINDOW, ranked=True)
+        window.sort(key=lambda row: (row[1], row[0]), reverse=True)
+        if cursor is not None:
+            window = [row for row in window if (row[1], row[0]) < cursor]
+        page = window[:limit]
+        has_more = len(window) > limit
+        next_cursor = f"{page[-1][1]!r}:{page[-1][0]}" if has_more else None
+    else:
+        rows = matching_ids(cur, conversation_ids, query, cursor, limit + 1)
+        page = rows[:limit]
+        next_cursor = str(page[-1][0]) if len(rows) > limit else None
+    return page, next_cursor
+
+
+def parse_cursor(value, sort):
+    # Raises ValueError on a malformed cursor.
+    if value in (None, ''):
+        return None
+    if sort == 'relevance':
+        rank, _, message_id = value.partition(':')
+        return float(rank), int(message_id)
+    return int(value)
+
+
+def highlight(snippet):
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_STOP, '</mark>')
@@ -0,0 +1,383 @@
+import os
+import json
+import time
+import threading
+from flask_socketio import emit
+from extensions import socketio
+from fanout import SOCKETIO_MESSAGE_QUEUE, SOCKETIO_CHANNEL
+from rooms import ROOM_KEY_TTL
+
+# WebRTC signaling between the sockets of one conversation room. Offers and
+# answers are relayed as they come; trickle ICE candidates are held for
+# ICE_BATCH_WINDOW and sent as one 'signal-batch' per sender, and a call's
+# lifecycle is tracked so the room hears a single 'call-ended'. With a Redis
+# message queue the call state lives in Redis, since the offer and the answer
+# can reach different workers.
+SIGNAL_MAX_BYTES = int(os.environ.get('SIGNAL_MAX_BYTES', 64 * 1024))
+SIGNAL_RATE = float(os.environ.get('SIGNAL_RATE', 20))
+SIGNAL_BURST = float(os.environ.get('SIGNAL_BURST', 60))
+ICE_BATCH_WINDOW = float(os.environ.get('ICE_BATCH_WINDOW', 0.05))
+ICE_BATCH_MAX = int(os.environ.get('ICE_BATCH_MAX', 50))
+RING_TIMEOUT = float(os.environ.get('CALL_RING_TIMEOUT', 45))
+ENDED_CALL_TTL = 60
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, cost=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class CallStore:
+    # Per-process call state. Authoritative when every socket lives in this
+    # process; otherwise an answer can land on another worker, so ringing
+    # calls are never timed out here (expires=False).
+    def __init__(self, expires=True):
+        self.expires = expires
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def start(self, room, caller_id):
+        # Returns the new call's start time, or None if one is in progress.
+        with self._lock:
+            call = self._calls.get(room)
+            if call is not None and call['state'] != 'ended':
+                return None
+            started = str(time.time())
+            self._calls[room] = {'state': 'ringing', 'caller': caller_id, 'started': started,
+                                 'ended': None, 'reason': None}
+            return started
+
+    def answer(self, room):
+        # Returns the call's start time, or None unless it was ringing.
+        with self._lock:
+            call = self._calls.get(room)
+            if call is None or call['state'] != 'ringing':
+                return None
+            call['state'] = 'active'
+            return call['started']
+
+    def end(self, room, reason, caller_id=None, ringing_since=None):
+        # Returns the state the call was in, or None if nothing was ended.
+        # ringing_since only ends the call started then, if still ringing.
+        with self._lock:
+            call = self._calls.get(room)
+            if call is None or call['state'] == 'ended':
+                return None
+            if caller_id is not None and call['caller'] != caller_id:
+                return None
+            if ringing_since is not None and (call['state'] != 'ringing' or call['started'] != ringing_since):
+                return None
+            previous = call['state']
+            call.update(state='ended', ended=time.time(), reason=reason)
+            return previous
+
+    def get(self, room):
+        call = self._calls.get(room)
+        return {'room': room, 'state': call['state'], 'reason': call['reason']} if call else None
+
+    def sweep(self, now):
+        with self._lock:
+            for room, call in list(self._calls.items()):
+                if call['state'] == 'ended' and now - call['ended'] > ENDED_CALL_TTL:
+                    del self._calls[room]
+
+    def active(self):
+        with self._lock:
+            return sum(1 for call in self._calls.values() if call['state'] != 'ended')
+
+
+class RedisCallStore:
+    # Shared across workers, next to the room registry: the offer, the answer
+    # and the hangup of one call may each be handled by a different worker.
+    # Every transition is one Lua script, so two workers can't both start,
+    # answer or end the same call. Ended calls expire after ENDED_CALL_TTL;
+    # any call key after a day, which bounds what a crashed worker leaves.
+    expires = True
+
+    START = """
+        local state = redis.call('HGET', KEYS[1], 'state')
+        if state and state ~= 'ended' then return 0 end
+        redis.call('DEL', KEYS[1])
+        redis.call('HSET', KEYS[1], 'state', 'ringing', 'caller', ARGV[1], 'started', ARGV[2])
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        redis.call('SADD', KEYS[2], KEYS[1])
+        redis.call('EXPIRE', KEYS[2], ARGV[3])
+        return 1
+    """
+    ANSWER = """
+        if redis.call('HGET', KEYS[1], 'state') ~= 'ringing' then return false end
+        redis.call('HSET', KEYS[1], 'state', 'active')
+        return redis.call('HGET', KEYS[1], 'started')
+    """
+    END = """
+        local call = redis.call('HMGET', KEYS[1], 'state', 'caller', 'started')
+        if not call[1] or call[1] == 'ended' then return false end
+        if ARGV[4] ~= '' and call[2] ~= ARGV[4] then return false end
+        if ARGV[5] ~= '' and (call[1] ~= 'ringing' or call[3] ~= ARGV[5]) then return false end
+        redis.call('HSET', KEYS[1], 'state', 'ended', 'reason', ARGV[1], 'ended', ARGV[2])
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        redis.call('SREM', KEYS[2], KEYS[1])
+        return call[1]
+    """
+
+    def __init__(self, url, prefix=SOCKETIO_CHANNEL):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._start = self.redis.register_script(self.START)
+        self._answer = self.redis.register_script(self.ANSWER)
+        self._end = self.redis.register_script(self.END)
+
+    def _key(self, room):
+        return f'{self.prefix}:call:{room}'
+
+    def _active_key(self):
+        return f'{self.prefix}:calls'
+
+    def start(self, room, caller_id):
+        started = str(time.time())
+        if self._start(keys=[self._key(room), self._active_key()], args=[caller_id, started, ROOM_KEY_TTL]):
+            return started
+        return None
+
+    def answer(self, room):
+        started = self._answer(keys=[self._key(room)])
+        return started.decode() if started is not None else None
+
+    def end(self, room, reason, caller_id=None, ringing_since=None):
+        previous = self._end(keys=[self._key(room), self._active_key()],
+                             args=[reason, time.time(), ENDED_CALL_TTL,
+                                   '' if caller_id is None else caller_id, ringing_since or ''])
+        return previous.decode() if previous is not None else None
+
+    def get(self, room):
+        state, reason = self.redis.hmget(self._key(room), 'state', 'reason')
+        if state is None:
+            return None
+        return {'room': room, 'state': state.decode(), 'reason': reason.decode() if reason else None}
+
+    def sweep(self, now):
+        pass
+
+    def active(self):
+        return self.redis.scard(self._active_key())
+
+
+def make_call_store(url=SOCKETIO_MESSAGE_QUEUE):
+    if not url or url.startswith('local://'):
+        return CallStore()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCallStore(url)
+    return CallStore(expires=False)
+
+
+_lock = threading.Lock()
+_buckets = {}
+_ringing = {}
+_ice = {}
+_stats = {
+    'relayed': 0,
+    'candidates': 0,
+    'batches': 0,
+    'rateLimited': 0,
+    'oversized': 0,
+    'callsStarted': 0,
+    'callsAnswered': 0,
+    'callsMissed': 0,
+    'relayTimeTotalMs': 0.0,
+    'relayTimeMaxMs': 0.0,
+    'setupTimeTotalMs': 0.0,
+    'batchDelayTotalMs': 0.0,
+}
+_timeouts_started = False
+calls = make_call_store()
+
+
+def allow(sid, payload):
+    # Every relayed event costs one token. Oversized or throttled payloads
+    # are refused with an ack instead of being fanned out.
+    try:
+        size = len(json.dumps(payload))
+    except (TypeError, ValueError):
+        size = SIGNAL_MAX_BYTES + 1
+    with _lock:
+        if size > SIGNAL_MAX_BYTES:
+            _stats['oversized'] += 1
+            return {'ok': False, 'message': 'Payload too large', 'maxBytes': SIGNAL_MAX_BYTES}
+        bucket = _buckets.get(sid)
+        if bucket is None:
+            bucket = _buckets[sid] = TokenBucket(SIGNAL_RATE, SIGNAL_BURST)
+        if not bucket.take():
+            _stats['rateLimited'] += 1
+            return {'ok': False, 'message': 'Rate limited'}
+    return None
+
+
+def forget(sid, user_id, room_list):
+    with _lock:
+        _buckets.pop(sid, None)
+    for room in room_list:
+        end_call(room, 'caller-left', caller_id=user_id)
+
+
+def _is_candidate(signal):
+    return signal.get('type') == 'candidate' or ('candidate' in signal and 'sdp' not in signal)
+
+
+def _record_relay(started):
+    elapsed = (time.perf_counter() - started) * 1000
+    _stats['relayed'] += 1
+    _stats['relayTimeTotalMs'] += elapsed
+    _stats['relayTimeMaxMs'] = max(_stats['relayTimeMaxMs'], elapsed)
+
+
+def relay_signal(sid, user_id, room, data):
+    started = time.perf_counter()
+    signal = data.get('signal')
+    if not isinstance(signal, dict):
+        return {'ok': False, 'message': 'Invalid signal'}
+    kind = signal.get('type')
+
+    if kind == 'call-ended':
+        # Relayed even when the call was never seen or already ended, so the
+        # other side always hears about the hangup.
+        if not end_call(room, 'hangup'):
+            socketio.emit('call-ended', {'room': room, 'state': 'ended', 'reason': 'hangup'}, to=room)
+        return {'ok': True}
+
+    if _is_candidate(signal):
+        _queue_candidate(sid, room, signal)
+        return {'ok': True, 'batched': True}
+
+    if kind == 'offer':
+        call_started = calls.start(room, user_id)
+        if call_started is not None:
+            with _lock:
+                _stats['callsStarted'] += 1
+                _ringing[room] = (time.monotonic(), call_started)
+            _start_timeouts()
+    elif kind == 'answer':
+        call_started = calls.answer(room)
+        if call_started is not None:
+            with _lock:
+                _ringing.pop(room, None)
+                _stats['callsAnswered'] += 1
+                _stats['setupTimeTotalMs'] += max(time.time() - float(call_started), 0) * 1000
+
+    # Candidates from before the answer must not overtake it.
+    flush_candidates(sid, room)
+    emit('signal', data, to=room, include_self=False)
+    with _lock:
+        _record_relay(started)
+    return {'ok': True}
+
+
+def _queue_candidate(sid, room, signal):
+    key = (sid, room)
+    with _lock:
+        _stats['candidates'] += 1
+        pending = _ice.get(key)
+        if pending is None:
+            _ice[key] = pending = {'signals': [], 'started': time.perf_counter()}
+            schedule = True
+        else:
+            schedule = False
+        pending['signals'].append(signal)
+        full = len(pending['signals']) >= ICE_BATCH_MAX
+    if full:
+        flush_candidates(sid, room)
+    elif schedule:
+        socketio.start_background_task(_flush_later, sid, room)
+
+
+def _flush_later(sid, room):
+    socketio.sleep(ICE_BATCH_WINDOW)
+    flush_candidates(sid, room)
+
+
+def flush_candidates(sid, room):
+    with _lock:
+        pending = _ice.pop((sid, room), None)
+    if not pending:
+        return
+    socketio.emit('signal-batch', {'room': room, 'signals': pending['signals']}, to=room, skip_sid=sid)
+    with _lock:
+        _stats['batches'] += 1
+        _stats['batchDelayTotalMs'] += (time.perf_counter() - pending['started']) * 1000
+
+
+def end_call(room, reason, caller_id=None, ringing_since=None):
+    # Returns whether this call ended the session; only then is the room told.
+    previous = calls.end(room, reason, caller_id=caller_id, ringing_since=ringing_since)
+    if previous is None:
+        return False
+    with _lock:
+        _ringing.pop(room, None)
+        if previous == 'ringing' and reason != 'hangup':
+            _stats['callsMissed'] += 1
+    socketio.emit('call-ended', {'room': room, 'state': 'ended', 'reason': reason}, to=room)
+    return True
+
+
+def call_state(room):
+    return calls.get(room)
+
+
+def _start_timeouts():
+    global _timeouts_started
+    if _timeouts_started:
+        return
+    _timeouts_started = True
+    socketio.start_background_task(_expire_calls)
+
+
+def _expire_calls():
+    # Each worker times out the calls it saw start. Ending is conditional on
+    # that same call still ringing, so an answer relayed by another worker,
+    # or a newer call in the room, wins.
+    while True:
+        socketio.sleep(1)
+        now = time.monotonic()
+        with _lock:
+            expired = [(room, started) for room, (seen, started) in _ringing.items() if now - seen > RING_TIMEOUT]
+            for room, started in expired:
+                del _ringing[room]
+        if calls.expires:
+            for room, started in expired:
+                end_call(room, 'no-answer', ringing_since=started)
+        calls.sweep(time.time())
+
+
+def stats():
+    active = calls.active()
+    with _lock:
+        relayed = _stats['relayed']
+        batches = _stats['batches']
+        answered = _stats['callsAnswered']
+        return {
+            'relayed': relayed,
+            'candidates': _stats['candidates'],
+            'batches': _stats['batches'],
+            'rateLimited': _stats['rateLimited'],
+            'oversized': _stats['oversized'],
+            'activeCalls': active,
+            'callsStarted': _stats['callsStarted'],
+            'callsAnswered': answered,
+            'callsMissed': _stats['callsMissed'],
+            'relayTimeAvgMs': round(_stats['relayTimeTotalMs'] / relayed, 3) if relayed else 0.0,
+            'relayTimeMaxMs': round(_stats['relayTimeMaxMs'], 3),
+            'batchDelayAvgMs': round(_stats['batchDelayTotalMs'] / batches, 3) if batches else 0.0,
+            'callSetupAvgMs': round(_stats['setupTimeTotalMs'] / answered, 1) if answered else 0.0,
+        }
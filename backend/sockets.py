@@ -0,0 +1,161 @@
+from flask import request
+from flask_socketio import emit, join_room, leave_room, disconnect
+from extensions import socketio
+from auth import decode_token
+from db import PoolError
+import cache
+import rooms
+import presence
+import signaling
+import inbox
+import metrics
+
+
+def conversation_id_from(data):
+    try:
+        return int((data or {}).get('room'))
+    except (TypeError, ValueError):
+        return None
+
+
+@socketio.on('connect')
+@metrics.socket_event('connect')
+def handle_connect(auth=None):
+    # The client sends its API token in the Socket.IO handshake
+    # (io(url, { auth: { token } })); ?token= is accepted for older clients.
+    token = (auth or {}).get('token') or request.args.get('token')
+    user_id = decode_token(token)
+    if user_id is None:
+        raise ConnectionRefusedError('unauthorized')
+    rooms.registry.connect(request.sid, user_id)
+    presence.start()
+    presence.connect(request.sid, user_id)
+
+
+@socketio.on('disconnect')
+@metrics.socket_event('disconnect')
+def handle_disconnect(reason=None):
+    user_id = rooms.registry.user_id(request.sid)
+    room_list = rooms.registry.rooms_for(request.sid)
+    rooms.registry.disconnect(request.sid)
+    if user_id is not None:
+        presence.disconnect(request.sid, user_id, room_list)
+        signaling.forget(request.sid, user_id, room_list)
+
+
+@socketio.on('join-room')
+@metrics.socket_event('join-room')
+def handle_join_room(data):
+    user_id = rooms.registry.user_id(request.sid)
+    if user_id is None:
+        disconnect()
+        return {'ok': False, 'message': 'Unauthorized'}
+    conversation_id = conversation_id_from(data)
+    if conversation_id is None:
+        return {'ok': False, 'message': 'Invalid room'}
+    try:
+        allowed = cache.is_member(conversation_id, user_id, fresh=True)
+    except PoolError as e:
+        metrics.log(f"Database pool error joining conversation {conversation_id} (sid {request.sid}): {e}")
+        return {'ok': False, 'message': 'Database connection failed'}
+    if not allowed:
+        return {'ok': False, 'message': 'Unauthorized'}
+
+    room = rooms.conversation_room(conversation_id)
+    join_room(room)
+    rooms.registry.join(request.sid, room)
+    presence.joined(room, user_id)
+    # Current state of everyone in the conversation, so the client does not
+    # have to wait for the next room-activity batch. In large rooms that is
+    # only who is here now; the rest arrives with room activity.
+    conversation = cache.get_conversation(conversation_id)
+    if conversation and conversation['memberCount'] > inbox.LARGE_ROOM_SIZE:
+        member_ids = rooms.online_user_ids(conversation_id) | {user_id}
+    else:
+        member_ids = cache.get_member_ids(conversation_id)
+    profiles = cache.get_profiles(member_ids)
+    statuses = presence.statuses(member_ids)
+    return {
+        'ok': True,
+        'room': room,
+        'presence': {profiles[m]['uid']: statuses[m] for m in member_ids if m in profiles},
+        'call': signaling.call_state(room)
+    }
+
+
+@socketio.on('leave-room')
+@metrics.socket_event('leave-room')
+def handle_leave_room(data):
+    conversation_id = conversation_id_from(data)
+    if conversation_id is None:
+        return {'ok': False, 'message': 'Invalid room'}
+    room = rooms.conversation_room(conversation_id)
+    leave_room(room)
+    rooms.registry.leave(request.sid, room)
+    presence.set_typing(room, rooms.registry.user_id(request.sid), False)
+    return {'ok': True}
+
+
+def room_sender(data):
+    # Only sockets that passed the join-room check may talk to a room.
+    conversation_id = conversation_id_from(data)
+    room = rooms.conversation_room(conversation_id) if conversation_id is not None else None
+    if room is None or not rooms.registry.in_room(request.sid, room):
+        return None, None
+    return room, rooms.registry.user_id(request.sid)
+
+
+def peers_offline(room, user_id):
+    # Tells the sender nobody else is there to hear it, instead of emitting
+    # into an empty room.
+    return rooms.registry.authoritative and not (rooms.registry.online_user_ids(room) - {user_id})
+
+
+@socketio.on('signal')
+@metrics.socket_event('signal')
+def handle_signal(data):
+    room, user_id = room_sender(data)
+    if room is None:
+        return {'ok': False, 'message': 'Not in room'}
+    refused = signaling.allow(request.sid, data)
+    if refused:
+        return refused
+    if peers_offline(room, user_id) and (data.get('signal') or {}).get('type') != 'call-ended':
+        return {'ok': True, 'delivered': False}
+    return signaling.relay_signal(request.sid, user_id, room, data)
+
+
+@socketio.on('gesture-action')
+@metrics.socket_event('gesture-action')
+def handle_gesture_action(data):
+    room, user_id = room_sender(data)
+    if room is None:
+        return {'ok': False, 'message': 'Not in room'}
+    refused = signaling.allow(request.sid, data)
+    if refused:
+        return refused
+    if peers_offline(room, user_id):
+        return {'ok': True, 'delivered': False}
+    emit('gesture-action', data, to=room, include_self=False)
+    return {'ok': True, 'delivered': True}
+
+
+@socketio.on('heartbeat')
+@metrics.socket_event('heartbeat')
+def handle_heartbeat(data=None):
+    user_id = rooms.registry.user_id(request.sid)
+    if user_id is None:
+        return {'ok': False, 'message': 'Unauthorized'}
+    presence.heartbeat(user_id, (data or {}).get('status', 'online'))
+    return {'ok': True}
+
+
+@socketio.on('typing')
+@metrics.socket_event('typing')
+def handle_typing(data):
+    conversation_id = conversation_id_from(data)
+    room = rooms.conversation_room(conversation_id) if conversation_id is not None else None
+    if room is None or not rooms.registry.in_room(request.sid, room):
+        return {'ok': False, 'message': 'Not in room'}
+    presence.set_typing(room, rooms.registry.user_id(request.sid), bool(data.get('typing', True)))
+    return {'ok': True}
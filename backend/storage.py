@@ -0,0 +1,216 @@
+import os
+import re
+import sys
+import time
+import base64
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+# Where published attachment bytes live. Names are the ones uploads.py
+# publishes: <sha256>.<ext>, <sha256>_<size>.webp thumbnails and legacy
+# <uuid4>.<ext> files.
+#   STORAGE_BACKEND=local  sharded directories under STORAGE_LOCAL_ROOT
+#   STORAGE_BACKEND=s3     an S3-compatible bucket (AWS, MinIO, a local stand-in
+#                          via S3_ENDPOINT_URL)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+STORAGE_LOCAL_ROOT = os.environ.get('STORAGE_LOCAL_ROOT', os.path.join(os.getcwd(), 'uploads'))
+S3_BUCKET = os.environ.get('S3_BUCKET')
+S3_PREFIX = os.environ.get('S3_PREFIX', 'uploads/')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+S3_REGION = os.environ.get('S3_REGION')
+SIGNED_URL_TTL = int(os.environ.get('SIGNED_URL_TTL', 300))
+# Local files can be handed out as nginx secure_link URLs: set the public
+# base (e.g. https://files.example.com/uploads) and the shared secret, with
+# secure_link_md5 "$secure_link_expires$uri SECRET" on the nginx side.
+SIGNED_URL_BASE = os.environ.get('STORAGE_SIGNED_URL_BASE')
+SIGNED_URL_SECRET = os.environ.get('STORAGE_SIGNED_URL_SECRET')
+
+HASHED_NAME = re.compile(r'^([0-9a-f]{64})')
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def shard_path(name):
+    # ab/cd/abcd...: two levels of 256 directories keep every directory small
+    # however many blobs there are. Legacy names stay at the top level.
+    match = HASHED_NAME.match(name)
+    if not match:
+        return name
+    digest = match.group(1)
+    return f"{digest[:2]}/{digest[2:4]}/{name}"
+
+
+class LocalStorage:
+    name = 'local'
+
+    def __init__(self, root=STORAGE_LOCAL_ROOT):
+        self.root = root
+
+    def path(self, name):
+        sharded = os.path.join(self.root, shard_path(name))
+        if os.path.exists(sharded):
+            return sharded
+        # Files published before sharding are still at the top level.
+        flat = os.path.join(self.root, name)
+        return flat if os.path.exists(flat) else None
+
+    def exists(self, name):
+        return self.path(name) is not None
+
+    def size(self, name):
+        path = self.path(name)
+        return os.path.getsize(path) if path else None
+
+    def put_file(self, src_path, name, content_type=None):
+        # Moves src_path into place; src_path must be on the same filesystem
+        # (the upload staging folder is), so this is a rename, not a copy.
+        dest = os.path.join(self.root, shard_path(name))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(src_path, dest)
+
+    @contextmanager
+    def open(self, name):
+        path = self.path(name)
+        if path is None:
+            raise FileNotFoundError(name)
+        with open(path, 'rb') as f:
+            yield f
+
+    @contextmanager
+    def local_copy(self, name):
+        path = self.path(name)
+        if path is None:
+            raise FileNotFoundError(name)
+        yield path
+
+    def delete(self, name):
+        path = self.path(name)
+        if path:
+            os.remove(path)
+
+    def relative_path(self, name):
+        path = self.path(name)
+        return os.path.relpath(path, self.root) if path else None
+
+    def signed_url(self, name, ttl=SIGNED_URL_TTL):
+        if not SIGNED_URL_BASE or not SIGNED_URL_SECRET:
+            return None
+        relative = self.relative_path(name)
+        if relative is None:
+            return None
+        expires = int(time.time()) + ttl
+        uri = f"{urlsplit(SIGNED_URL_BASE).path.rstrip('/')}/{relative}"
+        digest = hashlib.md5(f"{expires}{uri} {SIGNED_URL_SECRET}".encode()).digest()
+        token = base64.urlsafe_b64encode(digest).decode().rstrip('=')
+        return f"{SIGNED_URL_BASE.rstrip('/')}/{relative}?md5={token}&expires={expires}"
+
+    def etag(self, name):
+        return None
+
+
+class S3Storage:
+    name = 's3'
+
+    def __init__(self, bucket=S3_BUCKET, prefix=S3_PREFIX, endpoint_url=S3_ENDPOINT_URL, region=S3_REGION):
+        if not bucket:
+            raise RuntimeError("S3_BUCKET is required for STORAGE_BACKEND=s3")
+        import boto3
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def key(self, name):
+        return f"{self.prefix}{shard_path(name)}"
+
+    def _head(self, name):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, name):
+        return self._head(name) is not None
+
+    def size(self, name):
+        head = self._head(name)
+        return head['ContentLength'] if head else None
+
+    def etag(self, name):
+        head = self._head(name)
+        return head['ETag'].strip('"') if head else None
+
+    def put_file(self, src_path, name, content_type=None):
+        # upload_file streams from disk and switches to multipart for large files.
+        extra = {'CacheControl': 'public, max-age=31536000, immutable'}
+        if content_type:
+            extra['ContentType'] = content_type
+        self.client.upload_file(src_path, self.bucket, self.key(name), ExtraArgs=extra)
+        os.remove(src_path)
+
+    @contextmanager
+    def open(self, name):
+        from botocore.exceptions import ClientError
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self.key(name))['Body']
+        except ClientError:
+            raise FileNotFoundError(name)
+        try:
+            yield body
+        finally:
+            body.close()
+
+    @contextmanager
+    def local_copy(self, name):
+        # For tools that need a real file (Pillow, ffprobe).
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(name)[1])
+        try:
+            with os.fdopen(fd, 'wb') as f, self.open(name) as body:
+                shutil.copyfileobj(body, f, COPY_BUFFER_SIZE)
+            yield path
+        finally:
+            os.remove(path)
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def relative_path(self, name):
+        return None
+
+    def signed_url(self, name, ttl=SIGNED_URL_TTL):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.key(name)}, ExpiresIn=ttl
+        )
+
+
+def make_storage(backend=STORAGE_BACKEND):
+    if backend == 's3':
+        return S3Storage()
+    return LocalStorage()
+
+
+storage = make_storage()
+
+
+def migrate_local(root=STORAGE_LOCAL_ROOT):
+    # Moves content-addressed files written before sharding into their shard.
+    moved = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not os.path.isfile(path) or not HASHED_NAME.match(name):
+            continue
+        dest = os.path.join(root, shard_path(name))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(path, dest)
+        moved += 1
+    return moved
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ['shard']:
+        sys.exit("Usage: python storage.py shard")
+    print(f"Moved {migrate_local()} file(s) into shard directories.")
@@ -0,0 +1,99 @@
+import os
+import sys
+import tempfile
+import pytest
+
+# Run from the backend directory: TEST_DATABASE_URL=postgresql://... python -m pytest
+# The database tests truncate every table, so they only ever run against
+# TEST_DATABASE_URL and are skipped without it; DATABASE_URL is blanked so
+# nothing falls back to the one in .env. Uploaded files go to a scratch folder.
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+os.environ['DATABASE_URL'] = TEST_DATABASE_URL or ''
+os.environ['STORAGE_LOCAL_ROOT'] = tempfile.mkdtemp(prefix='connectnow-test-')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def app():
+    if not TEST_DATABASE_URL:
+        pytest.skip("Set TEST_DATABASE_URL to a throwaway PostgreSQL database.")
+    import migrations
+    assert migrations.migrate()
+    from app import app
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def db(app):
+    from db import connection
+    import cache
+    import auth
+    import search
+    import uploads
+    import signaling
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT string_agg(quote_ident(tablename), ', ') FROM pg_tables
+            WHERE schemaname = 'public' AND tablename NOT IN ('schema_migrations', 'archived_message_partitions')
+              AND tablename NOT LIKE 'messages\\_%%'
+        """)
+        cur.execute(f"TRUNCATE {cur.fetchone()[0]} RESTART IDENTITY CASCADE")
+        conn.commit()
+    # Ids restart with the tables, so nothing cached from an earlier test may survive.
+    for ttl_cache in (cache.search_cache, cache.profile_cache, cache.uid_cache, cache.membership_cache,
+                      cache.member_cache, cache.conversation_cache, auth.token_cache,
+                      search._partition_cache, uploads._etag_cache):
+        ttl_cache.clear()
+    signaling.calls = signaling.make_call_store()
+    return connection
+
+
+@pytest.fixture
+def client(app, db):
+    return app.test_client()
+
+
+@pytest.fixture
+def make_user(db):
+    from auth import issue_access_token
+    from db import connection
+
+    def make_user(name):
+        with connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (uid, email, password_hash, display_name)
+                VALUES (%s, %s, '', %s)
+                RETURNING id
+            """, (name, f'{name}@example.com', name.title()))
+            user_id = cur.fetchone()[0]
+            conn.commit()
+        token = issue_access_token(user_id, name)
+        return {'id': user_id, 'uid': name, 'token': token, 'headers': {'Authorization': f'Bearer {token}'}}
+    return make_user
+
+
+@pytest.fixture
+def make_group(client):
+    def make_group(owner, *members):
+        response = client.post('/api/conversations', headers=owner['headers'],
+                               json={'name': 'Test group', 'memberUids': [m['uid'] for m in members]})
+        assert response.status_code == 201
+        return response.get_json()['conversationId']
+    return make_group
+
+
+@pytest.fixture
+def socket_client(app, client):
+    from extensions import socketio
+    clients = []
+
+    def socket_client(user):
+        sio = socketio.test_client(app, flask_test_client=client, auth={'token': user['token']})
+        assert sio.is_connected()
+        clients.append(sio)
+        return sio
+    yield socket_client
+    for sio in clients:
+        if sio.is_connected():
+            sio.disconnect()
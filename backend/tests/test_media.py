@@ -0,0 +1,64 @@
+import time
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+import media
+
+SHA256 = 'ab' * 32
+
+
+def test_hung_job_is_stopped_by_killing_its_workers():
+    executor, pids = media._get_executor()
+    future = executor.submit(time.sleep, 60)
+    deadline = time.monotonic() + 10
+    while not future.running() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    media._reset_executor(executor, pids)
+    with pytest.raises(BrokenProcessPool):
+        future.result(timeout=10)
+    assert media._get_executor()[0] is not executor
+
+
+def test_batch_rejects_malformed_content_and_types(client, make_user, make_group):
+    alice, bob = make_user('alice'), make_user('bob')
+    conversation_id = make_group(alice, bob)
+    for entry in ({'content': {'not': 'text'}}, {'content': ['a']}, {'content': 'hi', 'type': 'removed'},
+                  {'content': 'hi', 'type': None}):
+        response = client.post('/api/messages/batch', headers=alice['headers'],
+                               json={'messages': [{'conversationId': conversation_id, 'content': 'ok'},
+                                                  {'conversationId': conversation_id, **entry}]})
+        assert response.status_code == 400
+        assert 'messages[1]' in response.get_json()['message']
+
+
+def test_stale_processing_claims_are_requeued(client, db, make_user, make_group, monkeypatch):
+    alice, bob = make_user('alice'), make_user('bob')
+    conversation_id = make_group(alice, bob)
+    url = f'/uploads/{SHA256}.png'
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO blobs (sha256, name, size, media_status, media_started_at) VALUES
+                (%s, %s, 10, 'processing', LOCALTIMESTAMP - make_interval(secs => %s)),
+                (%s, %s, 10, 'processing', LOCALTIMESTAMP)
+        """, (SHA256, f'{SHA256}.png', media.MEDIA_STALE_AFTER + 60, 'cd' * 32, f"{'cd' * 32}.png"))
+        conn.commit()
+    response = client.post('/api/messages', headers=alice['headers'], json={
+        'conversationId': conversation_id, 'content': url, 'type': 'image', 'file': {'name': 'a.png'}})
+    assert response.status_code == 201
+    message_id = response.get_json()['message']['id']
+
+    scheduled = []
+    monkeypatch.setattr(media, 'schedule', scheduled.append)
+    media.requeue_stale()
+    assert scheduled == [url]
+
+    monkeypatch.setattr(media, '_run', lambda name, sha256, started: {'processed': True, 'width': 4})
+    media._process(SHA256, url)
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT media_status FROM blobs WHERE sha256 = %s", (SHA256,))
+        assert cur.fetchone()[0] == 'done'
+        cur.execute("SELECT file_meta FROM messages WHERE id = %s", (message_id,))
+        assert cur.fetchone()[0] == {'name': 'a.png', 'processed': True, 'width': 4}
+    # A fresh claim belongs to a live job and is left alone.
+    skipped = media.stats()['skipped']
+    media._process('cd' * 32, f"/uploads/{'cd' * 32}.png")
+    assert media.stats()['skipped'] == skipped + 1
@@ -0,0 +1,114 @@
+from routes import attach_media_to_messages
+
+
+def send(client, user, conversation_id, content, **fields):
+    response = client.post('/api/messages', headers=user['headers'],
+                           json={'conversationId': conversation_id, 'content': content, **fields})
+    assert response.status_code == 201
+    return response.get_json()['message']
+
+
+def conversation_seq(db, conversation_id):
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT seq FROM conversations WHERE id = %s", (conversation_id,))
+        return cur.fetchone()[0]
+
+
+def test_deleting_a_deleted_message_is_a_no_op(client, db, make_user, make_group):
+    alice, bob = make_user('alice'), make_user('bob')
+    conversation_id = make_group(alice, bob)
+    message = send(client, alice, conversation_id, 'oops')
+
+    assert client.delete(f"/api/messages/{message['id']}", headers=alice['headers']).status_code == 200
+    seq = conversation_seq(db, conversation_id)
+    assert seq == message['seq'] + 1
+    assert client.delete(f"/api/messages/{message['id']}", headers=alice['headers']).status_code == 200
+    assert conversation_seq(db, conversation_id) == seq
+
+
+def test_media_ready_updates_messages_in_every_conversation(client, db, make_user, make_group):
+    alice, bob = make_user('alice'), make_user('bob')
+    first, second = make_group(alice, bob), make_group(bob, alice)
+    url = f"/uploads/{'ef' * 32}.png"
+    sent = [send(client, alice, first, url, type='image', file={'name': 'a.png'}),
+            send(client, bob, second, url, type='image', file={'name': 'a.png'}),
+            send(client, alice, first, url, type='image', file={'name': 'b.png'})]
+
+    attach_media_to_messages(url, {'processed': True, 'width': 4})
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT id, seq, file_meta FROM messages WHERE id = ANY(%s) ORDER BY id", ([m['id'] for m in sent],))
+        rows = cur.fetchall()
+    assert [row[2]['width'] for row in rows] == [4, 4, 4]
+    # Each update is a change of its own, after everything sent before it.
+    assert sorted([rows[0][1], rows[2][1]]) == [3, 4]
+    assert rows[1][1] == 2
+    assert conversation_seq(db, first) == 4
+    assert conversation_seq(db, second) == 2
+
+
+def react(client, user, message_id, reaction):
+    return client.post(f'/api/messages/{message_id}/reactions', headers=user['headers'], json={'reaction': reaction})
+
+
+def test_reaction_toggle(client, db, make_user, make_group):
+    alice, bob, carol = make_user('alice'), make_user('bob'), make_user('carol')
+    conversation_id = make_group(alice, bob)
+    message = send(client, alice, conversation_id, 'hello')
+
+    assert react(client, alice, message['id'], '👍').get_json()['reactions'] == {'alice': '👍'}
+    assert react(client, bob, message['id'], '❤️').get_json()['reactions'] == {'alice': '👍', 'bob': '❤️'}
+    # Same reaction again takes it back; a different one replaces it.
+    assert react(client, alice, message['id'], '👍').get_json()['reactions'] == {'bob': '❤️'}
+    response = react(client, bob, message['id'], '😂')
+    assert response.get_json()['reactions'] == {'bob': '😂'}
+    assert response.get_json()['message']['seq'] == message['seq'] + 4
+    assert conversation_seq(db, conversation_id) == message['seq'] + 4
+
+    assert react(client, carol, message['id'], '👍').status_code == 404
+    assert conversation_seq(db, conversation_id) == message['seq'] + 4
+
+
+def test_since_returns_every_change_in_seq_order(client, make_user, make_group):
+    alice, bob = make_user('alice'), make_user('bob')
+    conversation_id = make_group(alice, bob)
+    first, second, third = (send(client, alice, conversation_id, text) for text in ('one', 'two', 'three'))
+    react(client, bob, first['id'], '👍')
+    client.delete(f"/api/messages/{second['id']}", headers=alice['headers'])
+
+    changes, cursor = [], first['seq']
+    while True:
+        response = client.get(f'/api/messages/{conversation_id}?since={cursor}&limit=2', headers=bob['headers'])
+        page = response.get_json()
+        changes += page['messages']
+        cursor = page['cursor']
+        if not page['hasMore']:
+            break
+    assert [(m['id'], m['seq']) for m in changes] == [(third['id'], 3), (first['id'], 4), (second['id'], 5)]
+    assert changes[1]['reactions'] == {'bob': '👍'}
+    assert changes[2]['type'] == 'removed'
+    assert cursor == 5
+
+    page = client.get(f'/api/messages/{conversation_id}?since={cursor}', headers=bob['headers']).get_json()
+    assert page == {'messages': [], 'hasMore': False, 'cursor': 5}
+
+
+def test_writer_assigns_ids_and_seqs_in_order(client, make_user, make_group):
+    alice, bob = make_user('alice'), make_user('bob')
+    first, second = make_group(alice, bob), make_group(alice, bob)
+    send(client, alice, second, 'before')
+    entries = [{'conversationId': cid, 'content': f'{cid}-{n}', 'clientId': str(n)}
+               for n, cid in enumerate((first, second, first, second, first))]
+    response = client.post('/api/messages/batch', headers=alice['headers'], json={'messages': entries})
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert [r['status'] for r in results] == ['sent'] * 5
+    assert [r['clientId'] for r in results] == ['0', '1', '2', '3', '4']
+
+    for cid, seqs in ((first, [1, 2, 3]), (second, [2, 3])):
+        sent = [r['message'] for r, e in zip(results, entries) if e['conversationId'] == cid]
+        assert [m['seq'] for m in sent] == seqs
+        # Paging by id and syncing by seq see the messages in the same order.
+        assert [m['id'] for m in sent] == sorted(m['id'] for m in sent)
+        history = client.get(f'/api/messages/{cid}?limit=10', headers=bob['headers']).get_json()
+        assert [m['content'] for m in history['messages']][-len(sent):] == [m['content'] for m in sent]
+        assert history['cursor'] == seqs[-1]
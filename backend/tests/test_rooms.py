@@ -0,0 +1,40 @@
+import rooms
+from extensions import socketio
+
+
+def joined(socket_client, user, conversation_id):
+    sio = socket_client(user)
+    assert sio.emit('join-room', {'room': conversation_id}, callback=True)['ok']
+    sio.get_received()
+    return sio
+
+
+def test_removed_member_can_no_longer_talk_to_the_room(client, make_user, make_group, socket_client):
+    alice, bob = make_user('alice'), make_user('bob')
+    conversation_id = make_group(alice, bob)
+    joined(socket_client, alice, conversation_id)
+    removed = joined(socket_client, bob, conversation_id)
+
+    response = client.delete(f'/api/conversations/{conversation_id}/members/bob', headers=alice['headers'])
+    assert response.status_code == 200
+    signal = {'room': conversation_id, 'signal': {'type': 'offer', 'sdp': 'v=0'}}
+    assert removed.emit('signal', signal, callback=True) == {'ok': False, 'message': 'Not in room'}
+    assert removed.emit('typing', {'room': conversation_id}, callback=True) == {'ok': False, 'message': 'Not in room'}
+    assert removed.emit('join-room', {'room': conversation_id}, callback=True) == {'ok': False, 'message': 'Unauthorized'}
+
+
+def test_leave_from_another_worker_reaches_the_registry(make_user, make_group, socket_client):
+    alice, bob = make_user('alice'), make_user('bob')
+    conversation_id = make_group(alice, bob)
+    room = rooms.conversation_room(conversation_id)
+    joined(socket_client, alice, conversation_id)
+    removed = joined(socket_client, bob, conversation_id)
+    sid = socketio.server.manager.sid_from_eio_sid(removed.eio_sid, '/')
+
+    # What the message queue does on the worker holding the socket when
+    # rooms.remove_member runs on another one: only the Socket.IO room changes.
+    socketio.server.leave_room(sid, room, namespace='/')
+    assert rooms.online_user_ids(conversation_id) == {alice['id'], bob['id']}
+    gesture = {'room': conversation_id, 'action': 'wave'}
+    assert removed.emit('gesture-action', gesture, callback=True) == {'ok': False, 'message': 'Not in room'}
+    assert rooms.online_user_ids(conversation_id) == {alice['id']}
@@ -0,0 +1,63 @@
+import rooms
+import signaling
+from signaling import CallStore
+
+
+def test_call_store_lifecycle():
+    calls = CallStore()
+    started = calls.start('conversation:1', 1)
+    assert started is not None
+    assert calls.get('conversation:1')['state'] == 'ringing'
+    # A second offer while ringing or active is a renegotiation, not a new call.
+    assert calls.start('conversation:1', 2) is None
+    assert calls.answer('conversation:1') == started
+    assert calls.answer('conversation:1') is None
+    assert calls.start('conversation:1', 1) is None
+    assert calls.end('conversation:1', 'hangup') == 'active'
+    assert calls.end('conversation:1', 'hangup') is None
+    assert calls.get('conversation:1') == {'room': 'conversation:1', 'state': 'ended', 'reason': 'hangup'}
+    assert calls.start('conversation:1', 2) is not None
+
+
+def test_call_store_conditional_end():
+    calls = CallStore()
+    started = calls.start('conversation:1', 1)
+    # Only the caller's sockets leaving ends a ringing call.
+    assert calls.end('conversation:1', 'caller-left', caller_id=2) is None
+    # A ring timeout only ends the call it was started for, while it rings.
+    assert calls.end('conversation:1', 'no-answer', ringing_since='0') is None
+    calls.answer('conversation:1')
+    assert calls.end('conversation:1', 'no-answer', ringing_since=started) is None
+    assert calls.end('conversation:1', 'caller-left', caller_id=1) == 'active'
+    assert calls.active() == 0
+
+
+def test_offer_answer_and_renegotiation_are_relayed(make_user, make_group, socket_client):
+    alice, bob = make_user('alice'), make_user('bob')
+    conversation_id = make_group(alice, bob)
+    room = rooms.conversation_room(conversation_id)
+    caller, callee = socket_client(alice), socket_client(bob)
+    assert caller.emit('join-room', {'room': conversation_id}, callback=True)['ok']
+    assert callee.emit('join-room', {'room': conversation_id}, callback=True)['ok']
+    caller.get_received()
+    callee.get_received()
+    before = signaling.stats()
+
+    offer = {'room': conversation_id, 'signal': {'type': 'offer', 'sdp': 'v=0 offer'}}
+    answer = {'room': conversation_id, 'signal': {'type': 'answer', 'sdp': 'v=0 answer'}}
+    reoffer = {'room': conversation_id, 'signal': {'type': 'offer', 'sdp': 'v=0 reoffer'}}
+    assert caller.emit('signal', offer, callback=True) == {'ok': True}
+    assert signaling.call_state(room)['state'] == 'ringing'
+    assert callee.emit('signal', answer, callback=True) == {'ok': True}
+    assert signaling.call_state(room)['state'] == 'active'
+    assert caller.emit('signal', reoffer, callback=True) == {'ok': True}
+    assert signaling.call_state(room)['state'] == 'active'
+
+    to_callee = [e['args'][0]['signal']['sdp'] for e in callee.get_received() if e['name'] == 'signal']
+    to_caller = [e['args'][0]['signal']['sdp'] for e in caller.get_received() if e['name'] == 'signal']
+    assert to_callee == ['v=0 offer', 'v=0 reoffer']
+    assert to_caller == ['v=0 answer']
+    after = signaling.stats()
+    assert after['relayed'] - before['relayed'] == 3
+    assert after['callsStarted'] - before['callsStarted'] == 1
+    assert after['callsAnswered'] - before['callsAnswered'] == 1
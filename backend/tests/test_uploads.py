@@ -0,0 +1,83 @@
+import hashlib
+import uploads
+
+
+def start(client, user, data, sha256=True):
+    body = {'filename': 'notes.txt', 'size': len(data)}
+    if sha256:
+        body['sha256'] = hashlib.sha256(data).hexdigest()
+    return client.post('/api/uploads', headers=user['headers'], json=body)
+
+
+def upload(client, user, data, response=None):
+    response = response or start(client, user, data)
+    result = response.get_json()
+    if result['complete']:
+        return result
+    assert response.status_code == 201
+    response = client.put(f"/api/uploads/{result['uploadId']}?offset=0", headers=user['headers'], data=data)
+    assert response.status_code == 200
+    response = client.post(f"/api/uploads/{result['uploadId']}/complete", headers=user['headers'])
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def blob(db, data):
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT size, ref_count FROM blobs WHERE sha256 = %s", (hashlib.sha256(data).hexdigest(),))
+        return cur.fetchone()
+
+
+def used(db, user):
+    with db() as conn, conn.cursor() as cur:
+        return uploads.quota_used(cur, user['id'])
+
+
+def test_declared_hash_of_someone_elses_blob_still_needs_the_bytes(client, db, make_user):
+    alice, mallory = make_user('alice'), make_user('mallory')
+    data = b'alice only' * 100
+    first = upload(client, alice, data)
+
+    response = start(client, mallory, data)
+    assert response.status_code == 201
+    assert response.get_json()['complete'] is False
+    assert response.get_json()['offset'] == 0
+    assert blob(db, data) == (len(data), 1)
+
+    # Once the bytes arrive they dedup onto the stored blob.
+    second = upload(client, mallory, data, response)
+    assert second['url'] == first['url']
+    assert blob(db, data) == (len(data), 2)
+    assert used(db, mallory) == len(data)
+
+
+def test_owner_skips_the_bytes_and_is_charged_once(client, db, make_user):
+    alice = make_user('alice')
+    data = b'twice' * 200
+    first = upload(client, alice, data)
+
+    response = client.post('/api/uploads', headers=alice['headers'], json={
+        'filename': 'again.txt', 'size': 1, 'sha256': hashlib.sha256(data).hexdigest()})
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result['complete'] is True
+    assert result['url'] == first['url']
+    # The blob's size counts, not the declared one, and only once.
+    assert result['offset'] == len(data)
+    assert used(db, alice) == len(data)
+    assert blob(db, data) == (len(data), 2)
+
+
+def test_quota_is_checked_before_anything_is_referenced(client, db, make_user, monkeypatch):
+    alice = make_user('alice')
+    data = b'x' * 1000
+    upload(client, alice, data)
+    monkeypatch.setattr(uploads, 'USER_UPLOAD_QUOTA', 1500)
+
+    assert start(client, alice, b'y' * 600).status_code == 413
+    # Pending uploads reserve their declared size.
+    assert start(client, alice, b'y' * 400).status_code == 201
+    assert start(client, alice, b'z' * 200).status_code == 413
+    # Re-using an owned blob adds nothing to what is charged.
+    assert start(client, alice, data).status_code == 200
+    assert blob(db, data) == (len(data), 2)
@@ -0,0 +1,372 @@
+import os
+import re
+import sys
+import uuid
+import hashlib
+import mimetypes
+from werkzeug.utils import secure_filename
+from cache import TTLCache
+from storage import storage, STORAGE_LOCAL_ROOT
+
+UPLOAD_FOLDER = STORAGE_LOCAL_ROOT
+# Uploads in progress are always staged on local disk; only finished blobs
+# go to the storage backend.
+PARTIAL_FOLDER = os.path.join(UPLOAD_FOLDER, '.partial')
+
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE', 100 * 1024 * 1024))
+MAX_CHUNK_SIZE = int(os.environ.get('MAX_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+USER_UPLOAD_QUOTA = int(os.environ.get('USER_UPLOAD_QUOTA', 1024 * 1024 * 1024))
+STALE_UPLOAD_HOURS = int(os.environ.get('STALE_UPLOAD_HOURS', 24))
+# Request bodies are copied to disk in pieces of this size, never held whole in memory.
+STREAM_BUFFER_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, **extra):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.extra = extra
+
+
+def ensure_folders():
+    os.makedirs(PARTIAL_FOLDER, exist_ok=True)
+
+
+def _partial_path(upload_id):
+    return os.path.join(PARTIAL_FOLDER, f"{upload_id}.part")
+
+
+def _extension(filename):
+    filename = secure_filename(filename or '')
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+
+def _blob_name(sha256, ext):
+    return f"{sha256}.{ext}" if ext else sha256
+
+
+def blob_url(name):
+    return f"/uploads/{name}"
+
+
+# Published names are <sha256>.<ext> (content-addressed), <sha256>_<size>.webp
+# (thumbnails derived from it) or the legacy <uuid4>.<ext>; none of them ever
+# change content, so they can be cached forever.
+IMMUTABLE_NAME = re.compile(r'^(?:[0-9a-f]{64}(?:_[0-9]+)?|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(?:\.[A-Za-z0-9]+)?$')
+CONTENT_HASH_NAME = re.compile(r'^([0-9a-f]{64})(?:\.[A-Za-z0-9]+)?$')
+
+# Legacy files have to be hashed once to get a content ETag; keyed on
+# (path, size, mtime) so a replaced file is re-hashed.
+_etag_cache = TTLCache(maxsize=4096, ttl=24 * 3600)
+
+
+def is_immutable_name(name):
+    return bool(IMMUTABLE_NAME.match(name))
+
+
+def content_etag(name):
+    match = CONTENT_HASH_NAME.match(name)
+    if match:
+        return match.group(1)
+    if storage.name != 'local':
+        return storage.etag(name)
+    path = storage.path(name)
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (path, st.st_size, st.st_mtime_ns)
+    etag = _etag_cache.get(key)
+    if etag is None:
+        etag = _hash_file(path)
+        _etag_cache.set(key, etag)
+    return etag
+
+
+def _normalize_hash(value):
+    if value is None:
+        return None
+    value = str(value).strip().lower()
+    if len(value) != 64 or any(c not in '0123456789abcdef' for c in value):
+        raise UploadError('sha256 must be a hex-encoded SHA-256 digest')
+    return value
+
+
+def quota_used(cur, user_id):
+    # Completed uploads are charged once per distinct blob; pending sessions
+    # reserve their declared size so parallel uploads can't overshoot the quota.
+    cur.execute("""
+        SELECT
+            COALESCE((SELECT SUM(size) FROM (
+                SELECT DISTINCT ON (sha256) size FROM uploads
+                WHERE owner_id = %s AND status = 'complete'
+            ) done), 0)
+            + COALESCE((SELECT SUM(size) FROM uploads WHERE owner_id = %s AND status = 'pending'), 0)
+    """, (user_id, user_id))
+    return cur.fetchone()[0]
+
+
+def _find_blob(cur, sha256):
+    cur.execute("SELECT name FROM blobs WHERE sha256 = %s", (sha256,))
+    row = cur.fetchone()
+    if row and storage.exists(row[0]):
+        return row[0]
+    return None
+
+
+def _owned_blob(cur, user_id, sha256):
+    # (name, size) of a stored blob the user completed an upload of, else None.
+    cur.execute("""
+        SELECT b.name, b.size FROM uploads u JOIN blobs b ON b.sha256 = u.sha256
+        WHERE u.owner_id = %s AND u.status = 'complete' AND u.sha256 = %s
+        LIMIT 1
+    """, (user_id, sha256))
+    row = cur.fetchone()
+    if row and storage.exists(row[0]):
+        return row
+    return None
+
+
+def _reference_blob(cur, sha256, name, size):
+    cur.execute("""
+        INSERT INTO blobs (sha256, name, size) VALUES (%s, %s, %s)
+        ON CONFLICT (sha256) DO UPDATE SET ref_count = blobs.ref_count + 1
+        RETURNING name
+    """, (sha256, name, size))
+    return cur.fetchone()[0]
+
+
+def start_upload(cur, user_id, filename, size, sha256=None):
+    if not filename:
+        raise UploadError('filename is required')
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError('size must be an integer')
+    if size <= 0:
+        raise UploadError('size must be positive')
+    if size > MAX_UPLOAD_SIZE:
+        raise UploadError(f'File exceeds the {MAX_UPLOAD_SIZE} byte limit', 413)
+    sha256 = _normalize_hash(sha256)
+
+    upload_id = str(uuid.uuid4())
+
+    # A client re-sending a file it already uploaded can skip the bytes. A
+    # declared hash alone proves nothing about having the content, so anyone
+    # else uploads it and complete_upload dedups against the stored blob.
+    owned = _owned_blob(cur, user_id, sha256) if sha256 else None
+    # An owned blob is already charged (once per distinct blob).
+    if quota_used(cur, user_id) + (0 if owned else size) > USER_UPLOAD_QUOTA:
+        raise UploadError('Upload quota exceeded', 413)
+
+    if owned:
+        name, size = owned
+        _reference_blob(cur, sha256, name, size)
+        cur.execute("""
+            INSERT INTO uploads (id, owner_id, original_name, size, received, expected_sha256, sha256, status, completed_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, 'complete', CURRENT_TIMESTAMP)
+        """, (upload_id, user_id, filename, size, size, sha256, sha256))
+        return {'uploadId': upload_id, 'offset': size, 'complete': True, 'url': blob_url(name)}
+
+    ensure_folders()
+    open(_partial_path(upload_id), 'wb').close()
+    cur.execute("""
+        INSERT INTO uploads (id, owner_id, original_name, size, expected_sha256)
+        VALUES (%s, %s, %s, %s, %s)
+    """, (upload_id, user_id, filename, size, sha256))
+    return {'uploadId': upload_id, 'offset': 0, 'complete': False, 'chunkSize': MAX_CHUNK_SIZE}
+
+
+def get_upload(cur, upload_id, user_id):
+    cur.execute("""
+        SELECT id, original_name, size, received, expected_sha256, status, sha256
+        FROM uploads WHERE id = %s AND owner_id = %s
+    """, (upload_id, user_id))
+    row = cur.fetchone()
+    if not row:
+        raise UploadError('Upload not found', 404)
+    return {
+        'id': row[0],
+        'filename': row[1],
+        'size': row[2],
+        'received': row[3],
+        'expectedSha256': row[4],
+        'status': row[5],
+        'sha256': row[6],
+    }
+
+
+def upload_status(upload):
+    return {
+        'uploadId': upload['id'],
+        'offset': upload['received'],
+        'size': upload['size'],
+        'complete': upload['status'] == 'complete',
+    }
+
+
+def write_chunk(upload, offset, stream, length):
+    # Called without a database connection checked out: slow clients should
+    # only tie up a file handle, not a pooled connection.
+    if upload['status'] != 'pending':
+        raise UploadError('Upload is already complete', 409, offset=upload['received'])
+    if offset != upload['received']:
+        raise UploadError('Chunk offset does not match the upload offset', 409, offset=upload['received'])
+    if length is None:
+        raise UploadError('Content-Length is required', 411)
+    if length > MAX_CHUNK_SIZE:
+        raise UploadError(f'Chunks are limited to {MAX_CHUNK_SIZE} bytes', 413)
+    if offset + length > upload['size']:
+        raise UploadError('Chunk extends past the declared upload size', 416, offset=upload['received'])
+
+    path = _partial_path(upload['id'])
+    if not os.path.exists(path):
+        raise UploadError('Upload not found', 404)
+
+    written = 0
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        while written < length:
+            data = stream.read(min(STREAM_BUFFER_SIZE, length - written))
+            if not data:
+                break
+            f.write(data)
+            written += len(data)
+    if written != length:
+        raise UploadError('Request body ended before Content-Length bytes were received', 400, offset=upload['received'])
+    return offset + written
+
+
+def record_chunk(cur, upload, new_offset):
+    # Compare-and-set: a concurrent writer for the same offset loses cleanly.
+    cur.execute("""
+        UPDATE uploads SET received = %s
+        WHERE id = %s AND received = %s AND status = 'pending'
+        RETURNING received
+    """, (new_offset, upload['id'], upload['received']))
+    if not cur.fetchone():
+        raise UploadError('Upload offset changed during the write; retry from the current offset', 409)
+    return new_offset
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(STREAM_BUFFER_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def verify_upload(upload, sha256=None):
+    # Hashes the assembled file; like write_chunk this runs without a
+    # connection checked out. Returns the actual SHA-256 digest.
+    if upload['received'] != upload['size']:
+        raise UploadError('Upload is incomplete', 409, offset=upload['received'])
+
+    path = _partial_path(upload['id'])
+    if not os.path.exists(path):
+        raise UploadError('Upload not found', 404)
+    with open(path, 'r+b') as f:
+        f.truncate(upload['size'])
+
+    actual = _hash_file(path)
+    expected = _normalize_hash(sha256) or upload['expectedSha256']
+    if expected and expected != actual:
+        raise UploadError('Checksum mismatch', 422, sha256=actual)
+    return actual
+
+
+def complete_upload(cur, upload, sha256):
+    # Row lock so two concurrent "complete" calls don't both move the file.
+    cur.execute("SELECT status FROM uploads WHERE id = %s FOR UPDATE", (upload['id'],))
+    row = cur.fetchone()
+    if row and row[0] == 'complete':
+        return completed_upload(cur, dict(upload, sha256=sha256))
+
+    path = _partial_path(upload['id'])
+    name = _find_blob(cur, sha256)
+    if name:
+        os.remove(path)
+    else:
+        name = _blob_name(sha256, _extension(upload['filename']))
+        storage.put_file(path, name, mimetypes.guess_type(name)[0])
+    name = _reference_blob(cur, sha256, name, upload['size'])
+
+    cur.execute("""
+        UPDATE uploads SET sha256 = %s, status = 'complete', completed_at = CURRENT_TIMESTAMP
+        WHERE id = %s AND status = 'pending'
+    """, (sha256, upload['id']))
+    return {'uploadId': upload['id'], 'complete': True, 'url': blob_url(name), 'sha256': sha256}
+
+
+def completed_upload(cur, upload):
+    cur.execute("SELECT name FROM blobs WHERE sha256 = %s", (upload['sha256'],))
+    return {'uploadId': upload['id'], 'complete': True, 'url': blob_url(cur.fetchone()[0]), 'sha256': upload['sha256']}
+
+
+def spool_stream(stream):
+    # Single-request uploads (POST /api/upload) are copied to a partial file
+    # first and then go through the same dedup and quota bookkeeping.
+    ensure_folders()
+    upload_id = str(uuid.uuid4())
+    path = _partial_path(upload_id)
+    size = 0
+    try:
+        with open(path, 'wb') as f:
+            for block in iter(lambda: stream.read(STREAM_BUFFER_SIZE), b''):
+                size += len(block)
+                if size > MAX_UPLOAD_SIZE:
+                    raise UploadError(f'File exceeds the {MAX_UPLOAD_SIZE} byte limit', 413)
+                f.write(block)
+        if size == 0:
+            raise UploadError('Empty file')
+    except Exception:
+        discard_partial(upload_id)
+        raise
+    return {
+        'id': upload_id, 'filename': None, 'size': size, 'received': size,
+        'expectedSha256': None, 'status': 'pending', 'sha256': None,
+    }
+
+
+def register_spooled(cur, user_id, upload):
+    if quota_used(cur, user_id) + upload['size'] > USER_UPLOAD_QUOTA:
+        raise UploadError('Upload quota exceeded', 413)
+    cur.execute("""
+        INSERT INTO uploads (id, owner_id, original_name, size, received)
+        VALUES (%s, %s, %s, %s, %s)
+    """, (upload['id'], user_id, upload['filename'], upload['size'], upload['size']))
+
+
+def discard_partial(upload_id):
+    path = _partial_path(upload_id)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def expire_stale_uploads(cur):
+    cur.execute("""
+        DELETE FROM uploads
+        WHERE status = 'pending' AND created_at < CURRENT_TIMESTAMP - make_interval(hours => %s)
+        RETURNING id
+    """, (STALE_UPLOAD_HOURS,))
+    expired = [row[0] for row in cur.fetchall()]
+    for upload_id in expired:
+        discard_partial(upload_id)
+    return len(expired)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    from db import connection
+
+    if sys.argv[1:] != ['cleanup']:
+        sys.exit("Usage: python uploads.py cleanup")
+    with connection() as conn, conn.cursor() as cur:
+        count = expire_stale_uploads(cur)
+        conn.commit()
+    print(f"Removed {count} stale upload(s).")
@@ -0,0 +1,257 @@
+import os
+import time
+import atexit
+import threading
+from psycopg2.extras import Json, execute_values
+from extensions import socketio
+from db import connection
+import metrics
+import inbox
+
+# How send_message persists messages:
+#   sync     INSERT + conversation UPDATE inside the request (default)
+#   commit   hand the message to the background writer and answer once the
+#            batch holding it has committed
+#   enqueue  answer 202 as soon as the message is queued; it is written and
+#            broadcast with the next batch and is lost if the process dies first
+MESSAGE_WRITE_MODE = os.environ.get('MESSAGE_WRITE_MODE', 'sync')
+WRITE_BATCH_SIZE = int(os.environ.get('MESSAGE_WRITE_BATCH_SIZE', 500))
+WRITE_BATCH_WINDOW = float(os.environ.get('MESSAGE_WRITE_BATCH_WINDOW', 0.01))
+WRITE_QUEUE_LIMIT = int(os.environ.get('MESSAGE_WRITE_QUEUE_LIMIT', 10000))
+WRITE_ACK_TIMEOUT = float(os.environ.get('MESSAGE_WRITE_ACK_TIMEOUT', 10))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class WriteFailed(Exception):
+    pass
+
+
+class PendingMessage:
+    def __init__(self, conversation_id, sender_id, content, msg_type, reply_to, file_meta):
+        self.id = None
+        self.conversation_id = conversation_id
+        self.sender_id = sender_id
+        self.content = content
+        self.type = msg_type
+        self.reply_to = reply_to
+        self.file_meta = file_meta
+        self.done = None
+        self.result = None
+        self.error = None
+
+
+class MessageWriter:
+    # Batches queued messages into one transaction: a single UPDATE per
+    # conversation (seq, message_count and last_message collapsed over the
+    # batch), one multi-row INSERT, one read-cursor UPDATE for senders and one
+    # inbox_entries UPDATE.
+    # seq and the message id are assigned inside that transaction, after the
+    # conversation rows are locked, so within a conversation both become
+    # visible in commit order: ?since= delta sync stays exact and history
+    # ordered and paged by id never has a late commit with a lower id.
+    def __init__(self, on_commit, mode=MESSAGE_WRITE_MODE):
+        self.mode = mode
+        self.on_commit = on_commit
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pending = 0
+        self._stats = {
+            'queued': 0,
+            'written': 0,
+            'failed': 0,
+            'rejected': 0,
+            'batches': 0,
+            'flushTimeTotalMs': 0.0,
+            'maxBatch': 0,
+        }
+
+    @property
+    def enabled(self):
+        return self.mode in ('commit', 'enqueue')
+
+    def start(self):
+        with self._lock:
+            if self._queue is not None:
+                return
+            self._queue = socketio.server.eio.create_queue()
+        socketio.start_background_task(self._run)
+        atexit.register(self.drain)
+
+    def submit(self, conversation_id, sender_id, content, msg_type, reply_to, file_meta):
+        self.start()
+        with self._lock:
+            if self._pending >= WRITE_QUEUE_LIMIT:
+                self._stats['rejected'] += 1
+                raise QueueFull()
+            self._pending += 1
+            self._stats['queued'] += 1
+        item = PendingMessage(conversation_id, sender_id, content, msg_type, reply_to, file_meta)
+        if self.mode == 'commit':
+            item.done = socketio.server.eio.create_event()
+        self._queue.put(item)
+        return item
+
+    def wait(self, item):
+        if not item.done.wait(WRITE_ACK_TIMEOUT):
+            raise WriteFailed('Timed out waiting for the message to be written')
+        if item.error:
+            raise WriteFailed(item.error)
+        return item.result
+
+    def write(self, batch):
+        # Writes a batch of PendingMessage in the caller's thread, whatever
+        # the mode (POST /messages/batch), with the same per-item fallback and
+        # publishing as queued batches; read item.result and item.error after.
+        with self._lock:
+            self._pending += len(batch)
+            self._stats['queued'] += len(batch)
+        self.flush(batch)
+
+    def _take_batch(self):
+        empty = socketio.server.eio.get_queue_empty_exception()
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + WRITE_BATCH_WINDOW
+        while len(batch) < WRITE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                self.flush(batch)
+            except Exception as e:
+                metrics.log(f"Message writer loop error: {e}")
+
+    def flush(self, batch):
+        started = time.perf_counter()
+        try:
+            rows = self._write(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                metrics.log(f"Message write failed: {e}")
+                self._finish(batch, error=str(e))
+                return
+            # One bad row must not take the rest of the batch with it.
+            for item in batch:
+                self.flush([item])
+            return
+
+        with self._lock:
+            self._stats['batches'] += 1
+            self._stats['flushTimeTotalMs'] += (time.perf_counter() - started) * 1000
+            self._stats['maxBatch'] = max(self._stats['maxBatch'], len(batch))
+        for item in batch:
+            try:
+                item.result = self.on_commit(item, rows[item.id])
+            except Exception as e:
+                metrics.log(f"Message publish failed: {e}")
+        self._finish(batch)
+
+    def _finish(self, batch, error=None):
+        with self._lock:
+            self._pending -= len(batch)
+            self._stats['failed' if error else 'written'] += len(batch)
+        for item in batch:
+            item.error = error
+            if item.done is not None:
+                item.done.set()
+
+    def _write(self, batch):
+        per_conversation = {}
+        for item in batch:
+            per_conversation.setdefault(item.conversation_id, []).append(item)
+
+        with connection() as conn, conn.cursor() as cur:
+            # Locked in id order so concurrent batches can't deadlock; ids are
+            # drawn only once the locks are held.
+            cur.execute("SELECT id FROM conversations WHERE id = ANY(%s) ORDER BY id FOR UPDATE",
+                        (sorted(per_conversation),))
+            cur.execute("SELECT nextval(pg_get_serial_sequence('messages', 'id')) FROM generate_series(1, %s)",
+                        (len(batch),))
+            for item, (message_id,) in zip(batch, sorted(cur.fetchall())):
+                item.id = message_id
+
+            counters = execute_values(cur, """
+                UPDATE conversations c
+                SET last_message = v.last_message, updated_at = CURRENT_TIMESTAMP,
+                    seq = c.seq + v.n, message_count = c.message_count + v.n,
+                    last_message_id = GREATEST(c.last_message_id, v.message_id),
+                    last_sender_id = v.sender_id, last_message_type = v.type
+                FROM (VALUES %s) AS v(id, n, last_message, message_id, sender_id, type)
+                WHERE c.id = v.id
+                RETURNING c.id, c.seq, c.message_count
+            """, [(cid, len(items), items[-1].content, items[-1].id, items[-1].sender_id, items[-1].type)
+                  for cid, items in sorted(per_conversation.items())],
+                template="(%s, %s, %s, %s, %s, %s)", fetch=True)
+            counters = {row[0]: (row[1], row[2]) for row in counters}
+
+            values = []
+            cursors = {}
+            for cid, items in per_conversation.items():
+                if cid not in counters:
+                    raise WriteFailed(f"Conversation {cid} not found")
+                last_seq, message_count = counters[cid]
+                first_seq = last_seq - len(items) + 1
+                first_count = message_count - len(items) + 1
+                for offset, item in enumerate(items):
+                    item.seq = first_seq + offset
+                    values.append((item.id, cid, item.sender_id, item.content, item.type, item.reply_to,
+                                   Json(item.file_meta) if item.file_meta else None, item.seq))
+                    cursors[(cid, item.sender_id)] = (item.seq, first_count + offset)
+
+            written = execute_values(cur, """
+                INSERT INTO messages (id, conversation_id, sender_id, content, type, reply_to, file_meta, seq)
+                VALUES %s
+                RETURNING id, sender_id, content, type, created_at, reply_to, reactions, is_deleted, file_meta, seq
+            """, values, page_size=len(values), fetch=True)
+
+            # Senders have read everything up to their own last message.
+            execute_values(cur, """
+                UPDATE conversation_participants p
+                SET last_read_seq = v.seq, read_count = v.read_count, last_read_at = CURRENT_TIMESTAMP
+                FROM (VALUES %s) AS v(conversation_id, user_id, seq, read_count)
+                WHERE p.conversation_id = v.conversation_id AND p.user_id = v.user_id
+            """, [(cid, uid, seq, count) for (cid, uid), (seq, count) in sorted(cursors.items())])
+
+            summaries = []
+            for cid, items in per_conversation.items():
+                after = {}
+                for offset, item in enumerate(items):
+                    after[item.sender_id] = len(items) - offset - 1
+                last = items[-1]
+                summaries.append((cid, len(items), last.id, last.content, last.type, last.sender_id, after))
+            inbox.record_messages(cur, summaries)
+            conn.commit()
+
+        return {row[0]: row for row in written}
+
+    def drain(self, timeout=WRITE_ACK_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            socketio.sleep(0.01)
+
+    def stats(self):
+        with self._lock:
+            batches = self._stats['batches']
+            return {
+                'mode': self.mode,
+                'pending': self._pending,
+                'queued': self._stats['queued'],
+                'written': self._stats['written'],
+                'failed': self._stats['failed'],
+                'rejected': self._stats['rejected'],
+                'batches': batches,
+                'maxBatch': self._stats['maxBatch'],
+                'avgBatch': round(self._stats['written'] / batches, 2) if batches else 0.0,
+                'flushTimeAvgMs': round(self._stats['flushTimeTotalMs'] / batches, 3) if batches else 0.0,
+            }